@@ -0,0 +1,136 @@
+"""
+Insert and query latency of the fraud screening index at millions of past claims.
+
+Synthetic claims get random perceptual hashes and reviews drawn from a vocabulary;
+a sample of queries are planted near-duplicates (a few flipped hash bits, a few
+edited words) so recall is reported next to latency:
+
+    python benchmarks/fraud_index.py --entries 1000000 --backend memory
+    python benchmarks/fraud_index.py --entries 1000000 --backend sqlite --path /tmp/fraud_bench.sqlite
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from smart_claims.utils.similarity_index import (  # noqa: E402
+    IndexEntry, MemorySimilarityIndex, MinHasher, SQLiteSimilarityIndex
+)
+
+VOCABULARY = [f"word{index}" for index in range(5000)]
+
+
+def make_review(rng: random.Random, length: int = 60) -> str:
+    return ' '.join(rng.choice(VOCABULARY) for _ in range(length))
+
+
+def edit_review(rng: random.Random, review: str, edits: int = 1) -> str:
+    words = review.split()
+    for _ in range(edits):
+        words[rng.randrange(len(words))] = rng.choice(VOCABULARY)
+    return ' '.join(words)
+
+
+def flip_bits(rng: random.Random, value: int, bits: int) -> int:
+    for position in rng.sample(range(64), bits):
+        value ^= 1 << position
+    return value
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(seconds):
+    return {
+        'p50_ms': percentile(seconds, 0.50) * 1000,
+        'p95_ms': percentile(seconds, 0.95) * 1000,
+        'p99_ms': percentile(seconds, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=1_000_000)
+    parser.add_argument('--images-per-claim', type=int, default=2)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--insert-batch', type=int, default=10_000)
+    parser.add_argument('--backend', choices=['memory', 'sqlite'], default='memory')
+    parser.add_argument('--path', default='fraud_index_bench.sqlite')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    numpy_rng = np.random.default_rng(args.seed)
+    minhasher = MinHasher()
+    if args.backend == 'sqlite':
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.path + suffix):
+                os.remove(args.path + suffix)
+        index = SQLiteSimilarityIndex(args.path)
+    else:
+        index = MemorySimilarityIndex()
+
+    # Unrelated reviews share no MinHash bands, so background entries get random
+    # signatures; the claims used as queries get signatures of real reviews
+    query_every = max(1, args.entries // args.queries)
+    planted = []
+
+    insert_seconds = 0.0
+    batch = []
+    for entry_index in range(args.entries):
+        image_hashes = [rng.getrandbits(64) for _ in range(args.images_per_claim)]
+        if entry_index % query_every == 0 and len(planted) < args.queries:
+            review = make_review(rng)
+            signature = minhasher.signature(review)
+            planted.append((image_hashes[0], review))
+        else:
+            signature = numpy_rng.integers(0, 1 << 32, minhasher.num_perm, dtype=np.uint32)
+        batch.append(IndexEntry(f"claim-{entry_index}", f"group-{entry_index}", image_hashes, signature))
+        if len(batch) == args.insert_batch:
+            started = time.perf_counter()
+            index.add_many(batch)
+            insert_seconds += time.perf_counter() - started
+            batch = []
+    if batch:
+        started = time.perf_counter()
+        index.add_many(batch)
+        insert_seconds += time.perf_counter() - started
+
+    image_latency, review_latency, signature_latency = [], [], []
+    image_hits = review_hits = 0
+    for image_hash, review in planted:
+        started = time.perf_counter()
+        matches = index.similar_images(flip_bits(rng, image_hash, 2))
+        image_latency.append(time.perf_counter() - started)
+        image_hits += bool(matches)
+
+        started = time.perf_counter()
+        signature = minhasher.signature(edit_review(rng, review))
+        signature_latency.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        matches = index.similar_reviews(signature, 0.8)
+        review_latency.append(time.perf_counter() - started)
+        review_hits += bool(matches)
+
+    print(json.dumps({
+        'backend': args.backend,
+        'entries': args.entries,
+        'images': args.entries * args.images_per_claim,
+        'insert_claims_per_sec': args.entries / insert_seconds if insert_seconds else 0.0,
+        'image_query': dict(latency_summary(image_latency), recall=image_hits / len(planted)),
+        'review_signature': latency_summary(signature_latency),
+        'review_query': dict(latency_summary(review_latency), recall=review_hits / len(planted)),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
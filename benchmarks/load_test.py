@@ -0,0 +1,358 @@
+"""
+End-to-end load test of ClaimRefundFlow with every model call served offline.
+
+Generates a synthetic claim corpus (JPEG images of varying resolution, reviews of
+varying length), answers OpenAI requests from the local stub server, scores sentiment
+with a tiny randomly initialised classifier, and runs the corpus at each concurrency
+level. Reports end-to-end and per-stage p50/p95/p99 latency, throughput and peak RSS
+(overall and while each stage was running) as JSON:
+
+    python benchmarks/load_test.py --concurrency 10 100 1000 --claims 1000 --output results.json
+    python benchmarks/load_test.py --latency-ms 800 --error-rate 0.05 --compare baseline.json
+
+With --compare, the run fails when throughput or p95 latency of any level regressed by
+more than --tolerance against the baseline report.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_openai_server import start_stub_server  # noqa: E402
+
+SENTIMENT_LABELS = {0: 'positive', 1: 'negative', 2: 'neutral'}
+REVIEW_FIXTURES = os.path.join(ROOT, 'test', 'problems', 'sentiment_reviews.json')
+PRODUCTS = [
+    ("Panda Stuffed Animal", "A cute stuffed animal in the shape of a Panda"),
+    ("Ceramic Coffee Mug", "A 350ml glazed ceramic mug"),
+    ("Bluetooth Headphones", "Over-ear wireless headphones with noise cancelling"),
+    ("Glass Vase", "A hand-blown decorative glass vase"),
+    ("Hiking Backpack", "A 40 litre backpack with padded straps"),
+]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(seconds):
+    return {
+        'count': len(seconds),
+        'p50_ms': percentile(seconds, 0.50) * 1000,
+        'p95_ms': percentile(seconds, 0.95) * 1000,
+        'p99_ms': percentile(seconds, 0.99) * 1000,
+        'max_ms': max(seconds) * 1000,
+    }
+
+
+def make_tiny_sentiment_model(directory, words):
+    """
+    Save a two-layer BERT classifier with a vocabulary built from `words`
+
+    Its predictions are meaningless but its tokenizer, shapes and code path match the
+    real sentiment model, at a fraction of the cost.
+    """
+    import torch
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizerFast
+
+    os.makedirs(directory, exist_ok=True)
+    vocab_path = os.path.join(directory, 'vocab.txt')
+    with open(vocab_path, 'w') as vocab_file:
+        vocab_file.write("\n".join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + sorted(words)) + "\n")
+    tokenizer = BertTokenizerFast(vocab_file=vocab_path)
+    config = BertConfig(
+        vocab_size=tokenizer.vocab_size, hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+        intermediate_size=64, num_labels=len(SENTIMENT_LABELS), id2label=SENTIMENT_LABELS,
+        label2id={label: index for index, label in SENTIMENT_LABELS.items()},
+    )
+    torch.manual_seed(0)
+    BertForSequenceClassification(config).save_pretrained(directory)
+    tokenizer.save_pretrained(directory)
+    return directory
+
+
+def make_image(path, size, rng):
+    """
+    Write a JPEG of random shapes over noise, so perceptual hashes of different images differ
+    """
+    import numpy as np
+    from PIL import Image, ImageDraw
+
+    width, height = size, int(size * rng.uniform(0.6, 1.0))
+    pixels = np.random.default_rng(rng.getrandbits(32)).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels)
+    draw = ImageDraw.Draw(image)
+    for _ in range(8):
+        box = sorted(rng.sample(range(width), 2)), sorted(rng.sample(range(height), 2))
+        draw.rectangle([box[0][0], box[1][0], box[0][1], box[1][1]], fill=tuple(rng.randrange(256) for _ in range(3)))
+    image.save(path, quality=90)
+
+
+def make_corpus(directory, count, image_sizes, images_per_claim, seed):
+    """
+    Generate synthetic claims with images on disk
+
+    :return: List of claim dictionaries
+    """
+    rng = random.Random(seed)
+    with open(REVIEW_FIXTURES) as fixture_file:
+        reviews = [fixture['text'] for fixture in json.load(fixture_file)]
+    vocabulary = sorted({word.strip('.,!?\'"').lower() for review in reviews for word in review.split()} - {''})
+    os.makedirs(directory, exist_ok=True)
+
+    today = datetime.date.today()
+    claims = []
+    for index in range(count):
+        images = []
+        for image_index in range(rng.randint(1, images_per_claim)):
+            path = os.path.join(directory, f"claim{index}_{image_index}.jpg")
+            make_image(path, rng.choice(image_sizes), rng)
+            images.append(path)
+        # Mostly one review, sometimes several joined into a long complaint. Random words
+        # keep reviews distinct, or fraud screening would flag them as copies of each other
+        review = ' '.join(rng.sample(reviews, rng.choice([1, 1, 1, 2, 5, 20])))
+        review += ' ' + ' '.join(rng.choice(vocabulary) for _ in range(12)) + '.'
+        order_date = today - datetime.timedelta(days=rng.randint(10, 80))
+        name, description = rng.choice(PRODUCTS)
+        claims.append({
+            'customer_id': f"customer-{index}",
+            'order_id': f"order-{index}",
+            'order_date': str(order_date),
+            'claim_date': str(order_date + datetime.timedelta(days=rng.randint(1, 9))),
+            'product_id': f"product-{index % 50}",
+            'product_name': name,
+            'product_description': description,
+            'product_cost': round(rng.uniform(10, 200), 2),
+            'product_review': review,
+            'product_images': images,
+        })
+    return claims
+
+
+class MemorySampler:
+    """
+    Samples resident memory on a background thread, and the stages running at that moment
+    """
+
+    def __init__(self, metrics, interval_seconds=0.01):
+        self.metrics = metrics
+        self.interval_seconds = interval_seconds
+        self.peak_mb = 0.0
+        self.stage_peak_mb = defaultdict(float)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def rss_mb():
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval_seconds):
+            rss = self.rss_mb()
+            self.peak_mb = max(self.peak_mb, rss)
+            for stage_name in self.metrics.active_stages():
+                self.stage_peak_mb[stage_name] = max(self.stage_peak_mb[stage_name], rss)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopping.set()
+        self._thread.join()
+
+
+async def run_level(claims, concurrency):
+    """
+    Process every claim with at most `concurrency` flows in flight
+    """
+    from smart_claims.refund_flow import ClaimRefundFlow
+    from smart_claims.utils.data_models import RefundClaim
+
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def process(claim):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                output = await ClaimRefundFlow(persist=False).kickoff_async(inputs=claim)
+                if not isinstance(output, RefundClaim):
+                    raise RuntimeError(f"Refund flow returned {type(output).__name__} instead of a claim")
+                results.append((time.perf_counter() - started, output.refund_status, output.trace or {}))
+            except Exception as e:
+                results.append((time.perf_counter() - started, f"exception:{type(e).__name__}", {}))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(process(claim) for claim in claims))
+    return time.perf_counter() - started, results
+
+
+def summarize_level(concurrency, wall_seconds, results, sampler, metrics_snapshot):
+    stage_seconds = defaultdict(list)
+    statuses = defaultdict(int)
+    for _, status, trace in results:
+        statuses[status] += 1
+        for stage_name, seconds in trace.get('stages', {}).items():
+            stage_seconds[stage_name].append(seconds)
+
+    return {
+        'concurrency': concurrency,
+        'claims': len(results),
+        'wall_seconds': wall_seconds,
+        'throughput_claims_per_sec': len(results) / wall_seconds,
+        'latency': latency_summary([seconds for seconds, _, _ in results]),
+        'stages': {
+            stage_name: dict(latency_summary(seconds), peak_rss_mb=sampler.stage_peak_mb.get(stage_name))
+            for stage_name, seconds in sorted(stage_seconds.items())
+        },
+        'statuses': dict(statuses),
+        'failed_claims': sum(count for status, count in statuses.items() if status.startswith('exception:')),
+        'errors': metrics_snapshot['errors'],
+        'counters': metrics_snapshot['counters'],
+        'peak_rss_mb': sampler.peak_mb,
+    }
+
+
+def compare_reports(baseline, report, tolerance):
+    """
+    Levels whose throughput dropped or p95 latency grew by more than `tolerance`
+    """
+    previous = {level['concurrency']: level for level in baseline['levels']}
+    regressions = []
+    for level in report['levels']:
+        before = previous.get(level['concurrency'])
+        if before is None:
+            continue
+        if level['throughput_claims_per_sec'] < before['throughput_claims_per_sec'] * (1 - tolerance):
+            regressions.append(f"concurrency {level['concurrency']}: throughput "
+                               f"{before['throughput_claims_per_sec']:.1f} -> {level['throughput_claims_per_sec']:.1f} claims/s")
+        if level['latency']['p95_ms'] > before['latency']['p95_ms'] * (1 + tolerance):
+            regressions.append(f"concurrency {level['concurrency']}: p95 latency "
+                               f"{before['latency']['p95_ms']:.0f} -> {level['latency']['p95_ms']:.0f} ms")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--claims', type=int, default=1000, help="Claims processed at each concurrency level")
+    parser.add_argument('--image-sizes', type=int, nargs='+', default=[256, 1024, 2048], help="Image widths in pixels")
+    parser.add_argument('--images-per-claim', type=int, default=3, help="Maximum images per claim")
+    parser.add_argument('--latency-ms', type=float, default=300.0, help="Stub OpenAI latency")
+    parser.add_argument('--jitter-ms', type=float, default=100.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of stub requests failing with 429/500")
+    parser.add_argument('--sentiment-model', default=None, help="Local sentiment model, a tiny one is generated by default")
+    parser.add_argument('--corpus-dir', default=None, help="Keep the generated corpus here instead of a temporary directory")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', default=None, help="Release or build label stored in the report")
+    parser.add_argument('--output', default=None, help="Write the JSON report to this file")
+    parser.add_argument('--compare', default=None, help="Baseline report to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Accepted relative regression")
+    args = parser.parse_args()
+
+    workspace = tempfile.TemporaryDirectory()
+    corpus_dir = args.corpus_dir or os.path.join(workspace.name, 'corpus')
+    started = time.perf_counter()
+    claims = make_corpus(corpus_dir, args.claims, args.image_sizes, args.images_per_claim, args.seed)
+    corpus_seconds = time.perf_counter() - started
+
+    sentiment_model = args.sentiment_model
+    if sentiment_model is None:
+        words = {word.strip('.,!?\'"').lower() for claim in claims for word in claim['product_review'].split()}
+        sentiment_model = make_tiny_sentiment_model(os.path.join(workspace.name, 'sentiment'), words - {''})
+
+    server = start_stub_server(0, args.latency_ms, args.jitter_ms, args.error_rate)
+
+    # Config is read at import time, so set the environment before importing the flow.
+    # Caching and persistence are off so every level does the same work.
+    os.environ.update({
+        'OPENAI_API_KEY': 'stub',
+        'OPENAI_BASE_URL': f"http://127.0.0.1:{server.server_port}/v1",
+        'SENTIMENT_MODEL': sentiment_model,
+        'SENTIMENT_BACKEND': 'torch',
+        'IMAGE_ANALYSIS_MODEL': 'gpt-4o-mini',
+        'CACHE_BACKEND': 'none',
+        'CLAIM_STORE_BACKEND': 'none',
+        'FRAUD_INDEX_BACKEND': 'memory',
+    })
+    from smart_claims.utils.instrumentation import metrics
+    from smart_claims.utils.model_registry import registry
+    # The tool modules register their models on import, so import them before warming up
+    import smart_claims.refund_flow  # noqa: F401
+
+    load_times = registry.warmup()
+    report = {
+        'label': args.label,
+        'git_commit': git_commit(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'sentiment_model': args.sentiment_model or 'generated tiny BERT',
+        'corpus_seconds': corpus_seconds,
+        'model_load_seconds': load_times,
+        'levels': [],
+    }
+
+    for concurrency in args.concurrency:
+        metrics.reset()
+        with MemorySampler(metrics) as sampler:
+            wall_seconds, results = asyncio.run(run_level(claims, concurrency))
+        level = summarize_level(concurrency, wall_seconds, results, sampler, metrics.to_json())
+        report['levels'].append(level)
+        print(f"concurrency {concurrency}: {level['throughput_claims_per_sec']:.1f} claims/s, "
+              f"p95 {level['latency']['p95_ms']:.0f} ms, peak RSS {level['peak_rss_mb']:.0f} MB", file=sys.stderr)
+
+    # ru_maxrss is reported in kilobytes on Linux
+    report['process_peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    server.shutdown()
+    workspace.cleanup()
+
+    # Claims whose flow raised or returned no claim fail the run
+    failed_claims = sum(level['failed_claims'] for level in report['levels'])
+    exit_code = 1 if failed_claims else 0
+    if failed_claims:
+        print(f"{failed_claims} claims failed", file=sys.stderr)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare_reports(json.load(baseline_file), report, args.tolerance)
+        report['regressions'] = regressions
+        exit_code = 1 if regressions else exit_code
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    print(output)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Throughput of the local vision model at different batch sizes.
+
+Point --model at a small stand-in (any trust_remote_code vision model whose processor
+takes (prompt, images) like Phi-3.5-vision) to benchmark on CPU nodes:
+
+    python benchmarks/local_vlm_batching.py --model path/to/tiny-vlm --device cpu --batch-sizes 1 2 4 8
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def make_images(directory: str, count: int, size: int):
+    from PIL import Image
+
+    paths = []
+    for index in range(count):
+        color = tuple(random.randint(0, 255) for _ in range(3))
+        path = os.path.join(directory, f"image_{index}.jpg")
+        Image.new('RGB', (size, size), color).save(path, quality=85)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default=None, help="Local vision model (defaults to LOCAL_VLM_MODEL)")
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--quantization', default='none')
+    parser.add_argument('--claims', type=int, default=16)
+    parser.add_argument('--images-per-claim', type=int, default=2)
+    parser.add_argument('--image-size', type=int, default=640)
+    parser.add_argument('--max-new-tokens', type=int, default=32)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    # Config is read at import time, so set the environment first
+    if args.model:
+        os.environ['LOCAL_VLM_MODEL'] = args.model
+    os.environ['IMAGE_ANALYSIS_MODEL'] = 'local'
+    os.environ['LOCAL_VLM_DEVICE'] = args.device
+    os.environ['LOCAL_VLM_QUANTIZATION'] = args.quantization
+    os.environ['LOCAL_VLM_MAX_NEW_TOKENS'] = str(args.max_new_tokens)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from smart_claims.tools.image_analysis import ImageAnalysisTool
+    from smart_claims.utils.model_registry import registry
+
+    load_times = registry.warmup(['vision'])
+    tool = ImageAnalysisTool()
+    product_info = {'product_name': 'Panda Stuffed Animal', 'product_description': 'A cute stuffed animal'}
+
+    results = {'model': os.environ.get('LOCAL_VLM_MODEL'), 'load_seconds': load_times['vision'], 'runs': []}
+    with tempfile.TemporaryDirectory() as directory:
+        images = make_images(directory, args.claims * args.images_per_claim, args.image_size)
+        claims = [
+            (images[index * args.images_per_claim:(index + 1) * args.images_per_claim], product_info)
+            for index in range(args.claims)
+        ]
+        for batch_size in args.batch_sizes:
+            started = time.perf_counter()
+            errors = 0
+            for offset in range(0, len(claims), batch_size):
+                outputs = tool.analyze_local_batch(claims[offset:offset + batch_size])
+                errors += sum(output['error'] is not None for output in outputs)
+            elapsed = time.perf_counter() - started
+            results['runs'].append({
+                'batch_size': batch_size,
+                'seconds': elapsed,
+                'claims_per_sec': len(claims) / elapsed,
+                'errors': errors,
+            })
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Memory and throughput of forked worker processes that share the parent's models.
+
+Queues a synthetic claim corpus in a temporary claim store, answers OpenAI requests
+from the local stub server and processes the claims with PreforkWorkerPool, once with
+every worker process loading its own models ('separate') and once with the models
+loaded before forking ('preload'). Reports the parent and per-worker RSS, the
+combined PSS (shared pages counted once) and throughput as JSON:
+
+    python benchmarks/prefork_workers.py --processes 4 --threads 2 --claims 64
+    python benchmarks/prefork_workers.py --processes 8 --sentiment-model ProsusAI/finbert --output prefork.json
+
+Needs Linux, for fork() and /proc/<pid>/smaps_rollup.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import make_corpus, make_tiny_sentiment_model  # noqa: E402
+
+
+def start_stub_process(latency_ms, jitter_ms):
+    """
+    Run the stub server in its own process, as the benchmark process must not have
+    threads when it forks the workers
+
+    :return: Tuple of the process and the base URL it serves
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-u', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub_openai_server.py'),
+         '--port', '0', '--latency-ms', str(latency_ms), '--jitter-ms', str(jitter_ms)],
+        stdout=subprocess.PIPE, text=True
+    )
+    url = process.stdout.readline().split()[-1]
+    return process, url
+
+
+def run_mode(mode, claims, args):
+    from smart_claims.job_queue import PreforkWorkerPool, claim_status, process_memory, submit_claim
+
+    claim_ids = [submit_claim(claim) for claim in claims]
+    pool = PreforkWorkerPool(processes=args.processes, threads=args.threads,
+                             torch_threads=args.torch_threads, preload=mode == 'preload')
+    started = time.perf_counter()
+    pool.start()
+    parent_mb = process_memory(os.getpid()).get('rss_mb', 0.0)
+
+    peak_rss, peak_pss = {}, 0.0
+    pending = set(claim_ids)
+    while pending:
+        time.sleep(0.2)
+        usage = pool.memory_usage()
+        for pid, memory in usage.items():
+            if pid != os.getpid():
+                peak_rss[pid] = max(peak_rss.get(pid, 0.0), memory.get('rss_mb', 0.0))
+        peak_pss = max(peak_pss, sum(memory.get('pss_mb', 0.0) for memory in usage.values()))
+        pending = {claim_id for claim_id in pending if not claim_status(claim_id)['done']}
+    wall_seconds = time.perf_counter() - started
+    pool.stop()
+
+    return {
+        'mode': mode,
+        'processes': args.processes,
+        'threads_per_process': args.threads,
+        'torch_threads_per_process': pool.torch_threads,
+        'wall_seconds': wall_seconds,
+        'throughput_claims_per_sec': len(claims) / wall_seconds,
+        'parent_rss_mb': parent_mb,
+        'worker_peak_rss_mb': sorted(peak_rss.values()),
+        'peak_total_pss_mb': peak_pss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=2, help="Worker threads per process")
+    parser.add_argument('--torch-threads', type=int, default=0, help="torch threads per process, 0 divides the cores")
+    parser.add_argument('--claims', type=int, default=64, help="Claims processed in each mode")
+    parser.add_argument('--image-sizes', type=int, nargs='+', default=[256, 1024])
+    parser.add_argument('--latency-ms', type=float, default=200.0, help="Stub OpenAI latency")
+    parser.add_argument('--jitter-ms', type=float, default=50.0)
+    parser.add_argument('--sentiment-model', default=None, help="Local sentiment model, a tiny one is generated by default")
+    parser.add_argument('--modes', nargs='+', choices=['separate', 'preload'], default=['separate', 'preload'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    workspace = tempfile.TemporaryDirectory()
+    claims = make_corpus(os.path.join(workspace.name, 'corpus'), args.claims, args.image_sizes, 2, args.seed)
+    sentiment_model = args.sentiment_model
+    if sentiment_model is None:
+        words = {word.strip('.,!?\'"').lower() for claim in claims for word in claim['product_review'].split()}
+        sentiment_model = make_tiny_sentiment_model(os.path.join(workspace.name, 'sentiment'), words - {''})
+    stub, base_url = start_stub_process(args.latency_ms, args.jitter_ms)
+
+    # Every mode processes the same claims, so decisions are not reused and repeated
+    # images are not flagged as fraud
+    os.environ.update({
+        'OPENAI_API_KEY': 'stub',
+        'OPENAI_BASE_URL': base_url,
+        'SENTIMENT_MODEL': sentiment_model,
+        'SENTIMENT_BACKEND': 'torch',
+        'IMAGE_ANALYSIS_MODEL': 'gpt-4o-mini',
+        'CACHE_BACKEND': 'none',
+        'CLAIM_STORE_PATH': os.path.join(workspace.name, 'claims.db'),
+        'CLAIM_STORE_REUSE_DECISIONS': 'false',
+        'FRAUD_SCREENING_ENABLED': 'false',
+    })
+
+    report = {
+        'cpus': os.cpu_count(),
+        'sentiment_model': args.sentiment_model or 'generated tiny BERT',
+        'claims': args.claims,
+        'modes': [],
+    }
+    # 'separate' runs first: once the parent has loaded the models every child inherits them
+    for mode in sorted(args.modes, key=['separate', 'preload'].index):
+        result = run_mode(mode, [dict(claim, claim_id=None) for claim in claims], args)
+        report['modes'].append(result)
+        print(f"{mode}: {result['throughput_claims_per_sec']:.1f} claims/s, "
+              f"total PSS {result['peak_total_pss_mb']:.0f} MB", file=sys.stderr)
+
+    stub.terminate()
+    workspace.cleanup()
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
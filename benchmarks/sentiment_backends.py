@@ -0,0 +1,182 @@
+"""
+Accuracy parity, latency, throughput and memory of the sentiment inference backends.
+
+Each backend runs in its own process so peak RSS is measured in isolation. Labels and
+scores are compared with the full-precision torch backend on a fixture set of reviews,
+and the script exits non-zero when a backend disagrees beyond the tolerances:
+
+    python benchmarks/sentiment_backends.py --backends torch int8 onnx onnx-int8 --threads 4
+    python benchmarks/sentiment_backends.py --model path/to/small-classifier --repeat 2
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_FIXTURES = os.path.join(ROOT, 'test', 'problems', 'sentiment_reviews.json')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def current_rss_mb():
+    """
+    Resident memory right now, from /proc on Linux, None elsewhere
+
+    :return: Tuple of total RSS and anonymous RSS in MB. Model weights memory-mapped from
+        safetensors files count towards the total but are clean pages the kernel can
+        reclaim, so the anonymous part is what a backend really costs.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            fields = dict(line.split(':', 1) for line in status if ':' in line)
+    except OSError:
+        return None, None
+    return int(fields['VmRSS'].split()[0]) / 1024, int(fields['RssAnon'].split()[0]) / 1024
+
+
+def run_backend(args):
+    """
+    Measure one backend inside this process and print the results as JSON
+    """
+    # Config is read at import time, so set the environment first
+    os.environ['SENTIMENT_BACKEND'] = args.worker
+    os.environ['SENTIMENT_NUM_THREADS'] = str(args.threads)
+    if args.model:
+        os.environ['SENTIMENT_MODEL'] = args.model
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+    sys.path.insert(0, ROOT)
+
+    from smart_claims.tools.sentiment_analysis import SentimentAnalysisTool
+    from smart_claims.utils.model_registry import registry
+
+    with open(args.fixtures) as fixture_file:
+        texts = [fixture['text'] for fixture in json.load(fixture_file)]
+
+    load_seconds = registry.warmup(['sentiment'])['sentiment']
+    tool = SentimentAnalysisTool()
+    # _run_batch bypasses the result cache so every call reaches the model
+    predictions = tool._run_batch(texts)
+    errors = [prediction['error'] for prediction in predictions if prediction['error']]
+    if errors:
+        raise RuntimeError(errors[0])
+
+    latencies = []
+    for _ in range(args.repeat):
+        for text in texts:
+            started = time.perf_counter()
+            tool._run_batch([text])
+            latencies.append(time.perf_counter() - started)
+
+    workload = texts * args.repeat
+    started = time.perf_counter()
+    for offset in range(0, len(workload), args.batch_size):
+        tool._run_batch(workload[offset:offset + args.batch_size])
+    batch_seconds = time.perf_counter() - started
+
+    rss_mb, anon_rss_mb = current_rss_mb()
+    print(json.dumps({
+        'backend': args.worker,
+        'load_seconds': load_seconds,
+        'labels': [prediction['sentiment_label'] for prediction in predictions],
+        'scores': [prediction['sentiment_score'] for prediction in predictions],
+        'latency_ms': {
+            'p50': percentile(latencies, 0.50) * 1000,
+            'p95': percentile(latencies, 0.95) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+        },
+        'throughput_texts_per_sec': len(workload) / batch_seconds,
+        # Steady state after loading; the peak also includes the loading spike
+        'rss_mb': rss_mb,
+        'anon_rss_mb': anon_rss_mb,
+        # ru_maxrss is reported in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def compare(reference, candidate, max_score_diff):
+    """
+    Label agreement and score drift of a backend against the torch backend
+    """
+    pairs = list(zip(reference['labels'], reference['scores'], candidate['labels'], candidate['scores']))
+    mismatches = [index for index, (label, _, other_label, _) in enumerate(pairs) if label != other_label]
+    score_diffs = [abs(score - other_score) for label, score, other_label, other_score in pairs if label == other_label]
+    agreement = 1 - len(mismatches) / len(pairs)
+    max_diff = max(score_diffs, default=0.0)
+    return {
+        'label_agreement': agreement,
+        'max_score_diff': max_diff,
+        'mismatched_fixtures': mismatches,
+        'passed': max_diff <= max_score_diff,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', default=['torch', 'int8', 'onnx', 'onnx-int8'])
+    parser.add_argument('--model', default=None, help="Sentiment model (defaults to SENTIMENT_MODEL)")
+    parser.add_argument('--fixtures', default=DEFAULT_FIXTURES)
+    parser.add_argument('--repeat', type=int, default=5, help="Passes over the fixtures for latency and throughput")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threads', type=int, default=0, help="CPU threads per backend, 0 keeps the default")
+    parser.add_argument('--min-agreement', type=float, default=0.95, help="Smallest accepted label agreement with torch")
+    parser.add_argument('--max-score-diff', type=float, default=0.05, help="Largest accepted score difference with torch")
+    parser.add_argument('--output', default=None, help="Also write the report to this JSON file")
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_backend(args)
+        return
+
+    backends = ['torch'] + [backend for backend in args.backends if backend != 'torch']
+    results = {}
+    for backend in backends:
+        command = [sys.executable, os.path.abspath(__file__), '--worker', backend, '--fixtures', args.fixtures,
+                   '--repeat', str(args.repeat), '--batch-size', str(args.batch_size), '--threads', str(args.threads)]
+        if args.model:
+            command += ['--model', args.model]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            results[backend] = {'backend': backend, 'error': completed.stderr.strip().splitlines()[-1:]}
+            continue
+        results[backend] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    reference = results['torch']
+    report = {'model': args.model or os.environ.get('SENTIMENT_MODEL', 'ProsusAI/finbert'), 'backends': []}
+    failed = 'error' in reference
+    for backend in backends:
+        result = results[backend]
+        if 'error' in result:
+            report['backends'].append(result)
+            failed = True
+            continue
+        entry = {key: value for key, value in result.items() if key not in ('labels', 'scores')}
+        if backend != 'torch' and 'error' not in reference:
+            parity = compare(reference, result, args.max_score_diff)
+            parity['passed'] = parity['passed'] and parity['label_agreement'] >= args.min_agreement
+            entry['parity'] = parity
+            entry['speedup_p50'] = reference['latency_ms']['p50'] / result['latency_ms']['p50']
+            entry['speedup_throughput'] = result['throughput_texts_per_sec'] / reference['throughput_texts_per_sec']
+            if result['anon_rss_mb'] and reference['anon_rss_mb']:
+                entry['anon_rss_ratio'] = result['anon_rss_mb'] / reference['anon_rss_mb']
+            failed = failed or not parity['passed']
+        report['backends'].append(entry)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint.
+
+Responds to POST /v1/chat/completions with a structured output that matches the
+requested json_schema, after a configurable latency, and fails a configurable share
+of requests with 429/500 so retry, backoff and rate limiting can be exercised offline:
+
+    python benchmarks/stub_openai_server.py --port 8100 --latency-ms 300 --error-rate 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8100/v1 OPENAI_API_KEY=stub python main.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+CANNED_OUTPUTS = {
+    'ImageAnalysisResponse': lambda: {
+        'detected_defects': random.sample(['scratch', 'torn seam', 'stain', 'dent', 'missing part'], 2),
+        'defect_score': round(random.uniform(0.1, 0.9), 2),
+    },
+    'RefundEstimationResponse': lambda: {
+        'refund_amount': round(random.uniform(5, 50), 2),
+        'refund_status': 'Approved',
+        'refund_reason': 'Defects confirmed by image analysis.',
+        'refund_notes': 'Generated by the stub server.',
+    },
+}
+
+
+def sample_from_schema(schema: Dict[str, Any], definitions: Dict[str, Any]) -> Any:
+    """
+    Build a minimal value that satisfies a JSON schema
+    """
+    if '$ref' in schema:
+        return sample_from_schema(definitions[schema['$ref'].split('/')[-1]], definitions)
+    if 'anyOf' in schema:
+        return sample_from_schema(schema['anyOf'][0], definitions)
+    kind = schema.get('type')
+    if kind == 'object':
+        return {name: sample_from_schema(prop, definitions) for name, prop in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return [sample_from_schema(schema.get('items', {}), definitions)]
+    if kind == 'number':
+        return 0.5
+    if kind == 'integer':
+        return 1
+    if kind == 'boolean':
+        return True
+    if kind == 'null':
+        return None
+    return 'stub'
+
+
+class StubSettings:
+    latency_ms = 200.0
+    jitter_ms = 50.0
+    error_rate = 0.0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    settings = StubSettings
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Dict[str, str] = None) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        delay = max(0.0, random.gauss(self.settings.latency_ms, self.settings.jitter_ms)) / 1000.0
+        time.sleep(delay)
+
+        if not self.path.endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': f"Unknown path {self.path}"}})
+            return
+
+        if random.random() < self.settings.error_rate:
+            if random.random() < 0.5:
+                self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'rate_limit_error'}}, {'retry-after': '0'})
+            else:
+                self._send_json(500, {'error': {'message': 'Stub server error', 'type': 'server_error'}})
+            return
+
+        self._send_json(200, self.completion(request))
+
+    @staticmethod
+    def completion(request: Dict[str, Any]) -> Dict[str, Any]:
+        response_format = request.get('response_format') or {}
+        json_schema = response_format.get('json_schema') or {}
+        name = json_schema.get('name', '')
+        if name in CANNED_OUTPUTS:
+            output = CANNED_OUTPUTS[name]()
+        elif json_schema:
+            schema = json_schema.get('schema', {})
+            output = sample_from_schema(schema, schema.get('$defs', {}))
+        else:
+            output = 'stub response'
+        content = output if isinstance(output, str) else json.dumps(output)
+
+        prompt_tokens = len(json.dumps(request.get('messages', []))) // 4
+        completion_tokens = len(content) // 4
+        return {
+            'id': f"chatcmpl-{uuid.uuid4().hex}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'stub'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content, 'refusal': None},
+                'finish_reason': 'stop',
+                'logprobs': None,
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }
+
+
+def start_stub_server(port: int = 0, latency_ms: float = 200.0, jitter_ms: float = 50.0, error_rate: float = 0.0) -> ThreadingHTTPServer:
+    """
+    Start the stub server on a background thread
+
+    :param port: Port to listen on, 0 picks a free port
+    :return: Running server, its base URL is http://127.0.0.1:{server.server_port}/v1
+    """
+    settings = type('Settings', (StubSettings,), {
+        'latency_ms': latency_ms,
+        'jitter_ms': jitter_ms,
+        'error_rate': error_rate,
+    })
+    handler = type('Handler', (StubHandler,), {'settings': settings})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency-ms', type=float, default=200.0)
+    parser.add_argument('--jitter-ms', type=float, default=50.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = start_stub_server(args.port, args.latency_ms, args.jitter_ms, args.error_rate)
+    print(f"Stub OpenAI server listening on http://127.0.0.1:{server.server_port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
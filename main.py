@@ -1,7 +1,12 @@
-from smart_claims.refund_flow import ClaimRefundFlow
+import asyncio
+import time
 import gradio as gr
+import httpx
+import uvicorn
 from datetime import date
 import uuid
+from smart_claims.api import app
+from smart_claims.utils.config import Config
 
 
 # test data for reference
@@ -18,8 +23,10 @@ import uuid
 #     "product_images": ["test/data/images/image1.jpg", "test/data/images/image2.jpg", "test/data/images/image3.jpg"]
 # }
 
-def validate_form_data(order_date, product_name, product_description, product_cost, product_review, product_images):
+def validate_form_data(customer_id, order_date, product_name, product_description, product_cost, product_review, product_images):
     
+    if not customer_id or not customer_id.strip():
+        raise gr.Error("Customer ID cannot be empty")
     if not order_date:
         raise gr.Error("Order Date cannot be empty")
     if not product_name:
@@ -33,10 +40,21 @@ def validate_form_data(order_date, product_name, product_description, product_co
     if not product_images:
         raise gr.Error("Product Images cannot be empty")
 
-    
-# TODO: Integrate the Gradio Interface with the ClaimRefundFlow
-# Function to process user inputs
-def process_input(
+
+# The UI has no product or order catalogue, so those ids are derived from the form: a
+# resubmission by the same customer for the same product and order keeps its ids and
+# is not screened as another customer's duplicate claim
+UI_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "smart-claims-ui")
+
+
+def stable_id(*parts) -> str:
+    return str(uuid.uuid5(UI_NAMESPACE, "\x1f".join(str(part) for part in parts)))
+
+
+# Function to process user inputs: the claim is queued through the API and the
+# result polled, so the UI never runs the flow itself
+async def process_input(
+        customer_id,
         order_date, 
         product_name, 
         product_description, 
@@ -45,14 +63,16 @@ def process_input(
         product_images
     ):
     
-    validate_form_data(order_date, product_name, product_description, product_cost, product_review, product_images)
+    validate_form_data(customer_id, order_date, product_name, product_description, product_cost, product_review, product_images)
     
+    customer_id = customer_id.strip()
+    product_id = stable_id("product", product_name, product_description)
     customer_claim = {
-        "customer_id": uuid.uuid4(),
-        "order_id": uuid.uuid4(),
+        "customer_id": customer_id,
+        "order_id": stable_id("order", customer_id, product_id, order_date),
         "order_date": str(order_date),
         "claim_date": str(date.today()),
-        "product_id": uuid.uuid4(),
+        "product_id": product_id,
         "product_name": product_name,
         "product_description": product_description,
         "product_cost": product_cost,
@@ -60,11 +80,22 @@ def process_input(
         "product_images": [image[0] for image in product_images]
     }
     
-    # Constructing the returned data in the same format
-    flow = ClaimRefundFlow()
-    final_output = flow.kickoff(inputs=customer_claim)
+    async with httpx.AsyncClient(base_url=Config.API_URL) as client:
+        response = await client.post("/claims", json=customer_claim)
+        if response.status_code != 202:
+            raise gr.Error(f"Claim could not be submitted: {response.text}")
+        status_url = response.json()["status_url"]
 
-    return final_output
+        deadline = time.monotonic() + Config.UI_RESULT_TIMEOUT_SECONDS
+        while True:
+            status = (await client.get(status_url)).json()
+            if status["done"]:
+                return status["claim"]
+            if time.monotonic() > deadline:
+                # The claim stays queued; its id can be polled through the API later
+                return {"claim_id": status["claim_id"], "refund_status": status["status"],
+                        "refund_reason": "Still processing, check back later"}
+            await asyncio.sleep(Config.UI_POLL_SECONDS)
 
 if __name__ == "__main__":
     
@@ -72,6 +103,7 @@ if __name__ == "__main__":
     iface = gr.Interface(
         fn=process_input,
         inputs=[
+            gr.Textbox(label="Customer ID", placeholder="Enter your Customer ID", type="text"),
             gr.DateTime( label="Order Date", include_time=False),  # Date input for order date
             gr.Textbox(label="Product Name", placeholder="Enter Product Name", type="text"),
             gr.Textbox(label="Product Description", placeholder="Enter Product Description", type="text"),
@@ -85,4 +117,6 @@ if __name__ == "__main__":
         title="Claim Refund Agent",
     )
 
-    iface.launch()
+    # Serve the UI from the API process, at /ui
+    app = gr.mount_gradio_app(app, iface, path="/ui")
+    uvicorn.run(app, host=Config.API_HOST, port=Config.API_PORT)
@@ -0,0 +1,114 @@
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from smart_claims.job_queue import ClaimWorkerPool, amend_claim, claim_status, submit_claim
+from smart_claims.utils.config import Config
+from smart_claims.utils.claim_store import get_claim_store
+
+
+class ClaimSubmission(BaseModel):
+    """
+    Claim fields accepted by the submission endpoint
+    """
+    claim_id: Optional[str] = None
+    claim_date: str
+    customer_id: str
+    customer_name: Optional[str] = None
+    product_id: str
+    product_name: str
+    product_description: str
+    product_cost: float
+    order_id: str
+    order_date: str
+    product_review: str
+    product_images: Optional[List[str]] = None
+
+
+class ClaimAmendment(BaseModel):
+    """
+    Claim fields that can be changed after submission; fields left out keep their value
+    """
+    customer_name: Optional[str] = None
+    product_name: Optional[str] = None
+    product_description: Optional[str] = None
+    product_review: Optional[str] = None
+    product_images: Optional[List[str]] = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # With JOB_WORKERS=0 the API only queues claims and standalone workers process them
+    pool = None
+    if Config.JOB_WORKERS > 0:
+        pool = await run_in_threadpool(ClaimWorkerPool(workers=Config.JOB_WORKERS).start)
+    yield
+    if pool is not None:
+        await run_in_threadpool(pool.stop, Config.JOB_POLL_SECONDS * 2)
+
+
+app = FastAPI(title=Config.PROJECT_NAME, lifespan=lifespan)
+
+
+@app.post("/claims", status_code=202)
+async def create_claim(submission: ClaimSubmission) -> Dict[str, Any]:
+    """
+    Queue a claim and return its id without waiting for the decision
+    """
+    try:
+        claim_id = await run_in_threadpool(submit_claim, submission.model_dump())
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {'claim_id': claim_id, 'status': "Pending", 'status_url': f"/claims/{claim_id}"}
+
+
+@app.patch("/claims/{claim_id}", status_code=202)
+async def update_claim(claim_id: str, amendment: ClaimAmendment) -> Dict[str, Any]:
+    """
+    Queue an amended claim; only the stages whose inputs changed are run again
+    """
+    try:
+        await run_in_threadpool(amend_claim, claim_id, amendment.model_dump(exclude_unset=True))
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown claim {claim_id}")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {'claim_id': claim_id, 'status': "Pending", 'status_url': f"/claims/{claim_id}"}
+
+
+@app.get("/claims/{claim_id}")
+async def get_claim(claim_id: str) -> Dict[str, Any]:
+    """
+    Status of a claim, with the decision once processing is done
+    """
+    status = await run_in_threadpool(claim_status, claim_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Unknown claim {claim_id}")
+    return status
+
+
+@app.get("/claims/{claim_id}/result")
+async def get_claim_result(claim_id: str):
+    """
+    Final claim, or 202 with the current status while it is still queued or running
+    """
+    status = await run_in_threadpool(claim_status, claim_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Unknown claim {claim_id}")
+    if not status['done']:
+        return JSONResponse(status_code=202, content={'claim_id': claim_id, 'status': status['status']})
+    return status['claim']
+
+
+@app.get("/health")
+async def health() -> Dict[str, Any]:
+    return {
+        'status': "ok",
+        'pending': await run_in_threadpool(get_claim_store().count, status="Pending"),
+        'processing': await run_in_threadpool(get_claim_store().count, status="Processing"),
+        'workers': sum(pool.workers for pool in ClaimWorkerPool.running),
+    }
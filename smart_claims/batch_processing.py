@@ -0,0 +1,323 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Any, Iterator, Optional, Set, Tuple
+from smart_claims.refund_flow import ClaimRefundFlow
+from smart_claims.tools.refund_calculator import rules_engine
+from smart_claims.utils.config import Config
+from smart_claims.utils.claim_store import get_claim_store
+from smart_claims.utils.data_models import RefundClaim
+from smart_claims.utils.instrumentation import metrics
+
+
+class StageStats:
+    """
+    Accumulates per-stage wall time so batch throughput can be reported per flow step
+    """
+
+    def __init__(self):
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.seconds: Dict[str, float] = defaultdict(float)
+
+    def add(self, stage_timings: Dict[str, float]) -> None:
+        """
+        Add the stage timings of one processed claim
+
+        :param stage_timings: Mapping of stage name to wall time in seconds
+        """
+        for stage, seconds in stage_timings.items():
+            self.counts[stage] += 1
+            self.seconds[stage] += seconds
+
+    def report(self, concurrency: int) -> Dict[str, Dict[str, float]]:
+        """
+        Summarize stage throughput
+
+        :param concurrency: Number of claims processed in parallel
+        :return: Mapping of stage name to count, average latency and claims/sec
+        """
+        summary = {}
+        for stage, count in self.counts.items():
+            seconds = self.seconds[stage]
+            per_worker = count / seconds if seconds > 0 else 0.0
+            summary[stage] = {
+                'claims': count,
+                'avg_seconds': seconds / count if count else 0.0,
+                'claims_per_sec_per_worker': per_worker,
+                'claims_per_sec': per_worker * concurrency,
+            }
+        return summary
+
+
+def load_claims(input_path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Stream claims from a JSONL, JSON or CSV file
+
+    CSV files use the same columns as test/problems/test.json; the product_images
+    column holds either a JSON list or a ';' separated list of paths.
+
+    :param input_path: Path to the claims file
+    :return: Iterator over claim dictionaries
+    """
+    extension = os.path.splitext(input_path)[1].lower()
+    if extension == '.csv':
+        with open(input_path, newline='') as claims_file:
+            for row in csv.DictReader(claims_file):
+                images = (row.get('product_images') or '').strip()
+                if images.startswith('['):
+                    row['product_images'] = json.loads(images)
+                else:
+                    row['product_images'] = [path for path in images.split(';') if path]
+                row['product_cost'] = float(row['product_cost'])
+                yield row
+    elif extension == '.json':
+        with open(input_path) as claims_file:
+            claims = json.load(claims_file)
+        yield from claims if isinstance(claims, list) else [claims]
+    else:
+        with open(input_path) as claims_file:
+            for line in claims_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class BatchClaimProcessor:
+    """
+    Runs many claims through ClaimRefundFlow with bounded concurrency.
+
+    Finished claims are written to the claim store in bulk, then their results are
+    appended to an output JSONL file, then their indices are appended to a checkpoint
+    file together with the size of the output file at that point. An interrupted run
+    is resumed from the last checkpoint: output written after it is dropped and those
+    claims run again, so every checkpointed claim is stored and has exactly one line.
+
+    Claims that fail are not checkpointed: their records go to an errors JSONL file
+    next to the output, rewritten on every run, and a resumed run processes them again.
+    """
+
+    def __init__(self, concurrency: int = Config.BATCH_CONCURRENCY, progress_interval: int = Config.BATCH_PROGRESS_INTERVAL):
+        self.concurrency = max(1, concurrency)
+        self.progress_interval = progress_interval
+        self.stage_stats = StageStats()
+
+    @staticmethod
+    def checkpoint_path(output_path: str) -> str:
+        return output_path + '.checkpoint'
+
+    @staticmethod
+    def errors_path(output_path: str) -> str:
+        return output_path + '.errors'
+
+    def load_checkpoint(self, output_path: str) -> Set[int]:
+        """
+        Load the indices of claims completed by a previous run
+
+        Each checkpoint line is "<claim index> <output file size>". The output file is
+        cut back to the size recorded by the last complete line.
+
+        :param output_path: Path to the output JSONL file
+        :return: Set of completed claim indices
+        """
+        completed = set()
+        output_size = 0
+        checkpoint = self.checkpoint_path(output_path)
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as checkpoint_file:
+                for line in checkpoint_file:
+                    fields = line.split()
+                    # A line cut short by a crash has no newline and may hold a wrong size
+                    if not line.endswith('\n') or len(fields) != 2 or not all(field.isdigit() for field in fields):
+                        continue
+                    completed.add(int(fields[0]))
+                    output_size = int(fields[1])
+            self._truncate_checkpoint(checkpoint)
+        self._truncate_output(output_path, output_size)
+        return completed
+
+    @staticmethod
+    def _truncate_checkpoint(checkpoint: str) -> None:
+        """
+        Drop a half-written trailing checkpoint line, looking back only from the end of the file
+        """
+        with open(checkpoint, 'rb+') as checkpoint_file:
+            end = checkpoint_file.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                step = min(4096, position)
+                checkpoint_file.seek(position - step)
+                chunk = checkpoint_file.read(step)
+                newline = chunk.rfind(b'\n')
+                if newline != -1:
+                    position = position - step + newline + 1
+                    break
+                position -= step
+            if position != end:
+                checkpoint_file.truncate(position)
+
+    @staticmethod
+    def _truncate_output(output_path: str, size: int) -> None:
+        """
+        Drop results written after the last checkpoint, including a half-written record
+        """
+        if os.path.exists(output_path) and os.path.getsize(output_path) > size:
+            with open(output_path, 'rb+') as output_file:
+                output_file.truncate(size)
+
+    @staticmethod
+    def process_claim(index: int, claim: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Run a single claim through the refund flow
+
+        :param index: Position of the claim in the input file
+        :param claim: Claim dictionary
+        :return: Output record for the claim
+        """
+        # Claims are stored in bulk by the batch loop rather than one by one
+        flow = ClaimRefundFlow(persist=False)
+        try:
+            result = flow.kickoff(inputs=claim)
+            # The flow ends on a RefundClaim; anything else means a step did not run
+            if not isinstance(result, RefundClaim):
+                raise RuntimeError(f"Refund flow returned {type(result).__name__} instead of a claim")
+            result = result.model_dump()
+            error = None
+        except Exception as e:
+            logging.error(f"Batch claim {index} failed: {e}")
+            result = claim
+            error = str(e)
+
+        return {
+            'batch_index': index,
+            'claim': result,
+            'error': error,
+            'stage_timings': dict(flow.stage_timings),
+            'stage_outputs': flow.stage_outputs,
+        }
+
+    def run(self, input_path: str, output_path: str, resume: bool = True) -> Dict[str, Any]:
+        """
+        Process every claim in the input file
+
+        :param input_path: Path to a JSONL, JSON or CSV file of claims
+        :param output_path: Path to the output JSONL file
+        :param resume: Skip claims recorded in the checkpoint of a previous run; claims
+            that failed in that run are processed again
+        :return: Throughput summary of the run
+        """
+        completed = self.load_checkpoint(output_path) if resume else set()
+        mode = 'a' if resume else 'w'
+        processed = failed = 0
+        started = time.perf_counter()
+
+        with open(output_path, mode) as output_file, \
+                open(self.checkpoint_path(output_path), mode) as checkpoint_file, \
+                open(self.errors_path(output_path), 'w') as errors_file, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+
+            def flush() -> None:
+                # Store first, then write the results, then checkpoint them
+                self._store_claims([(record['claim'], stage_outputs) for record, stage_outputs in finished])
+                for record, _ in finished:
+                    output_file.write(json.dumps(record, default=str) + '\n')
+                output_file.flush()
+                os.fsync(output_file.fileno())
+                output_size = output_file.tell()
+                for record, _ in finished:
+                    checkpoint_file.write(f"{record['batch_index']} {output_size}\n")
+                checkpoint_file.flush()
+                finished.clear()
+
+            def drain(pending, return_when) -> Tuple[set, int, int]:
+                done, pending = wait(pending, return_when=return_when)
+                ok = errors = 0
+                for future in done:
+                    record = future.result()
+                    stage_outputs = record.pop('stage_outputs')
+                    self.stage_stats.add(record['stage_timings'])
+                    if record['error'] is None:
+                        finished.append((record, stage_outputs))
+                        ok += 1
+                    else:
+                        # Left out of the checkpoint so that a resumed run retries it
+                        errors_file.write(json.dumps(record, default=str) + '\n')
+                        errors_file.flush()
+                        errors += 1
+                if len(finished) >= Config.CLAIM_STORE_BULK_SIZE:
+                    flush()
+                return pending, ok, errors
+
+            finished = []
+            pending = set()
+            for index, claim in enumerate(load_claims(input_path)):
+                if index in completed:
+                    continue
+                # Bound the number of claims held in memory to a small window
+                if len(pending) >= self.concurrency * 2:
+                    pending, ok, errors = drain(pending, FIRST_COMPLETED)
+                    processed, failed = processed + ok, failed + errors
+                    self._log_progress(processed + failed, started)
+                pending.add(executor.submit(self.process_claim, index, claim))
+
+            while pending:
+                pending, ok, errors = drain(pending, FIRST_COMPLETED)
+                processed, failed = processed + ok, failed + errors
+                self._log_progress(processed + failed, started)
+            if finished:
+                flush()
+
+        elapsed = time.perf_counter() - started
+        total = processed + failed
+        return {
+            'claims': total,
+            'failed': failed,
+            'skipped': len(completed),
+            'wall_seconds': elapsed,
+            'claims_per_sec': total / elapsed if elapsed > 0 else 0.0,
+            'stages': self.stage_stats.report(self.concurrency),
+            'refund_rules': rules_engine.stats(),
+        }
+
+    @staticmethod
+    def _store_claims(records: list) -> None:
+        if not records:
+            return
+        try:
+            get_claim_store().bulk_upsert(records)
+        except Exception as e:
+            # Nothing past the last checkpoint is kept, so a resumed run processes these claims again
+            logging.error(f"Could not store {len(records)} batch claims: {e}")
+            raise
+
+    def _log_progress(self, total: int, started: float) -> None:
+        if self.progress_interval and total and total % self.progress_interval == 0:
+            elapsed = time.perf_counter() - started
+            logging.info(f"Processed {total} claims in {elapsed:.1f}s ({total / elapsed:.2f} claims/sec)")
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Process a file of refund claims in bulk")
+    parser.add_argument('input', help="JSONL, JSON or CSV file of claims")
+    parser.add_argument('-o', '--output', required=True, help="Output JSONL file for results")
+    parser.add_argument('-c', '--concurrency', type=int, default=Config.BATCH_CONCURRENCY,
+                        help="Number of claims processed in parallel")
+    parser.add_argument('--no-resume', action='store_true',
+                        help="Ignore any checkpoint and overwrite the output file")
+    parser.add_argument('--metrics-out', default=None,
+                        help="Write aggregate metrics to this file (.prom for Prometheus text, JSON otherwise)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    processor = BatchClaimProcessor(concurrency=args.concurrency)
+    summary = processor.run(args.input, args.output, resume=not args.no_resume)
+    if args.metrics_out:
+        metrics.dump(args.metrics_out)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
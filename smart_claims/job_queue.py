@@ -0,0 +1,404 @@
+import argparse
+import gc
+import logging
+import os
+import signal
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+from smart_claims.refund_flow import ClaimRefundFlow
+from smart_claims.utils.config import Config
+from smart_claims.utils.claim_store import get_claim_store, NullClaimStore, QUEUED_STATUSES
+from smart_claims.utils.data_models import RefundClaim
+from smart_claims.utils.model_registry import registry
+from smart_claims.utils.openai_client import openai_client
+
+# Fields set by processing, cleared before a queued claim is run through the flow
+DECISION_FIELDS = ('refund_amount', 'refund_status', 'refund_reason', 'refund_notes', 'fraud_flags', 'trace')
+
+# Sentiment backends whose loaded models forked workers can share; ONNX Runtime
+# sessions own thread pools that do not survive fork(), so each worker loads its own
+FORK_SAFE_SENTIMENT_BACKENDS = ('torch', 'int8')
+
+
+def _require_claim_store() -> None:
+    if isinstance(get_claim_store(), NullClaimStore):
+        raise RuntimeError("Queued claims need a claim store; set CLAIM_STORE_BACKEND to 'sqlite'")
+
+
+@contextmanager
+def lease_heartbeat(claim_id: str, interval: float = Config.JOB_LEASE_SECONDS / 3) -> Iterator[None]:
+    """
+    Renew the lease of a claim every `interval` seconds while the block runs, so a claim
+    that takes longer than JOB_LEASE_SECONDS is not handed to a second worker
+
+    :param claim_id: Leased claim
+    :param interval: Seconds between renewals, well within the lease
+    """
+    done = threading.Event()
+
+    def renew() -> None:
+        while not done.wait(interval):
+            try:
+                if not get_claim_store().renew_lease(claim_id):
+                    return
+            except Exception as e:
+                logging.error(f"Could not renew the lease of claim {claim_id}: {e}")
+
+    thread = threading.Thread(target=renew, name=f"lease-{claim_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
+
+
+def submit_claim(customer_claim: Dict[str, Any]) -> str:
+    """
+    Queue a claim for processing
+
+    The claim is stored as 'Pending' in the claim store, which is the queue every
+    worker (in this process or another) takes work from.
+
+    :param customer_claim: Claim fields as accepted by RefundClaim
+    :return: Claim id to poll for the result
+    """
+    _require_claim_store()
+    claim_object = RefundClaim(**customer_claim)
+    claim_object.claim_id = claim_object.claim_id or str(uuid.uuid4())
+    claim_object.refund_status = "Pending"
+    claim_object.refund_reason = "Queued for processing"
+    get_claim_store().save(claim_object)
+    for pool in list(ClaimWorkerPool.running):
+        pool.notify()
+    return claim_object.claim_id
+
+
+def amend_claim(claim_id: str, changes: Dict[str, Any]) -> str:
+    """
+    Queue a new version of a processed claim, e.g. with an edited review or another photo
+
+    The amended claim keeps its id, so processing reuses the stored output of every
+    stage whose inputs did not change and only re-runs the rest.
+
+    :param claim_id: Id of the claim to amend
+    :param changes: Claim fields to replace, e.g. product_review or the full list of product_images
+    :return: Claim id to poll for the result
+    """
+    _require_claim_store()
+    claim = get_claim_store().get(claim_id)
+    if claim is None:
+        raise KeyError(f"Unknown claim {claim_id}")
+    if claim['refund_status'] in QUEUED_STATUSES:
+        raise ValueError(f"Claim {claim_id} is still being processed")
+    amended = {key: value for key, value in claim.items() if key not in DECISION_FIELDS}
+    amended.update(changes)
+    amended['claim_id'] = claim_id
+    return submit_claim(amended)
+
+
+def claim_status(claim_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Current state of a submitted claim
+
+    :param claim_id: Id returned by `submit_claim`
+    :return: Dictionary with the status, whether processing is done and the claim, or None if unknown
+    """
+    claim = get_claim_store().get(claim_id)
+    if claim is None:
+        return None
+    return {
+        'claim_id': claim_id,
+        'status': claim['refund_status'],
+        'done': claim['refund_status'] not in QUEUED_STATUSES,
+        'claim': claim,
+    }
+
+
+class ClaimWorkerPool:
+    """
+    Background worker threads that lease pending claims from the claim store and run them
+    through ClaimRefundFlow.
+
+    Models are loaded once by `start()` and shared by every worker, so no request pays
+    the loading cost. Several pools (in the API process and in standalone worker
+    processes) can serve the same claim store; leases make sure each claim runs once.
+    """
+
+    running: "set[ClaimWorkerPool]" = set()
+
+    def __init__(self, workers: int = Config.JOB_WORKERS, poll_seconds: float = Config.JOB_POLL_SECONDS):
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self, warmup: bool = True) -> "ClaimWorkerPool":
+        _require_claim_store()
+        if warmup:
+            load_times = registry.warmup()
+            logging.info(f"Warmed models for {self.workers} workers: {load_times}")
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"claim-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        ClaimWorkerPool.running.add(self)
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Let the workers finish their current claim and exit
+        """
+        ClaimWorkerPool.running.discard(self)
+        self._stopping.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self) -> None:
+        """
+        Wake idle workers because a claim was just queued
+        """
+        self._wake.set()
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                leased = get_claim_store().lease_pending(limit=1)
+            except Exception as e:
+                logging.error(f"Could not lease claims: {e}")
+                leased = []
+            if not leased:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+                continue
+            self.process(leased[0])
+
+    @staticmethod
+    def process(claim: Dict[str, Any]) -> None:
+        """
+        Run one leased claim through the flow, which stores the decision
+        """
+        inputs = {key: value for key, value in claim.items() if key not in DECISION_FIELDS}
+        try:
+            with lease_heartbeat(claim['claim_id']):
+                result = ClaimRefundFlow().kickoff(inputs=inputs)
+            # A flow that did not reach the end stored nothing and would leave the claim "Processing"
+            if not isinstance(result, RefundClaim):
+                raise RuntimeError(f"Refund flow returned {type(result).__name__} instead of a claim")
+        except Exception as e:
+            logging.error(f"Claim {claim['claim_id']} failed: {e}")
+            claim_object = RefundClaim(**inputs)
+            ClaimRefundFlow._mark_failed(claim_object)
+            get_claim_store().save(claim_object)
+
+
+def process_memory(pid: int) -> Dict[str, float]:
+    """
+    Resident and proportional set size of a process in MB
+
+    PSS splits every shared page between the processes that map it, so the PSS of the
+    worker processes adds up to the memory they actually use.
+
+    :param pid: Process id
+    :return: Dictionary with 'rss_mb' and 'pss_mb', empty where /proc is not available
+    """
+    usage = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('Rss', 'Pss'):
+                    usage[f"{key.lower()}_mb"] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return usage
+
+
+class PreforkWorkerPool:
+    """
+    Worker processes forked from a parent that has already loaded the models.
+
+    The parent loads every model once and forks `processes` children, which share the
+    weights copy-on-write instead of loading a copy each. Every child pins torch to
+    `torch_threads` intra-op threads so the processes do not oversubscribe the cores,
+    takes its share of the OpenAI rate limits and runs a ClaimWorkerPool of `threads`
+    workers; the claim store's leases dispatch the claims between them. Children that
+    die are restarted.
+
+    Fork is only safe before CUDA is initialised, so GPU hosts should run one
+    ClaimWorkerPool process per GPU instead.
+    """
+
+    def __init__(
+            self,
+            processes: int = Config.JOB_PROCESSES,
+            threads: int = Config.JOB_WORKERS,
+            torch_threads: int = Config.JOB_TORCH_THREADS,
+            poll_seconds: float = Config.JOB_POLL_SECONDS,
+            preload: bool = True
+        ):
+        """
+        :param processes: Number of worker processes
+        :param threads: Worker threads in each process
+        :param torch_threads: torch intra-op threads per process, 0 divides the cores between the processes
+        :param poll_seconds: How often the parent checks on its children
+        :param preload: Load the models before forking; when False every child loads its own copy
+        """
+        self.processes = max(1, processes)
+        self.threads = max(1, threads)
+        self.torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // self.processes)
+        self.poll_seconds = poll_seconds
+        self.preload = preload
+        # Process id of each running child, by slot
+        self.children: Dict[int, int] = {}
+        self._stopping = threading.Event()
+
+    def _load_models(self) -> Dict[str, float]:
+        import torch
+
+        # Threads do not survive fork(), so the parent stays single-threaded
+        torch.set_num_threads(1)
+        names = registry.registered()
+        if Config.SENTIMENT_BACKEND not in FORK_SAFE_SENTIMENT_BACKENDS:
+            names = [name for name in names if not name.startswith('sentiment')]
+        load_times = registry.warmup(names)
+        if torch.cuda.is_initialized():
+            raise RuntimeError("Models were loaded on CUDA, which forked workers cannot use; run one "
+                               "`python -m smart_claims.job_queue` process per GPU instead")
+        return load_times
+
+    def start(self) -> "PreforkWorkerPool":
+        _require_claim_store()
+        if self.preload:
+            load_times = self._load_models()
+            logging.info(f"Loaded models for {self.processes} worker processes: {load_times}")
+        # Objects that exist now are never collected, so the collector does not touch
+        # (and copy) the pages they live on in every child
+        gc.collect()
+        gc.freeze()
+        for slot in range(self.processes):
+            self._spawn(slot)
+        return self
+
+    def _spawn(self, slot: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._run_child(slot)
+            except BaseException:
+                logging.exception(f"Worker process {slot} failed")
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        self.children[slot] = pid
+        logging.info(f"Started worker process {slot} (pid {pid})")
+
+    def _run_child(self, slot: int) -> None:
+        import torch
+
+        stopping = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: stopping.set())
+        torch.set_num_threads(self.torch_threads)
+        openai_client.share_rate_limits(1 / self.processes)
+        # Loads whatever could not be shared with the parent, the rest is already loaded
+        registry.warmup()
+        pool = ClaimWorkerPool(workers=self.threads, poll_seconds=Config.JOB_POLL_SECONDS).start(warmup=False)
+        while not stopping.wait(self.poll_seconds):
+            pass
+        pool.stop()
+
+    def _reap(self) -> List[int]:
+        """
+        Collect children that exited
+
+        :return: Slots of the children that exited
+        """
+        exited = []
+        for slot, pid in list(self.children.items()):
+            try:
+                finished, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                finished, status = pid, 0
+            if finished:
+                del self.children[slot]
+                exited.append(slot)
+                if not self._stopping.is_set():
+                    logging.warning(f"Worker process {slot} (pid {pid}) exited with code {os.waitstatus_to_exitcode(status)}")
+        return exited
+
+    def memory_usage(self) -> Dict[int, Dict[str, float]]:
+        """
+        Memory of the parent and of each worker process
+
+        :return: Mapping of process id to its 'rss_mb' and 'pss_mb'
+        """
+        return {pid: process_memory(pid) for pid in [os.getpid()] + list(self.children.values())}
+
+    def run(self) -> None:
+        """
+        Start the workers and restart any that die, until SIGTERM or SIGINT
+        """
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: self._stopping.set())
+        self.start()
+        while not self._stopping.wait(self.poll_seconds):
+            for slot in self._reap():
+                self._spawn(slot)
+        self.stop()
+
+    def stop(self, timeout: float = 60.0) -> None:
+        """
+        Let every worker process finish its current claims and exit, killing those that
+        take longer than `timeout`
+        """
+        self._stopping.set()
+        for pid in self.children.values():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + timeout
+        while self.children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in self.children.values():
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self.children = {}
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Run claim workers that process claims queued through the API")
+    parser.add_argument('-w', '--workers', type=int, default=max(1, Config.JOB_WORKERS),
+                        help="Number of worker threads (per process with --processes)")
+    parser.add_argument('-p', '--processes', type=int, default=Config.JOB_PROCESSES,
+                        help="Number of worker processes forked after loading the models, 0 for threads only")
+    parser.add_argument('--torch-threads', type=int, default=Config.JOB_TORCH_THREADS,
+                        help="torch intra-op threads per worker process, 0 divides the cores between them")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.processes > 0:
+        PreforkWorkerPool(processes=args.processes, threads=args.workers, torch_threads=args.torch_threads).run()
+        return
+    pool = ClaimWorkerPool(workers=args.workers).start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    main()
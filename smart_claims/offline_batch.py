@@ -0,0 +1,571 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+from openai.types import CompletionUsage
+from pydantic import BaseModel
+from smart_claims.batch_processing import load_claims
+from smart_claims.refund_flow import ClaimRefundFlow, TERMINAL_STATUSES
+from smart_claims.tools.sentiment_analysis import SentimentAnalysisTool
+from smart_claims.tools.image_analysis import ImageAnalysisTool
+from smart_claims.tools.reporting_tool import RefundEstimationTool
+from smart_claims.tools.refund_calculator import rules_engine
+from smart_claims.tools.fraud_screening import FraudScreeningTool
+from smart_claims.utils.config import Config
+from smart_claims.utils.openai_client import openai_client
+from smart_claims.utils.output_parsing import parse_output
+from smart_claims.utils.claim_store import get_claim_store
+from smart_claims.utils.instrumentation import ClaimTrace, metrics, record_usage, increment
+from smart_claims.utils.data_models import RefundClaim, SentimentAnalysisResponse, ImageAnalysisResponse, RefundEstimationResponse
+
+FINISHED_BATCH_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+# custom_id -> (response body, error message)
+BatchOutputs = Dict[str, Tuple[Optional[Dict[str, Any]], Optional[str]]]
+
+
+def _strict_schema(schema: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Adapt a pydantic JSON schema to structured outputs' strict mode: every object lists
+    all its properties as required, allows no others and no property has a default
+    """
+    schema = {key: value for key, value in schema.items() if key != 'default'}
+    for key in ('properties', '$defs'):
+        if key in schema:
+            schema[key] = {name: _strict_schema(subschema) for name, subschema in schema[key].items()}
+    for key in ('anyOf', 'allOf', 'prefixItems'):
+        if key in schema:
+            schema[key] = [_strict_schema(subschema) for subschema in schema[key]]
+    if isinstance(schema.get('items'), dict):
+        schema['items'] = _strict_schema(schema['items'])
+    if schema.get('type') == 'object':
+        schema['additionalProperties'] = False
+        schema['required'] = list(schema.get('properties', {}))
+    return schema
+
+
+def response_format(response_model: Type[BaseModel]) -> Dict[str, Any]:
+    """
+    Structured output response_format for a response model, as sent by client.beta.chat.completions.parse
+
+    :param response_model: Pydantic model the response must follow
+    :return: json_schema response_format of the model
+    """
+    return {
+        'type': 'json_schema',
+        'json_schema': {
+            'name': response_model.__name__,
+            'schema': _strict_schema(response_model.model_json_schema()),
+            'strict': True,
+        },
+    }
+
+
+class BatchEndpoint(ABC):
+    """
+    Minimal interface of the OpenAI Batch API used by the offline runner
+    """
+
+    @abstractmethod
+    def submit(self, requests_path: str) -> str:
+        """
+        Upload a request JSONL file and start a batch
+
+        :return: Batch id
+        """
+
+    @abstractmethod
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        """
+        :return: Dictionary with the batch status, output_file_id, error_file_id and request_counts
+        """
+
+    @abstractmethod
+    def download(self, file_id: str) -> Iterator[str]:
+        """
+        :return: Lines of a result file
+        """
+
+
+class OpenAIBatchEndpoint(BatchEndpoint):
+    """
+    The OpenAI Batch API: half the price of synchronous requests, results within the completion window
+    """
+
+    def __init__(self, completion_window: str = Config.OFFLINE_BATCH_COMPLETION_WINDOW):
+        self.completion_window = completion_window
+
+    def submit(self, requests_path: str) -> str:
+        with open(requests_path, 'rb') as requests_file:
+            input_file = openai_client.client.files.create(file=requests_file, purpose='batch')
+        batch = openai_client.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window=self.completion_window,
+            metadata={'source': 'smart_claims.offline_batch', 'requests_file': os.path.basename(requests_path)}
+        )
+        return batch.id
+
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        batch = openai_client.client.batches.retrieve(batch_id)
+        return {
+            'id': batch.id,
+            'status': batch.status,
+            'output_file_id': batch.output_file_id,
+            'error_file_id': batch.error_file_id,
+            'request_counts': batch.request_counts.model_dump() if batch.request_counts else None,
+        }
+
+    def download(self, file_id: str) -> Iterator[str]:
+        yield from openai_client.client.files.content(file_id).text.splitlines()
+
+
+def _send_chat_request(body: Dict[str, Any]) -> Dict[str, Any]:
+    return openai_client.client.chat.completions.create(**body).model_dump()
+
+
+class LocalBatchEndpoint(BatchEndpoint):
+    """
+    File-based stand-in for the Batch API.
+
+    Batches live in `directory` as <batch_id>.input.jsonl, <batch_id>.json (status),
+    <batch_id>.output.jsonl and <batch_id>.errors.jsonl, in the same formats as the
+    real API. A batch is executed the first time it is polled, by passing each request
+    body to `responder` (by default a synchronous chat completion, which can itself be
+    pointed at the local stub server through OPENAI_BASE_URL).
+    """
+
+    def __init__(self, directory: str, responder: Callable[[Dict[str, Any]], Dict[str, Any]] = _send_chat_request):
+        self.directory = directory
+        self.responder = responder
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _save(self, batch: Dict[str, Any]) -> None:
+        with open(self._path(f"{batch['id']}.json"), 'w') as batch_file:
+            json.dump(batch, batch_file)
+
+    def submit(self, requests_path: str) -> str:
+        batch_id = f"local_batch_{uuid.uuid4().hex}"
+        shutil.copyfile(requests_path, self._path(f"{batch_id}.input.jsonl"))
+        self._save({'id': batch_id, 'status': 'in_progress', 'output_file_id': None, 'error_file_id': None, 'request_counts': None})
+        return batch_id
+
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        with open(self._path(f"{batch_id}.json")) as batch_file:
+            batch = json.load(batch_file)
+        if batch['status'] == 'in_progress':
+            batch = self._execute(batch)
+        return batch
+
+    def _execute(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        batch_id = batch['id']
+        completed = failed = 0
+        with open(self._path(f"{batch_id}.input.jsonl")) as input_file, \
+                open(self._path(f"{batch_id}.output.jsonl"), 'w') as output_file, \
+                open(self._path(f"{batch_id}.errors.jsonl"), 'w') as error_file:
+            for line in input_file:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                record = {'id': f"batch_req_{uuid.uuid4().hex}", 'custom_id': request['custom_id']}
+                try:
+                    body = self.responder(request['body'])
+                    record.update(response={'status_code': 200, 'request_id': record['id'], 'body': body}, error=None)
+                    output_file.write(json.dumps(record) + '\n')
+                    completed += 1
+                except Exception as e:
+                    record.update(response=None, error={'code': type(e).__name__, 'message': str(e)})
+                    error_file.write(json.dumps(record) + '\n')
+                    failed += 1
+
+        batch.update(
+            status='completed',
+            output_file_id=f"{batch_id}.output.jsonl",
+            error_file_id=f"{batch_id}.errors.jsonl",
+            request_counts={'total': completed + failed, 'completed': completed, 'failed': failed}
+        )
+        self._save(batch)
+        return batch
+
+    def download(self, file_id: str) -> Iterator[str]:
+        with open(self._path(file_id)) as result_file:
+            for line in result_file:
+                yield line.rstrip('\n')
+
+
+class OfflineBatchRunner:
+    """
+    Processes a backlog of claims through the Batch API instead of synchronous requests.
+
+    The flow is the same as ClaimRefundFlow, run stage by stage over the whole backlog:
+    dates and images are validated, duplicates are screened out, reviews are scored by the local sentiment model in
+    batches, the vision requests of every claim are written to Batch API JSONL files and
+    submitted, and once their results land the refund estimation requests (for claims the
+    rules engine could not decide) are submitted as a second batch. The results are then
+    joined back into RefundClaim objects and written to the claim store.
+
+    Submitted batch ids are recorded in a manifest in `work_dir`, so re-running the same
+    command after an interruption polls the existing batches instead of paying for new ones.
+    """
+
+    def __init__(
+            self,
+            endpoint: Optional[BatchEndpoint] = None,
+            work_dir: str = Config.OFFLINE_BATCH_DIR,
+            poll_seconds: float = Config.OFFLINE_BATCH_POLL_SECONDS
+        ):
+        self.endpoint = endpoint or OpenAIBatchEndpoint()
+        self.work_dir = work_dir
+        self.poll_seconds = poll_seconds
+        self.image_tool = ImageAnalysisTool()
+        self.refund_tool = RefundEstimationTool()
+        # Raw output of each stage per claim index, stored with the claims
+        self.stage_outputs: Dict[int, Dict[str, Any]] = defaultdict(dict)
+        os.makedirs(work_dir, exist_ok=True)
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.work_dir, 'manifest.json')
+
+    @staticmethod
+    def _fingerprint(input_path: str) -> str:
+        stat = os.stat(input_path)
+        return hashlib.sha256(f"{os.path.abspath(input_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+
+    def _load_manifest(self, input_path: str) -> Dict[str, Any]:
+        fingerprint = self._fingerprint(input_path)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('input') == fingerprint:
+                return manifest
+        return {'input': fingerprint, 'stages': {}}
+
+    def _save_manifest(self, manifest: Dict[str, Any]) -> None:
+        with open(self.manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+    @staticmethod
+    def batch_request(custom_id: str, model: str, messages: List[Dict[str, Any]], response_model: Type[BaseModel],
+                      max_tokens: int) -> Dict[str, Any]:
+        """
+        Build one line of a Batch API input file with a structured output schema
+        """
+        return {
+            'custom_id': custom_id,
+            'method': 'POST',
+            'url': '/v1/chat/completions',
+            'body': {
+                'model': model,
+                'messages': messages,
+                'max_tokens': max_tokens,
+                'temperature': 0,
+                'response_format': response_format(response_model),
+            },
+        }
+
+    def write_request_files(self, stage_name: str, requests: Iterable[Dict[str, Any]]) -> List[str]:
+        """
+        Stream requests into JSONL files that respect the Batch API request and size limits
+
+        :param stage_name: Name of the stage, used in the file names
+        :param requests: Batch API request lines
+        :return: Paths of the written files
+        """
+        paths = []
+        requests_file = None
+        count = size = 0
+        try:
+            for request in requests:
+                line = (json.dumps(request) + '\n').encode('utf-8')
+                if requests_file is None or count >= Config.OFFLINE_BATCH_MAX_REQUESTS \
+                        or size + len(line) > Config.OFFLINE_BATCH_MAX_FILE_BYTES:
+                    if requests_file is not None:
+                        requests_file.close()
+                    paths.append(os.path.join(self.work_dir, f"{stage_name}.{len(paths):04d}.jsonl"))
+                    requests_file = open(paths[-1], 'wb')
+                    count = size = 0
+                requests_file.write(line)
+                count += 1
+                size += len(line)
+        finally:
+            if requests_file is not None:
+                requests_file.close()
+        return paths
+
+    def run_stage(self, stage_name: str, requests: Iterable[Dict[str, Any]], manifest: Dict[str, Any]) -> BatchOutputs:
+        """
+        Submit the requests of one stage (or reuse batches recorded in the manifest) and wait for the results
+
+        :return: Mapping of custom_id to (response body, error)
+        """
+        batch_ids = manifest['stages'].get(stage_name)
+        if batch_ids is None:
+            paths = self.write_request_files(stage_name, requests)
+            batch_ids = [self.endpoint.submit(path) for path in paths]
+            manifest['stages'][stage_name] = batch_ids
+            self._save_manifest(manifest)
+            logging.info(f"Submitted {len(batch_ids)} {stage_name} batch(es): {batch_ids}")
+
+        outputs: BatchOutputs = {}
+        for batch_id in batch_ids:
+            outputs.update(self._collect(self._wait(batch_id)))
+        return outputs
+
+    def _wait(self, batch_id: str) -> Dict[str, Any]:
+        while True:
+            batch = self.endpoint.retrieve(batch_id)
+            if batch['status'] in FINISHED_BATCH_STATUSES:
+                if batch['status'] != 'completed':
+                    logging.error(f"Batch {batch_id} finished with status {batch['status']}")
+                return batch
+            logging.info(f"Batch {batch_id} is {batch['status']} {batch.get('request_counts') or ''}")
+            time.sleep(self.poll_seconds)
+
+    def _collect(self, batch: Dict[str, Any]) -> BatchOutputs:
+        outputs: BatchOutputs = {}
+        # Expired and cancelled batches may still have partial output
+        for file_id in (batch.get('output_file_id'), batch.get('error_file_id')):
+            if not file_id:
+                continue
+            for line in self.endpoint.download(file_id):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get('response') or {}
+                if record.get('error') is None and response.get('status_code') == 200:
+                    outputs[record['custom_id']] = (response['body'], None)
+                else:
+                    error = record.get('error') or (response.get('body') or {}).get('error') or 'request failed'
+                    outputs[record['custom_id']] = (None, json.dumps(error) if not isinstance(error, str) else error)
+        return outputs
+
+    @staticmethod
+    def _parse_output(output: Optional[Tuple], stage_name: str, model: str, response_model):
+        """
+        Parse a Batch API response body into the structured output model
+
+        :return: Parsed response model
+        """
+        if output is None:
+            raise RuntimeError("Request missing from the batch output")
+        body, error = output
+        if error is not None:
+            raise RuntimeError(error)
+        record_usage(stage_name, model, CompletionUsage.model_validate(body['usage']) if body.get('usage') else None)
+        message = body['choices'][0]['message']
+        if message.get('refusal'):
+            raise RuntimeError(message['refusal'])
+        # Repaired locally if needed; a Batch API request is not retried on its own
+        return parse_output(response_model, message['content'] or '', stage_name)
+
+    def _prepare_claims(self, input_path: str) -> List[RefundClaim]:
+        claims = []
+        for customer_claim in load_claims(input_path):
+            claim_object = RefundClaim(**customer_claim)
+            claim_object.claim_id = claim_object.claim_id or str(uuid.uuid4())
+            rejection = ClaimRefundFlow._validate_dates(claim_object) or ClaimRefundFlow._validate_images(claim_object)
+            if rejection is not None:
+                claim_object.refund_amount = 0.0
+                claim_object.refund_status, claim_object.refund_reason = rejection
+            claims.append(claim_object)
+        return claims
+
+    def _screen(self, claims: List[RefundClaim], traces: List[ClaimTrace]) -> None:
+        screening_tool = FraudScreeningTool()
+        for index, claim_object in enumerate(claims):
+            if claim_object.refund_status in TERMINAL_STATUSES:
+                continue
+            with traces[index].activate():
+                screening = screening_tool.screen(claim_object)
+            self.stage_outputs[index]['fraud_screening'] = screening
+            if screening['flags']:
+                claim_object.fraud_flags = screening['flags']
+                claim_object.refund_amount = 0.0
+                claim_object.refund_status = "Flagged for Review"
+                claim_object.refund_reason = screening['reason']
+
+    def _analyse_sentiment(self, claims: List[RefundClaim], traces: List[ClaimTrace], active: List[int]) -> Dict[int, SentimentAnalysisResponse]:
+        sentiment_tool = SentimentAnalysisTool()
+        sentiments = {}
+        for offset in range(0, len(active), Config.SENTIMENT_MAX_BATCH_SIZE):
+            chunk = active[offset:offset + Config.SENTIMENT_MAX_BATCH_SIZE]
+            results = sentiment_tool.analyze_batch([claims[index].product_review for index in chunk])
+            for index, result in zip(chunk, results):
+                self.stage_outputs[index]['sentiment_analysis'] = result
+                if result['error'] is None:
+                    sentiments[index] = SentimentAnalysisResponse(**result)
+                else:
+                    traces[index].add_error('sentiment_analysis', result['error'])
+        return sentiments
+
+    def _analyse_images(self, claims: List[RefundClaim], traces: List[ClaimTrace], active: List[int], manifest: Dict[str, Any]) -> Dict[int, ImageAnalysisResponse]:
+        product_infos = {
+            index: {'product_name': claims[index].product_name, 'product_description': claims[index].product_description}
+            for index in active
+        }
+        if Config.IMAGE_ANALYSIS_MODEL not in ['gpt-4o-mini', 'gpt-4o']:
+            # The local vision model has no Batch API, it already batches generate() calls
+            results = dict(zip(active, self.image_tool.analyze_images_batch(
+                [(claims[index].product_images, product_infos[index]) for index in active]
+            )))
+        else:
+            keys = {index: self.image_tool._cache_key(claims[index].product_images, product_infos[index]) for index in active}
+            results = {index: self.image_tool._cached(keys[index], claims[index].product_images) for index in active}
+            results = {index: result for index, result in results.items() if result is not None}
+            missing = [index for index in active if index not in results]
+
+            def requests() -> Iterator[Dict[str, Any]]:
+                # Messages carry the encoded images, so they are built one at a time while writing
+                for index in missing:
+                    with traces[index].activate():
+                        messages = self.image_tool.build_openai_messages(claims[index].product_images, product_infos[index])
+                    yield self.batch_request(f"image-{index}", Config.IMAGE_ANALYSIS_MODEL, messages, ImageAnalysisResponse,
+                                             Config.IMAGE_ANALYSIS_MAX_COMPLETION_TOKENS)
+
+            outputs = self.run_stage('image_analysis', requests(), manifest) if missing else {}
+            for index in missing:
+                with traces[index].activate():
+                    try:
+                        image_analysis = self._parse_output(outputs.get(f"image-{index}"), 'image_analysis',
+                                                            Config.IMAGE_ANALYSIS_MODEL, ImageAnalysisResponse)
+                        results[index] = self.image_tool._store(
+                            keys[index], self.image_tool.parse_analysis(image_analysis, claims[index].product_images)
+                        )
+                    except Exception as e:
+                        results[index] = self.image_tool._error_response(claims[index].product_images, e)
+
+        images = {}
+        for index, result in results.items():
+            self.stage_outputs[index]['image_analysis'] = result
+            if result['error'] is None:
+                images[index] = ImageAnalysisResponse(**result)
+            elif not any(error['stage'] == 'image_analysis' for error in traces[index].errors):
+                traces[index].add_error('image_analysis', result['error'])
+        return images
+
+    def _estimate_refunds(self, claims: List[RefundClaim], traces: List[ClaimTrace], active: List[int],
+                          sentiments: Dict[int, SentimentAnalysisResponse], images: Dict[int, ImageAnalysisResponse],
+                          manifest: Dict[str, Any]) -> Dict[int, Dict[str, Any]]:
+        reports = {}
+        escalated = []
+        for index in active:
+            if Config.REFUND_RULES_ENABLED:
+                with traces[index].activate():
+                    decision = rules_engine.evaluate(sentiments[index], images[index], claims[index])
+                    if decision is not None:
+                        increment('refund_rules_short_circuited')
+                        reports[index] = decision
+                        continue
+            escalated.append(index)
+
+        def requests() -> Iterator[Dict[str, Any]]:
+            for index in escalated:
+                # Prompt sizes are recorded on the claim's trace
+                with traces[index].activate():
+                    messages = self.refund_tool.build_messages(sentiments[index], images[index], claims[index])
+                yield self.batch_request(f"refund-{index}", Config.REFUND_ESTIMATION_MODEL, messages,
+                                         RefundEstimationResponse, Config.REFUND_MAX_COMPLETION_TOKENS)
+
+        outputs = self.run_stage('refund_estimation', requests(), manifest) if escalated else {}
+        for index in escalated:
+            with traces[index].activate():
+                try:
+                    estimation = self._parse_output(outputs.get(f"refund-{index}"), 'refund_estimation',
+                                                    Config.REFUND_ESTIMATION_MODEL, RefundEstimationResponse)
+                    reports[index] = self.refund_tool.parse_estimation(estimation)
+                except Exception as e:
+                    reports[index] = self.refund_tool.error_response(e)
+        return reports
+
+    def run(self, input_path: str, output_path: str) -> Dict[str, Any]:
+        """
+        Process every claim in the input file through the Batch API
+
+        :param input_path: Path to a JSONL, JSON or CSV file of claims
+        :param output_path: Path to the output JSONL file
+        :return: Summary of the run
+        """
+        started = time.perf_counter()
+        manifest = self._load_manifest(input_path)
+        claims = self._prepare_claims(input_path)
+        traces = [ClaimTrace(claim_object.claim_id) for claim_object in claims]
+        if Config.FRAUD_SCREENING_ENABLED:
+            self._screen(claims, traces)
+        active = [index for index, claim_object in enumerate(claims) if claim_object.refund_status not in TERMINAL_STATUSES]
+        terminal = len(claims) - len(active)
+
+        sentiments = self._analyse_sentiment(claims, traces, active)
+        images = self._analyse_images(claims, traces, active, manifest)
+
+        failed = [index for index in active if index not in sentiments or index not in images]
+        for index in failed:
+            ClaimRefundFlow._mark_failed(claims[index])
+        active = [index for index in active if index in sentiments and index in images]
+
+        reports = self._estimate_refunds(claims, traces, active, sentiments, images, manifest)
+        for index, report in reports.items():
+            self.stage_outputs[index]['refund_estimation'] = report
+            claim_object = claims[index]
+            if report['error'] is None:
+                claim_object.refund_amount = report['refund_amount']
+                claim_object.refund_status = report['refund_status']
+                claim_object.refund_reason = report['refund_reason']
+                claim_object.refund_notes = report['refund_notes']
+            else:
+                ClaimRefundFlow._mark_failed(claim_object)
+                failed.append(index)
+
+        with open(output_path, 'w') as output_file:
+            for index, claim_object in enumerate(claims):
+                claim_object.trace = traces[index].to_dict()
+                errors = claim_object.trace['errors']
+                output_file.write(json.dumps({
+                    'batch_index': index,
+                    'claim': claim_object.model_dump(),
+                    'error': errors[-1]['error'] if errors else None,
+                }, default=str) + '\n')
+
+        get_claim_store().bulk_upsert((claims[index], self.stage_outputs.get(index)) for index in range(len(claims)))
+
+        elapsed = time.perf_counter() - started
+        return {
+            'claims': len(claims),
+            'failed': len(failed),
+            'decided_before_models': terminal,
+            'batches': manifest['stages'],
+            'wall_seconds': elapsed,
+            'tokens': metrics.to_json()['tokens'],
+            'refund_rules': rules_engine.stats(),
+        }
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Process a backlog of refund claims through the OpenAI Batch API")
+    parser.add_argument('input', help="JSONL, JSON or CSV file of claims")
+    parser.add_argument('-o', '--output', required=True, help="Output JSONL file for results")
+    parser.add_argument('--work-dir', default=Config.OFFLINE_BATCH_DIR,
+                        help="Directory for request files and the batch manifest")
+    parser.add_argument('--poll-seconds', type=float, default=Config.OFFLINE_BATCH_POLL_SECONDS)
+    parser.add_argument('--local', action='store_true',
+                        help="Use the file-based local batch endpoint instead of the Batch API")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    endpoint = LocalBatchEndpoint(os.path.join(args.work_dir, 'local_endpoint')) if args.local else OpenAIBatchEndpoint()
+    runner = OfflineBatchRunner(endpoint, work_dir=args.work_dir, poll_seconds=args.poll_seconds)
+    print(json.dumps(runner.run(args.input, args.output), indent=2))
+
+
+if __name__ == "__main__":
+    main()
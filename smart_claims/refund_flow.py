@@ -1,71 +1,380 @@
+import asyncio
+import logging
 import openai
 import uuid
+from typing import Any, Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 from crewai.flow.flow import Flow, listen, start
 from smart_claims.tools.sentiment_analysis import SentimentAnalysisTool
 from smart_claims.tools.image_analysis import ImageAnalysisTool
-from smart_claims.tools.reporting_tool import RefundEstimationTool
+from smart_claims.tools.reporting_tool import RefundEstimationTool, defects_described, speculative_image_analysis
+from smart_claims.tools.refund_calculator import rules_engine
+from smart_claims.tools.fraud_screening import FraudScreeningTool
 from smart_claims.utils.config import Config
+from smart_claims.utils.image_processing import validate_image_files
+from smart_claims.utils.cache import make_cache_key
+from smart_claims.utils.claim_store import get_claim_store, claim_fingerprint
+from smart_claims.utils.instrumentation import ClaimTrace, stage, increment
 from smart_claims.utils.data_models import RefundClaim, SentimentAnalysisResponse, ImageAnalysisResponse, RefundEstimationResponse
 
 
 # Configure OpenAI
 openai.api_key = Config.OPENAI_API_KEY
 
+# Claims in one of these states skip every remaining model call
+TERMINAL_STATUSES = {"Rejected", "Invalid", "Not Successfully Processed", "Flagged for Review"}
+
 class ClaimRefundFlow(Flow):
+    """
+    Claim refund flow
+
+    Use kickoff() from synchronous code and `await kickoff_async()` from an
+    async web server; both run the sentiment and image analyses concurrently.
+    """
+
+    def __init__(self, *args, persist: bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Per-claim record of stage wall time, token usage, bytes uploaded, cache hits and errors
+        self.trace = ClaimTrace()
+        # Raw output of each stage, stored with the claim when `persist` is set
+        self.stage_outputs: Dict[str, Any] = {}
+        self.persist = persist
+        self.reused_decision = False
+        # Refund estimate started before the image analysis finished and kept afterwards
+        self.speculative_refund: Dict[str, Any] | None = None
+        # Stage outputs stored for an earlier version of an amended claim
+        self.previous_outputs: Dict[str, Any] = {}
+        # Parsed analyses handed from analyse_sentiment_and_images to generate_claim_report,
+        # as each listener receives only the claim returned by the step before it
+        self.sentiment_response: SentimentAnalysisResponse | None = None
+        self.image_response: ImageAnalysisResponse | None = None
+
+    @property
+    def stage_timings(self) -> Dict[str, float]:
+        return dict(self.trace.stages)
+
+    def _finish(self, claim_object: RefundClaim) -> RefundClaim:
+        claim_object.trace = self.trace.to_dict()
+        if self.persist:
+            try:
+                get_claim_store().save(claim_object, self.stage_outputs)
+            except Exception as e:
+                logging.error(f"Could not store claim {claim_object.claim_id}: {e}")
+        return claim_object
+
+    def _is_decided(self, claim_object: RefundClaim) -> bool:
+        return self.reused_decision or claim_object.refund_status in TERMINAL_STATUSES
+
+    def _reuse_decision(self, claim_object: RefundClaim) -> None:
+        """
+        Take the decision of an identical claim that was already processed
+        """
+        stored = get_claim_store().find_decided(claim_fingerprint(claim_object))
+        if stored is None:
+            return
+        claim_object.refund_amount = stored['refund_amount']
+        claim_object.refund_status = stored['refund_status']
+        claim_object.refund_reason = stored['refund_reason']
+        claim_object.refund_notes = stored['refund_notes']
+        self.stage_outputs = get_claim_store().stage_outputs(stored['claim_id'])
+        self.reused_decision = True
+
+    @staticmethod
+    def _stage_fingerprints(claim_object: RefundClaim) -> Dict[str, Any]:
+        """
+        Fingerprint the inputs of the model stages
+
+        Stored with the stage outputs, so when the claim is amended only the stages
+        whose inputs changed run again. Images are fingerprinted one by one, so an added
+        photo is analysed on its own.
+        """
+        return {
+            'sentiment_analysis': SentimentAnalysisTool._cache_key(claim_object.product_review),
+            'image_analysis': {
+                'context': make_cache_key('image_analysis', [
+                    Config.IMAGE_ANALYSIS_MODEL,
+                    Config.PROMPT_VERSION,
+                    claim_object.product_name,
+                    claim_object.product_description,
+                ]),
+                'images': [make_cache_key('image', files=[image_path]) for image_path in claim_object.product_images],
+            },
+        }
 
-    @start
-    def initialize_claim_refund_flow(self, customer_claim: dict) -> RefundClaim:
+    def _load_previous_outputs(self, claim_object: RefundClaim) -> None:
         """
-        Initialize the claim refund flow
+        Take the stage outputs of an earlier version of this claim, if it was stored
         """
-        claim_object = RefundClaim(**customer_claim)
-        claim_object.claim_id = str(uuid.uuid4())
+        try:
+            self.stage_outputs['fingerprints'] = self._stage_fingerprints(claim_object)
+            previous = get_claim_store().stage_outputs(claim_object.claim_id)
+        except Exception as e:
+            logging.error(f"Could not load earlier stage outputs of claim {claim_object.claim_id}: {e}")
+            return
+        if previous.get('fingerprints'):
+            self.previous_outputs = previous
+            increment('claim_amended')
+
+    def _reusable_output(self, stage_name: str) -> Optional[Dict[str, Any]]:
+        """
+        Earlier output of a stage whose inputs have not changed since
+        """
+        previous = self.previous_outputs.get(stage_name)
+        if previous is None or previous.get('error') is not None:
+            return None
+        if self.previous_outputs['fingerprints'].get(stage_name) != self.stage_outputs['fingerprints'][stage_name]:
+            return None
+        increment(f"{stage_name}_reused")
+        return previous
+
+    def _added_images(self, claim_object: RefundClaim) -> Optional[List[str]]:
+        """
+        Images added since the earlier version of the claim was analysed
+
+        :return: Paths of the added images, None if the earlier analysis cannot be reused
+            (no analysis, another product description or model, or a photo was removed)
+        """
+        previous = self.previous_outputs.get('image_analysis')
+        before = self.previous_outputs.get('fingerprints', {}).get('image_analysis')
+        now = self.stage_outputs['fingerprints']['image_analysis']
+        if not previous or previous.get('error') is not None or not before or before['context'] != now['context']:
+            return None
+        if not set(before['images']) <= set(now['images']):
+            return None
+        analysed = set(before['images'])
+        return [path for path, fingerprint in zip(claim_object.product_images, now['images']) if fingerprint not in analysed]
+
+    async def _analyse_images(self, image_tool: ImageAnalysisTool, claim_object: RefundClaim, product_info: Dict[str, str]) -> Dict[str, Any]:
+        """
+        Analyse the claim's images, or for an amended claim only the images it did not have before
+        """
+        added = self._added_images(claim_object) if self.previous_outputs else None
+        if added is None:
+            return await image_tool.analyze_images_async(claim_object.product_images, product_info)
+        
+        previous = self.previous_outputs['image_analysis']
+        increment('image_analysis_images_reused', len(claim_object.product_images) - len(added))
+        if not added:
+            increment('image_analysis_reused')
+            return dict(previous, image_path=claim_object.product_images)
+        image_results = await image_tool.analyze_images_async(added, product_info)
+        if image_results['error'] is not None:
+            return image_results
+        return image_tool.merge_analyses(previous, image_results, claim_object.product_images)
+
+    @staticmethod
+    def _mark_failed(claim_object: RefundClaim) -> None:
+        claim_object.refund_amount = 0.0
+        claim_object.refund_status = "Not Successfully Processed"
+        claim_object.refund_reason = "Error processing refund request. Please try again later."
+
+    async def _resolve_speculation(
+            self,
+            speculation: asyncio.Future,
+            assumed: ImageAnalysisResponse,
+            sentiment_response: SentimentAnalysisResponse,
+            image_response: ImageAnalysisResponse,
+            claim_object: RefundClaim
+        ) -> Dict[str, Any] | None:
+        """
+        Keep a speculative refund estimate if the image analysis agrees with its assumption
+
+        The estimate was made assuming the defects described in the review, so it is
+        cancelled when the images show a defect the review does not describe (or none),
+        when the actual defect score is further than REFUND_SPECULATION_MAX_DEFECT_DIFF
+        from the assumed one, or when the rules engine decides the claim from the actual
+        analysis.
+
+        :return: The refund estimate, None if the claim must be estimated again
+        """
+        difference = abs(image_response.defect_score - assumed.defect_score)
+        defects_match = defects_described(image_response.detected_defects, claim_object.product_review)
+        accepted = defects_match and difference <= Config.REFUND_SPECULATION_MAX_DEFECT_DIFF and not (
+            Config.REFUND_RULES_ENABLED and rules_engine.decides(sentiment_response, image_response, claim_object)
+        )
+        refund_response = None
+        if not accepted:
+            speculation.cancel()
+        else:
+            refund_response = await speculation
+            # A failed speculative request is retried by the regular estimate
+            accepted = refund_response['error'] is None
+        
+        increment('refund_speculation_accepted' if accepted else 'refund_speculation_rejected')
+        self.stage_outputs['refund_speculation'] = {
+            'assumed_defect_score': assumed.defect_score,
+            'actual_defect_score': image_response.defect_score,
+            'defects_described': defects_match,
+            'accepted': accepted,
+        }
+        return refund_response if accepted else None
+
+    @staticmethod
+    def _validate_dates(claim_object: RefundClaim) -> Tuple[str, str] | None:
+        """
+        Check the claim dates and the 90 day warranty window
+
+        :return: Tuple of (refund status, refund reason) if the claim must stop here
+        """
+        try:
+            claim_date = datetime.strptime(claim_object.claim_date, "%Y-%m-%d")
+            order_date = datetime.strptime(claim_object.order_date, "%Y-%m-%d")
+        except ValueError:
+            return "Invalid", "Order and claim dates must use the YYYY-MM-DD format."
+        
+        if claim_date < order_date:
+            return "Invalid", "Claim date is before the order date."
         
         # Check if claim date is less than 90 days from order date
         # If not, reject the claim
-        claim_date = datetime.strptime(claim_object.claim_date, "%Y-%m-%d")
-        order_date = datetime.strptime(claim_object.order_date, "%Y-%m-%d")
         if claim_date > order_date + timedelta(days=90):
-            claim_object.refund_amount = 0.0
-            claim_object.refund_status = "Rejected"
-            claim_object.refund_reason = "Claim submitted after 90 days. The prduct is no longer in warranty."
+            return "Rejected", "Claim submitted after 90 days. The prduct is no longer in warranty."
+        return None
+
+    @staticmethod
+    def _validate_images(claim_object: RefundClaim) -> Tuple[str, str] | None:
+        """
+        Check that the claim has readable product images of an acceptable size
+
+        :return: Tuple of (refund status, refund reason) if the claim must stop here
+        """
+        if not claim_object.product_images:
+            return "Invalid", "At least one product image is required."
+        
+        problems = validate_image_files(claim_object.product_images)
+        if problems:
+            return "Invalid", "Product images could not be processed: " + "; ".join(problems)
+        return None
+
+    @start()
+    def initialize_claim_refund_flow(self) -> RefundClaim:
+        """
+        Initialize the claim refund flow from the claim passed as kickoff(inputs=...)
+        """
+        with self.trace.activate(), stage('initialize_claim_refund_flow'):
+            # The flow state holds the kickoff inputs plus the flow's own 'id', which RefundClaim ignores
+            claim_object = RefundClaim(**self.state)
+            # Claims queued through the API already carry the id returned to the client
+            claim_object.claim_id = claim_object.claim_id or str(uuid.uuid4())
+            
+            # Cheap checks first: dates, then image files, so invalid claims never reach a model
+            rejection = self._validate_dates(claim_object) or self._validate_images(claim_object)
+            if rejection is not None:
+                claim_object.refund_amount = 0.0
+                claim_object.refund_status, claim_object.refund_reason = rejection
+            else:
+                if Config.CLAIM_STORE_REUSE_DECISIONS:
+                    self._reuse_decision(claim_object)
+                # A claim resubmitted under its id is an amendment of the stored claim
+                if not self.reused_decision and self.persist and Config.CLAIM_INCREMENTAL_REEVALUATION:
+                    self._load_previous_outputs(claim_object)
+            self.trace.claim_id = claim_object.claim_id
         
         return claim_object
     
     @listen('initialize_claim_refund_flow')
-    def analyse_sentiment_and_images(self, claim_object: RefundClaim) -> RefundClaim:
+    def screen_for_fraud(self, claim_object: RefundClaim) -> RefundClaim:
+        """
+        Flag claims whose images or review duplicate earlier claims before any model call
+        """
+        if self._is_decided(claim_object) or not Config.FRAUD_SCREENING_ENABLED:
+            return claim_object
+        
+        with self.trace.activate():
+            screening = FraudScreeningTool().screen(claim_object)
+        self.stage_outputs['fraud_screening'] = screening
+        
+        if screening['flags']:
+            claim_object.fraud_flags = screening['flags']
+            claim_object.refund_amount = 0.0
+            claim_object.refund_status = "Flagged for Review"
+            claim_object.refund_reason = screening['reason']
+        return claim_object
+    
+    @listen('screen_for_fraud')
+    async def analyse_sentiment_and_images(self, claim_object: RefundClaim) -> RefundClaim:
         """
         Analyze sentiment of product review and detect defects in product images
+        
+        Both analyses are independent, so the local sentiment model runs in a worker
+        thread while the vision request is awaited, and the step takes roughly as long
+        as the slower of the two.
+        
+        For an amended claim, the earlier sentiment is kept when the review did not
+        change, and only images that were added are sent to the vision model.
+        
+        With REFUND_SPECULATION_ENABLED, the refund estimate is started as soon as the
+        review is scored, assuming the defects the review describes and a defect score
+        for its sentiment, so it overlaps the vision request. It is kept only if the
+        image analysis agrees on both.
         """
-        if claim_object.refund_status == "Rejected":
-            return claim_object, None, None
+        if self._is_decided(claim_object):
+            return claim_object
         
-        # Analyze sentiment of product review
         sentiment_tool = SentimentAnalysisTool()
-        sentiment_results = sentiment_tool.run(claim_object.product_review)
+        image_tool = ImageAnalysisTool()
+        product_info = {
+            'product_name': claim_object.product_name,
+            'product_description': claim_object.product_description,
+        }
         
-        sentiment_analysis_response = SentimentAnalysisResponse(**sentiment_results)
+        # Analyze sentiment of product review and detect defects in product images concurrently
+        with self.trace.activate(), stage('analyse_sentiment_and_images'):
+            # An amended claim keeps the sentiment of an unchanged review
+            reused_sentiment = self._reusable_output('sentiment_analysis') if self.previous_outputs else None
+            sentiment_task = asyncio.ensure_future(
+                asyncio.to_thread(sentiment_tool.analyze_sentiment, claim_object.product_review)
+                if reused_sentiment is None else asyncio.sleep(0, reused_sentiment)
+            )
+            image_task = asyncio.ensure_future(self._analyse_images(image_tool, claim_object, product_info))
+            
+            speculation, assumed = None, None
+            if Config.REFUND_SPECULATION_ENABLED:
+                sentiment_results = await sentiment_task
+                if sentiment_results['error'] is None and not image_task.done():
+                    assumed = speculative_image_analysis(SentimentAnalysisResponse(**sentiment_results))
+                    speculation = asyncio.ensure_future(RefundEstimationTool().estimate_refund_async(
+                        SentimentAnalysisResponse(**sentiment_results), assumed, claim_object, 'refund_speculation'
+                    ))
+                    increment('refund_speculation_started')
+            
+            sentiment_results, image_results = await asyncio.gather(sentiment_task, image_task)
+        self.stage_outputs['sentiment_analysis'] = sentiment_results
+        self.stage_outputs['image_analysis'] = image_results
         
-        # Detect defects in product images
-        image_tool = ImageAnalysisTool()
-        image_results = image_tool.run(claim_object.product_images)
+        if sentiment_results['error'] is not None or image_results['error'] is not None:
+            if speculation is not None:
+                speculation.cancel()
+            self._mark_failed(claim_object)
+            return claim_object
+        
+        sentiment_analysis_response = SentimentAnalysisResponse(**sentiment_results)
         image_analysis_response = ImageAnalysisResponse(**image_results)
         
-        return claim_object, sentiment_analysis_response, image_analysis_response
+        if speculation is not None:
+            with self.trace.activate():
+                self.speculative_refund = await self._resolve_speculation(
+                    speculation, assumed, sentiment_analysis_response, image_analysis_response, claim_object
+                )
+        
+        self.sentiment_response = sentiment_analysis_response
+        self.image_response = image_analysis_response
+        return claim_object
     
     @listen('analyse_sentiment_and_images')
-    def generate_claim_report(
-            self, 
-            claim_object: RefundClaim, 
-            sentiment_response: SentimentAnalysisResponse | None, 
-            image_response: ImageAnalysisResponse | None
-        ) -> RefundClaim:
+    def generate_claim_report(self, claim_object: RefundClaim) -> RefundClaim:
         """
         Generate a report based on sentiment analysis and image analysis results
         """
+        if self._is_decided(claim_object):
+            return self._finish(claim_object)
+        
         refund_estimation = RefundEstimationTool()
-        refund_response = refund_estimation.generate_report(sentiment_response, image_response, claim_object)
+        with self.trace.activate(), stage('generate_claim_report'):
+            refund_response = self.speculative_refund or refund_estimation.generate_report(
+                self.sentiment_response, self.image_response, claim_object
+            )
+        self.stage_outputs['refund_estimation'] = refund_response
         
         if refund_response['error'] is None:
             claim_object.refund_amount = refund_response['refund_amount']
@@ -73,8 +382,6 @@ class ClaimRefundFlow(Flow):
             claim_object.refund_reason = refund_response['refund_reason']
             claim_object.refund_notes = refund_response['refund_notes']
         else:
-            claim_object.refund_amount = 0.0
-            claim_object.refund_status = "Not Successfully Processed"
-            claim_object.refund_reason = "Error processing refund request. Please try again later."
+            self._mark_failed(claim_object)
             
-        return claim_object
\ No newline at end of file
+        return self._finish(claim_object)
\ No newline at end of file
@@ -0,0 +1,136 @@
+import hashlib
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from smart_claims.utils.config import Config
+from smart_claims.utils.image_processing import load_image, perceptual_hash
+from smart_claims.utils.similarity_index import IndexEntry, MinHasher, SimilarityIndex, create_similarity_index, review_words
+from smart_claims.utils.instrumentation import stage, record_error, increment
+
+minhasher = MinHasher()
+
+# Shared index, created by the first screened claim so that nothing is opened when
+# fraud screening is disabled
+_similarity_index: Optional[SimilarityIndex] = None
+_similarity_index_lock = threading.Lock()
+
+
+def get_similarity_index() -> SimilarityIndex:
+    """
+    Return the shared fraud screening index, creating it on first use
+
+    :return: Similarity index instance
+    """
+    global _similarity_index
+    if _similarity_index is None:
+        with _similarity_index_lock:
+            if _similarity_index is None:
+                _similarity_index = create_similarity_index()
+    return _similarity_index
+
+
+def _after_fork() -> None:
+    global _similarity_index_lock
+    _similarity_index_lock = threading.Lock()
+    if _similarity_index is not None:
+        _similarity_index.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def claim_group_id(claim_info) -> str:
+    """
+    Claims for the same customer, order and product are resubmissions of one claim
+    """
+    key = f"{claim_info.customer_id}\x1f{claim_info.order_id}\x1f{claim_info.product_id}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+
+class FraudScreeningTool:
+    """
+    Flags claims whose product images or review text near-duplicate those of earlier claims.
+
+    Every screened claim is added to the index, so the same stock photo or copy-pasted
+    review submitted with a later claim is caught before any model call.
+    """
+
+    def __init__(self, index: Optional[SimilarityIndex] = None):
+        self._index = index
+
+    @property
+    def index(self) -> SimilarityIndex:
+        # Resolved on first lookup, which only happens when a claim is screened
+        if self._index is None:
+            self._index = get_similarity_index()
+        return self._index
+
+    @staticmethod
+    def fingerprint(image_paths: List[str], review: str) -> Tuple[List[Tuple[str, int]], Optional[np.ndarray]]:
+        """
+        Perceptual hashes of the images and the MinHash signature of the review
+
+        :param image_paths: Paths to the image files
+        :param review: Review text
+        :return: Tuple of (image path, hash) pairs and the review signature, None for short reviews
+        """
+        image_hashes = [(image_path, perceptual_hash(load_image(image_path)[0])) for image_path in image_paths or []]
+        signature = None
+        if len(review_words(review)) >= Config.FRAUD_REVIEW_MIN_WORDS:
+            signature = minhasher.signature(review)
+        return image_hashes, signature
+
+    def screen(self, claim_info) -> Dict[str, Any]:
+        """
+        Look up near-duplicates of a claim, then add the claim to the index
+
+        :param claim_info: RefundClaim being processed
+        :return: Dictionary with the fraud flags, matches and a reason when flagged
+        """
+        with stage('fraud_screening'):
+            try:
+                group_id = claim_group_id(claim_info)
+                image_hashes, signature = self.fingerprint(claim_info.product_images, claim_info.product_review)
+
+                image_matches = []
+                for image_path, image_hash in image_hashes:
+                    for claim_id, match_group, distance in self.index.similar_images(image_hash):
+                        if match_group != group_id:
+                            image_matches.append({'image_path': image_path, 'claim_id': claim_id, 'distance': distance})
+
+                review_matches = []
+                if signature is not None:
+                    for claim_id, match_group, similarity in self.index.similar_reviews(signature, Config.FRAUD_REVIEW_MIN_SIMILARITY):
+                        if match_group != group_id:
+                            review_matches.append({'claim_id': claim_id, 'similarity': similarity})
+
+                self.index.add(IndexEntry(claim_info.claim_id, group_id, [image_hash for _, image_hash in image_hashes], signature))
+            except Exception as e:
+                logging.error(f"Fraud screening failed for claim {claim_info.claim_id}: {e}")
+                record_error('fraud_screening', str(e))
+                return {'flags': [], 'image_matches': [], 'review_matches': [], 'reason': None, 'error': str(e)}
+
+        flags = []
+        reasons = []
+        if image_matches:
+            flags.append('duplicate_image')
+            reasons.append(
+                "product images match earlier claims ("
+                + ", ".join(f"{match['image_path']} ~ claim {match['claim_id']}" for match in image_matches[:3]) + ")"
+            )
+        if review_matches:
+            flags.append('duplicate_review')
+            best = max(review_matches, key=lambda match: match['similarity'])
+            reasons.append(f"review text matches claim {best['claim_id']} ({best['similarity']:.0%} similar)")
+        if flags:
+            increment('fraud_flagged')
+
+        return {
+            'flags': flags,
+            'image_matches': image_matches,
+            'review_matches': review_matches,
+            'reason': "Possible duplicate claim: " + "; ".join(reasons) + "." if flags else None,
+            'error': None,
+        }
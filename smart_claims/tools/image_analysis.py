@@ -1,45 +1,72 @@
-import base64
+import asyncio
 import logging
-from PIL import Image
-from typing import List, Dict, Any
-from openai import OpenAI
+import os
+from typing import List, Dict, Any, Tuple
 from smart_claims.utils.config import Config
+from smart_claims.utils.output_parsing import OutputParseError, parse_structured, parse_structured_async, repair_output
 from smart_claims.utils.prompts import IMAGE_ANALYSIS_SYSTEM_PROMPT
+from smart_claims.utils.prompt_builder import PromptBuilder, normalize_whitespace
 from smart_claims.utils.data_models import ImageAnalysisResponse
+from smart_claims.utils.model_registry import registry
+from smart_claims.utils.cache import result_cache, make_cache_key
+from smart_claims.utils.image_processing import preprocess_images, estimate_upload_bytes, image_byte_budget
+from smart_claims.utils.batching import MicroBatcher
+from smart_claims.utils.instrumentation import stage, record_error, increment
 
-# Supports one opensource model and GPT-4o
-if Config.IMAGE_ANALYSIS_MODEL not in ['gpt-4o-mini', 'gpt-4o']:
+
+def load_vision_model() -> Tuple[Any, Any, Any]:
+    """
+    Load the open-source vision language model and its processor
+
+    transformers, torch and bitsandbytes are imported here so that importing this
+    module stays fast when only the OpenAI models are used. On machines without a
+    GPU (or with LOCAL_VLM_DEVICE=cpu) the model runs in full precision on the CPU,
+    and 4-bit quantization is only applied on CUDA when LOCAL_VLM_QUANTIZATION=4bit.
+    """
     from transformers import AutoModelForCausalLM, AutoProcessor
-    from transformers import BitsAndBytesConfig
     import torch
     
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if Config.LOCAL_VLM_DEVICE == 'auto':
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    else:
+        device = torch.device(Config.LOCAL_VLM_DEVICE)
     
-    quantization_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype="float16",
-        bnb_4bit_use_double_quant=True
-    )
+    model_kwargs = {}
+    if device.type == 'cuda' and Config.LOCAL_VLM_QUANTIZATION == '4bit':
+        from transformers import BitsAndBytesConfig
+        
+        model_kwargs['quantization_config'] = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype="float16",
+            bnb_4bit_use_double_quant=True
+        )
+        model_kwargs['device_map'] = "cuda"
 
     # Note: set _attn_implementation='eager' if you don't have flash_attn installed
     model = AutoModelForCausalLM.from_pretrained(
-        "microsoft/Phi-3.5-vision-instruct" ,
-        device_map="cuda",
+        Config.LOCAL_VLM_MODEL,
         trust_remote_code=True,
-        torch_dtype="auto",
+        torch_dtype="auto" if device.type == 'cuda' else torch.float32,
         _attn_implementation='eager',
-        quantization_config=quantization_config
+        **model_kwargs
     )
+    if 'device_map' not in model_kwargs:
+        model.to(device)
+    model.eval()
 
     # for best performance, use num_crops=4 for multi-frame, num_crops=16 for single-frame.
     processor = AutoProcessor.from_pretrained(
-        "microsoft/Phi-3.5-vision-instruct",
+        Config.LOCAL_VLM_MODEL,
         trust_remote_code=True,
-        num_crops=4
+        num_crops=Config.LOCAL_VLM_NUM_CROPS
     )
-else:
-    client = OpenAI(api_key=Config.OPENAI_API_KEY)
+    return model, processor, device
+
+
+# Supports one opensource model and GPT-4o
+if Config.IMAGE_ANALYSIS_MODEL not in ['gpt-4o-mini', 'gpt-4o']:
+    registry.register('vision', load_vision_model)
 
 class ImageAnalysisTool:
     """
@@ -50,146 +77,391 @@ class ImageAnalysisTool:
         """
         Encode image to base64 for OpenAI API
         
+        The image is orientation-corrected and downsized to the resolution the model
+        uses before encoding, and encoded in chunks without an intermediate copy.
+        
         :param image_path: Path to the image file
         :return: Base64 encoded image string
         """
         try:
-            with open(image_path, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode('utf-8')
+            return preprocess_images([image_path])[0].to_base64()
         except Exception as e:
             logging.error(f"Image encoding failed: {e}")
 
+    def build_openai_messages(self, image_paths: List[str], product_info: Dict) -> List[Dict[str, Any]]:
+        """
+        Build the chat messages for an OpenAI vision request
+        
+        :param image_paths: Paths to the image files
+        :param product_info: Dictionary with product name and description
+        :return: List of chat messages
+        """
+        builder = PromptBuilder('image_analysis', Config.IMAGE_ANALYSIS_MODEL, Config.IMAGE_PROMPT_MAX_TOKENS)
+        builder.system(IMAGE_ANALYSIS_SYSTEM_PROMPT)
+        # Instructions come before the product details so every request shares the same prefix
+        builder.static("Carefully examine the product images below. Product Information:")
+        builder.field('Product Name', product_info['product_name'])
+        builder.field('Product Description', product_info['product_description'], compressible=True)
+        
+        # Downsize, re-encode and drop near-duplicate images before upload
+        with stage('image.encode'):
+            for prepared_image in preprocess_images(image_paths):
+                data_url = prepared_image.to_data_url()
+                increment('image_bytes_uploaded', len(data_url))
+                builder.image(data_url, Config.IMAGE_DETAIL)
+        
+        return builder.build()
+
+    @staticmethod
+    def upload_bytes(messages: List[Dict[str, Any]]) -> int:
+        """
+        Size of the encoded images carried by a vision request
+        """
+        return sum(
+            len(part['image_url']['url'])
+            for message in messages if isinstance(message['content'], list)
+            for part in message['content'] if part['type'] == 'image_url'
+        )
+
+    @staticmethod
+    def parse_analysis(image_analysis: ImageAnalysisResponse, image_paths: List[str]) -> Dict[str, Any]:
+        return {
+            'image_path': image_paths,
+            'error': None,
+            'detected_defects': image_analysis.detected_defects,
+            'defect_score': image_analysis.defect_score,
+        }
+
+    @staticmethod
+    def merge_analyses(previous: Dict[str, Any], added: Dict[str, Any], image_paths: List[str]) -> Dict[str, Any]:
+        """
+        Combine the analysis of a claim's earlier images with that of images added later
+
+        Defects from both are kept and the defect score is the higher of the two, as a
+        claim is assessed on its most damaged item.
+
+        :param previous: Analysis of the images the claim had before
+        :param added: Analysis of the added images
+        :param image_paths: Paths of all the claim's images
+        :return: Dictionary with image analysis results for all images
+        """
+        defects = list(previous['detected_defects'])
+        defects += [defect for defect in added['detected_defects'] if defect not in defects]
+        return {
+            'image_path': image_paths,
+            'error': None,
+            'detected_defects': defects,
+            'defect_score': max(previous['defect_score'], added['defect_score']),
+        }
+
+    def _error_response(self, image_paths: List[str], error: Exception) -> Dict[str, Any]:
+        logging.error(f"Image analysis failed for {image_paths}: {error}")
+        record_error('image_analysis', str(error))
+        return {
+            'image_paths': image_paths,
+            'error': str(error),
+            'detected_defects': None,
+            'defect_score': None,
+        }
+
+    def _cache_key(self, image_paths: List[str], product_info: Dict) -> str | None:
+        """
+        Key the analysis on the image bytes, product info, model and prompt version
+        
+        :return: Cache key, or None if the images cannot be read
+        """
+        try:
+            return make_cache_key(
+                'image_analysis',
+                [
+                    Config.IMAGE_ANALYSIS_MODEL,
+                    Config.PROMPT_VERSION,
+                    product_info['product_name'],
+                    product_info['product_description'],
+                ],
+                files=image_paths
+            )
+        except OSError as e:
+            logging.error(f"Could not hash images {image_paths}: {e}")
+            return None
+
+    @staticmethod
+    def _cached(cache_key: str | None, image_paths: List[str]) -> Dict[str, Any] | None:
+        # The key covers the image contents, not their paths, so a hit may come from
+        # another claim's copies of the same files
+        cached = result_cache.get(cache_key) if cache_key is not None else None
+        return dict(cached, image_path=image_paths) if cached is not None else None
+
+    def _store(self, cache_key: str | None, result: Dict[str, Any]) -> Dict[str, Any]:
+        if cache_key is not None and result['error'] is None:
+            result_cache.set(cache_key, result)
+        return result
+
+    async def analyze_images_async(self, image_paths: List[str], product_info: Dict) -> Dict[str, Any]:
+        """
+        Analyze images without blocking the event loop
+        
+        Uses AsyncOpenAI for the GPT-4o models and a worker thread for the local model.
+        Results are served from the result cache when the same images were analyzed before.
+        
+        :param image_paths: Paths to the image files
+        :param product_info: Dictionary with product name and description
+        :return: Dictionary with image analysis results
+        """
+        with stage('image_analysis'):
+            cache_key = await asyncio.to_thread(self._cache_key, image_paths, product_info)
+            cached = self._cached(cache_key, image_paths)
+            if cached is not None:
+                return cached
+            return self._store(cache_key, await self._analyze_images_async(image_paths, product_info))
+
+    async def _analyze_images_async(self, image_paths: List[str], product_info: Dict) -> Dict[str, Any]:
+        if Config.IMAGE_ANALYSIS_MODEL not in ['gpt-4o-mini', 'gpt-4o']:
+            return await asyncio.to_thread(self._analyze_images, image_paths, product_info)
+        
+        try:
+            # Encoded images stay in memory until the response arrives, so they count
+            # against the in-flight byte budget for the whole request
+            async with image_byte_budget.reserve_async(estimate_upload_bytes(image_paths)) as reservation:
+                # Base64 encoding reads every file, keep it off the event loop
+                messages = await asyncio.to_thread(self.build_openai_messages, image_paths, product_info)
+                reservation.settle(self.upload_bytes(messages))
+                with stage('image.openai_request'):
+                    image_analysis = await parse_structured_async(
+                        'image_analysis',
+                        Config.IMAGE_ANALYSIS_MODEL,
+                        messages,
+                        ImageAnalysisResponse,
+                        max_tokens=Config.IMAGE_ANALYSIS_MAX_COMPLETION_TOKENS,
+                        temperature=0
+                    )
+            return self.parse_analysis(image_analysis, image_paths)
+        
+        except Exception as e:
+            return self._error_response(image_paths, e)
+
     def analyze_images(self, image_paths: List[str], product_info: Dict) -> Dict[str, Any]:
         """
         Analyze an image using GPT-4o-mini vision capabilities
         
+        Results are served from the result cache when the same images were analyzed before.
+        
         :param image_path: Path to the image file
         :return: Dictionary with image analysis results
         """
+        with stage('image_analysis'):
+            cache_key = self._cache_key(image_paths, product_info)
+            cached = self._cached(cache_key, image_paths)
+            if cached is not None:
+                return cached
+            return self._store(cache_key, self._analyze_images(image_paths, product_info))
+
+    def _analyze_images(self, image_paths: List[str], product_info: Dict) -> Dict[str, Any]:
         if Config.IMAGE_ANALYSIS_MODEL in ['gpt-4o-mini', 'gpt-4o']:
             try:
-                # Encode image
-                content = [
-                    {
-                        "type": "text", 
-                        "text": f"""
-                        Product Information:
-                        - Product Name: {product_info['product_name']}
-                        - Product Description: {product_info['product_description']}
-                        
-                        Now, carefully examine these product images. 
-                        """
-                    },
-                                
-                ]
-                
-                for image_path in image_paths:
-                    base64_image = self.encode_image(image_path)
-                    content.append(
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}",
-                                "detail": "low"
-                            },
-                        }
-                    )
-                
-                # Prepare GPT-4o vision request
-                response = client.chat.completions.create(
-                    model=Config.IMAGE_ANALYSIS_MODEL,
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": IMAGE_ANALYSIS_SYSTEM_PROMPT
-                        },
-                        {
-                            "role": "user",
-                            "content": content
-                        }
-                    ],
-                    max_tokens=300,
-                    temperature=0,
-                    response_format=ImageAnalysisResponse
-                )
-                
-                # Extract analysis from response
-                image_analysis = response.choices[0].message.parsed
+                with image_byte_budget.reserve(estimate_upload_bytes(image_paths)) as reservation:
+                    # Prepare GPT-4o vision request
+                    messages = self.build_openai_messages(image_paths, product_info)
+                    reservation.settle(self.upload_bytes(messages))
+                    with stage('image.openai_request'):
+                        image_analysis = parse_structured(
+                            'image_analysis',
+                            Config.IMAGE_ANALYSIS_MODEL,
+                            messages,
+                            ImageAnalysisResponse,
+                            max_tokens=Config.IMAGE_ANALYSIS_MAX_COMPLETION_TOKENS,
+                            temperature=0
+                        )
                 
-                return {
-                    'image_path': image_paths,
-                    'error': None,
-                    'detected_defects': image_analysis.detected_defects,
-                    'defect_score': image_analysis.defect_score,
-                }
+                return self.parse_analysis(image_analysis, image_paths)
             
             except Exception as e:
-                logging.error(f"Image analysis failed for {image_paths}: {e}")
-                return {
-                    'image_paths': image_paths,
-                    'error': str(e),
-                    'detected_defects': None,
-                    'defect_score': None,
-                }
+                return self._error_response(image_paths, e)
+        elif Config.LOCAL_VLM_BATCH_SIZE > 1:
+            # Concurrent callers are merged into a single generate() call
+            return vision_batcher((image_paths, product_info))
         else:
+            return self.analyze_local_batch([(image_paths, product_info)])[0]
+
+    def analyze_images_batch(self, claims: List[Tuple[List[str], Dict]]) -> List[Dict[str, Any]]:
+        """
+        Analyze the images of several claims
+        
+        With the local model, every claim that is not cached is decoded in one batched
+        generate() call. The OpenAI models analyze one claim per request.
+        
+        :param claims: List of (image paths, product info) tuples
+        :return: List of image analysis results, one per claim
+        """
+        if Config.IMAGE_ANALYSIS_MODEL in ['gpt-4o-mini', 'gpt-4o']:
+            return [self.analyze_images(image_paths, product_info) for image_paths, product_info in claims]
+        
+        keys = [self._cache_key(image_paths, product_info) for image_paths, product_info in claims]
+        results = [self._cached(key, image_paths) for key, (image_paths, _) in zip(keys, claims)]
+        missing = [index for index, result in enumerate(results) if result is None]
+        for offset in range(0, len(missing), Config.LOCAL_VLM_BATCH_SIZE):
+            chunk = missing[offset:offset + Config.LOCAL_VLM_BATCH_SIZE]
+            computed = self.analyze_local_batch([claims[index] for index in chunk])
+            for index, result in zip(chunk, computed):
+                results[index] = self._store(keys[index], result)
+        return results
+
+    def _build_local_inputs(self, image_paths: List[str], product_info: Dict, processor,
+                            constrained: bool = False) -> Dict[str, Any]:
+        images = []
+        placeholder = "\n\n" + normalize_whitespace(f"""
+            Product Information:
+            - Product Name: {product_info['product_name']}
+            - Product Description: {product_info['product_description']}
+
+            Now, carefully examine these product images.
+        """) + "\n"
+        
+        for prepared_image in preprocess_images(image_paths):
+            images.append(prepared_image.image)
+            placeholder += f"<|image_{len(images)}|>\n"
+        
+        placeholder += "Return the detected detects followed by an overall defect score separated by \n-----\n"
+        if constrained:
+            # Retry of an answer that could not be parsed
+            placeholder += ("Answer in exactly this format and nothing else: one detected defect per line, "
+                            "a line with -----, then the defect score as a single number between 0 and 1.\n")
+        messages = [
+            {
+                "role": "user",
+                "content": normalize_whitespace(IMAGE_ANALYSIS_SYSTEM_PROMPT) + placeholder
+            }
+        ]
+        
+        prompt = processor.tokenizer.apply_chat_template(
+            messages,
+            tokenize=False,
+            add_generation_prompt=True
+        )
+        return processor(prompt, images, return_tensors="pt")
+
+    @staticmethod
+    def _collate_local_inputs(encodings: List[Dict[str, Any]], pad_token_id: int) -> Dict[str, Any]:
+        """
+        Merge per-claim processor outputs into one batch
+        
+        Token tensors are left-padded so every sequence ends at the generation position.
+        Image tensors are concatenated along the image dimension, in claim order, which
+        is the order the model assigns image features to image placeholder tokens.
+        """
+        import torch
+        import torch.nn.functional as F
+        
+        max_length = max(encoding['input_ids'].shape[1] for encoding in encodings)
+        batch = {}
+        for key in encodings[0].keys():
+            tensors = [encoding[key] for encoding in encodings]
+            if key in ('input_ids', 'attention_mask'):
+                pad_value = pad_token_id if key == 'input_ids' else 0
+                tensors = [F.pad(tensor, (max_length - tensor.shape[1], 0), value=pad_value) for tensor in tensors]
+            else:
+                target_shape = [max(sizes) for sizes in zip(*(tensor.shape[1:] for tensor in tensors))]
+                padded = []
+                for tensor in tensors:
+                    padding = []
+                    for size, target in reversed(list(zip(tensor.shape[1:], target_shape))):
+                        padding += [0, target - size]
+                    padded.append(F.pad(tensor, padding) if any(padding) else tensor)
+                tensors = padded
+            batch[key] = torch.cat(tensors, dim=0)
+        return batch
+
+    @staticmethod
+    def parse_local_response(response: str) -> ImageAnalysisResponse:
+        """
+        Parse the local model's "defects ----- score" answer, repairing other layouts
+
+        :param response: Generated text
+        :return: ImageAnalysisResponse
+        """
+        sections = response.split("-----")
+        if len(sections) == 2:
             try:
-                images = []
-                placeholder = f"""
-                Product Information:
-                    - Product Name: {product_info['product_name']}
-                    - Product Description: {product_info['product_description']}
-                    
-                Now, carefully examine these product images.
-                """
-                
-                for image_path in image_paths:
-                    images.append(Image.open(image_path))
-                    placeholder += f"<|image_{len(images)}|>\n"
-                
-                placeholder += "Return the detected detects followed by an overall defect score separated by \n-----\n"
-                messages = [
-                    {
-                        "role": "user",
-                        "content": IMAGE_ANALYSIS_SYSTEM_PROMPT + placeholder
-                    }
-                ]
-                
-                prompt = processor.tokenizer.apply_chat_template(
-                    messages,
-                    tokenize=False,
-                    add_generation_prompt=True
-                )
+                return ImageAnalysisResponse(detected_defects=sections[0], defect_score=sections[1])
+            except ValueError:
+                pass
+        # Other layouts are read as JSON or "Label: value" lines, or as the defects before
+        # the first separator and the score after the last one
+        try:
+            analysis = repair_output(ImageAnalysisResponse, response)
+        except OutputParseError:
+            if len(sections) < 3:
+                raise
+            analysis = repair_output(ImageAnalysisResponse, {'detected_defects': sections[0], 'defect_score': sections[-1]})
+        increment('image_analysis_output_repaired')
+        return analysis
 
-                inputs = processor(prompt, images, return_tensors="pt").to(device)
+    def analyze_local_batch(self, claims: List[Tuple[List[str], Dict]], constrained: bool = False) -> List[Dict[str, Any]]:
+        """
+        Run the local vision model on several claims with a single generate() call
+        
+        Answers that cannot be parsed or repaired are generated once more with a
+        constrained prompt, when STRUCTURED_OUTPUT_RETRY is set.
+        
+        :param claims: List of (image paths, product info) tuples
+        :param constrained: Ask for the exact answer format, used for the retry
+        :return: List of image analysis results, one per claim
+        """
+        try:
+            model, processor, device = registry.get('vision')
+            tokenizer = processor.tokenizer
+            pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+            
+            encodings = [
+                self._build_local_inputs(image_paths, product_info, processor, constrained)
+                for image_paths, product_info in claims
+            ]
+            inputs = self._collate_local_inputs(encodings, pad_token_id)
+            inputs = {key: value.to(device) for key, value in inputs.items()}
 
+            with stage('image.local_generate'):
                 generate_ids = model.generate(
                     **inputs,
-                    eos_token_id= processor.tokenizer.eos_token_id,
-                    max_new_tokens=256,
-                    temperature=0.0,
+                    eos_token_id=tokenizer.eos_token_id,
+                    pad_token_id=pad_token_id,
+                    max_new_tokens=Config.LOCAL_VLM_MAX_NEW_TOKENS,
+                    do_sample=False,
                 )
 
-                generate_ids = generate_ids[:, inputs['input_ids'].shape[1]:]
-                response = processor.batch_decode(
-                    generate_ids,
-                    skip_special_tokens=True,
-                    clean_up_tokenization_spaces=False
-                )[0].split("-----")
-                
-                return {
-                    'image_path': image_paths,
-                    'error': None,
-                    'detected_defects': response[0],
-                    'defect_score': response[1],
-                }
-            except Exception as e:
-                logging.error(f"Image analysis failed for {image_paths}: {e}")
-                return {
-                    'image_paths': image_paths,
-                    'error': str(e),
-                    'detected_defects': None,
-                    'defect_score': None,
-                }
+            generate_ids = generate_ids[:, inputs['input_ids'].shape[1]:]
+            responses = processor.batch_decode(
+                generate_ids,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False
+            )
+        except Exception as e:
+            return [self._error_response(image_paths, e) for image_paths, _ in claims]
+        
+        results, unparsed = [], []
+        for index, ((image_paths, _), response) in enumerate(zip(claims, responses)):
+            try:
+                results.append(self.parse_analysis(self.parse_local_response(response), image_paths))
+            except OutputParseError as e:
+                if constrained or not Config.STRUCTURED_OUTPUT_RETRY:
+                    results.append(self._error_response(image_paths, e))
+                else:
+                    results.append(None)
+                    unparsed.append(index)
+        
+        if unparsed:
+            increment('image_analysis_output_retried', len(unparsed))
+            retried = self.analyze_local_batch([claims[index] for index in unparsed], constrained=True)
+            for index, result in zip(unparsed, retried):
+                results[index] = result
+        return results
+
+vision_batcher = MicroBatcher(
+    lambda claims: ImageAnalysisTool().analyze_local_batch(claims),
+    max_batch_size=Config.LOCAL_VLM_BATCH_SIZE,
+    max_wait_ms=Config.LOCAL_VLM_MAX_WAIT_MS,
+    name="vision-batcher"
+)
+os.register_at_fork(after_in_child=vision_batcher.after_fork)
             
 
 if __name__ == "__main__":
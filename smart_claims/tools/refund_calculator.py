@@ -0,0 +1,129 @@
+import threading
+from collections import Counter
+from typing import Dict, Any, Optional
+from smart_claims.utils.config import Config
+
+
+class RefundRulesEngine:
+    """
+    Deterministic refund calculator for clear-cut claims.
+
+    Claims whose outcome follows mechanically from the product cost, defect score and
+    review sentiment are decided here, with a full, partial or no refund; everything
+    else returns None and is escalated to the refund estimation model.
+    """
+
+    def __init__(
+            self,
+            no_defect_max_score: float = Config.REFUND_RULES_NO_DEFECT_MAX_SCORE,
+            severe_defect_min_score: float = Config.REFUND_RULES_SEVERE_DEFECT_MIN_SCORE,
+            low_cost_max: float = Config.REFUND_RULES_LOW_COST_MAX,
+            min_sentiment_confidence: float = Config.REFUND_RULES_MIN_SENTIMENT_CONFIDENCE,
+            partial_enabled: bool = Config.REFUND_RULES_PARTIAL_ENABLED,
+            partial_min_score: float = Config.REFUND_RULES_PARTIAL_MIN_SCORE,
+            partial_min_fraction: float = Config.REFUND_RULES_PARTIAL_MIN_FRACTION,
+            partial_max_fraction: float = Config.REFUND_RULES_PARTIAL_MAX_FRACTION
+        ):
+        self.no_defect_max_score = no_defect_max_score
+        self.severe_defect_min_score = severe_defect_min_score
+        self.low_cost_max = low_cost_max
+        self.min_sentiment_confidence = min_sentiment_confidence
+        self.partial_enabled = partial_enabled
+        self.partial_min_score = partial_min_score
+        self.partial_min_fraction = partial_min_fraction
+        self.partial_max_fraction = partial_max_fraction
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def evaluate(self, sentiment_analysis, image_analysis, claim_info) -> Optional[Dict[str, Any]]:
+        """
+        Decide a claim without the refund estimation model when the outcome is mechanical
+
+        :param sentiment_analysis: SentimentAnalysisResponse for the review
+        :param image_analysis: ImageAnalysisResponse for the product images
+        :param claim_info: RefundClaim being processed
+        :return: Refund decision in the RefundEstimationTool format, or None to escalate
+        """
+        decision = self._decide(sentiment_analysis, image_analysis, claim_info)
+        with self._lock:
+            self.counters['evaluated'] += 1
+            if decision is None:
+                self.counters['escalated'] += 1
+            else:
+                self.counters['short_circuited'] += 1
+                self.counters[f"rule:{decision.pop('rule')}"] += 1
+        return decision
+
+    def decides(self, sentiment_analysis, image_analysis, claim_info) -> bool:
+        """
+        Whether a rule would decide the claim, without counting it in the stats
+        """
+        return self._decide(sentiment_analysis, image_analysis, claim_info) is not None
+
+    def _decide(self, sentiment_analysis, image_analysis, claim_info) -> Optional[Dict[str, Any]]:
+        if sentiment_analysis is None or image_analysis is None:
+            return None
+
+        defect_score = image_analysis.defect_score
+        sentiment_label = (sentiment_analysis.sentiment_label or '').lower()
+        confident = sentiment_analysis.sentiment_score >= self.min_sentiment_confidence
+        product_cost = float(claim_info.product_cost)
+
+        if defect_score <= self.no_defect_max_score and sentiment_label == 'positive' and confident:
+            return {
+                'rule': 'no_defect_positive_review',
+                'refund_amount': 0.0,
+                'refund_status': "Rejected",
+                'refund_reason': "No defects were detected in the product images and the review is positive.",
+                'refund_notes': f"Decided by rule: defect score {defect_score:.2f}, positive review.",
+                'error': None
+            }
+
+        if defect_score >= self.severe_defect_min_score and product_cost <= self.low_cost_max:
+            return {
+                'rule': 'severe_defect_low_cost',
+                'refund_amount': round(product_cost, 2),
+                'refund_status': "Approved",
+                'refund_reason': "Severe defects were detected in the product images. A full refund is issued.",
+                'refund_notes': f"Decided by rule: defect score {defect_score:.2f} on a ${product_cost:.2f} item.",
+                'error': None
+            }
+
+        if (self.partial_enabled and self.partial_min_score <= defect_score < self.severe_defect_min_score
+                and sentiment_label == 'negative' and confident and product_cost <= self.low_cost_max):
+            fraction = self.partial_fraction(defect_score)
+            return {
+                'rule': 'moderate_defect_negative_review',
+                'refund_amount': round(product_cost * fraction, 2),
+                'refund_status': "Approved",
+                'refund_reason': "Moderate defects were detected in the product images. A partial refund is issued.",
+                'refund_notes': f"Decided by rule: defect score {defect_score:.2f}, negative review, {fraction:.0%} of ${product_cost:.2f}.",
+                'error': None
+            }
+
+        return None
+
+    def partial_fraction(self, defect_score: float) -> float:
+        """
+        Share of the product cost refunded for a moderate defect
+
+        :param defect_score: Defect score between the partial and the severe defect scores
+        :return: Fraction rising linearly from the min to the max partial fraction
+        """
+        span = self.severe_defect_min_score - self.partial_min_score
+        position = (defect_score - self.partial_min_score) / span if span > 0 else 1.0
+        position = min(max(position, 0.0), 1.0)
+        return self.partial_min_fraction + (self.partial_max_fraction - self.partial_min_fraction) * position
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Counts of evaluated, short-circuited and escalated claims, plus the short-circuit rate
+        """
+        with self._lock:
+            stats = dict(self.counters)
+        evaluated = stats.get('evaluated', 0)
+        stats['short_circuit_rate'] = stats.get('short_circuited', 0) / evaluated if evaluated else 0.0
+        return stats
+
+
+rules_engine = RefundRulesEngine()
@@ -1,74 +1,171 @@
-from typing import Dict
-from openai import OpenAI
+import re
+from typing import Any, Dict, List
 from smart_claims.utils.config import Config
+from smart_claims.utils.output_parsing import parse_structured, parse_structured_async
 from smart_claims.utils.prompts import REFUND_ESTIMATION_PROMPT
-from smart_claims.utils.data_models import RefundEstimationResponse
+from smart_claims.utils.prompt_builder import PromptBuilder
+from smart_claims.utils.data_models import RefundEstimationResponse, ImageAnalysisResponse
+from smart_claims.utils.similarity_index import review_words
+from smart_claims.tools.refund_calculator import rules_engine
+from smart_claims.utils.instrumentation import stage, record_error, increment
+
+def parse_defect_priors(spec: str) -> Dict[str, float]:
+    """
+    Parse REFUND_SPECULATION_DEFECT_PRIORS, e.g. "negative=0.7,neutral=0.4,positive=0.1"
+
+    :return: Mapping of lower-case sentiment label to assumed defect score
+    """
+    priors = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        label, _, score = entry.partition('=')
+        priors[label.strip().lower()] = float(score)
+    return priors
+
+
+def speculative_image_analysis(sentiment_analysis) -> ImageAnalysisResponse:
+    """
+    Stand-in image analysis for a refund estimate started before the images are analysed
+
+    :param sentiment_analysis: SentimentAnalysisResponse for the review
+    :return: ImageAnalysisResponse with the defect score assumed for the review's sentiment
+    """
+    priors = parse_defect_priors(Config.REFUND_SPECULATION_DEFECT_PRIORS)
+    return ImageAnalysisResponse(
+        detected_defects=["Image analysis pending; assume the defects described in the customer review"],
+        defect_score=priors.get((sentiment_analysis.sentiment_label or '').lower(), 0.5)
+    )
+
+
+# Words of a defect description that do not name the defect
+_DEFECT_FILLER = re.compile(r'^(?:with|from|that|this|there|their|have|been|some|very|into|onto|over|near|side|part|area|visible|minor|major|small|large)$')
+
+
+def defects_described(detected_defects: List[str], review: str) -> bool:
+    """
+    Whether the review describes every defect the image analysis found
+
+    A speculative estimate assumes the defects described in the review, so it only
+    holds when the images show defects and each of them is one the review mentions.
+    A defect counts as mentioned when one of its words, compared on the first five
+    letters ("scratches" and "scratched" both match "scratch"), is in the review.
+
+    :param detected_defects: Defects from the image analysis
+    :param review: Product review text
+    :return: True when the review covers the detected defects
+    """
+    review_stems = {word[:5] for word in review_words(review) if len(word) >= 4}
+    for defect in detected_defects:
+        stems = {word[:5] for word in review_words(defect) if len(word) >= 4 and not _DEFECT_FILLER.match(word)}
+        if not stems & review_stems:
+            return False
+    return bool(detected_defects)
 
-client = OpenAI(api_key=Config.OPENAI_API_KEY)
 
 class RefundEstimationTool:
     """
     Sentiment analysis tool using Hugging Face transformers
     """
     def generate_report(self, sentiment_analysis, image_analysis, claim_info) -> Dict:
-        try:
-            # Prepare GPT-4o vision request
-            content = [
-                {
-                    "type": "text",
-                    "text": f"""
-                    Based on the sentiment analysis of the customer's review and the image analysis of the product images, 
-                    please provide an estimate of the refund amount for the claim using the following details:
-                    
-                    - Product ID: {claim_info.product_id}
-                    - Product Name: {claim_info.product_name}
-                    - Product Cost: ${claim_info.product_cost}
-                    
-                    - Customer Review: {claim_info.product_review}
-                    - Sentiment Score: {sentiment_analysis.sentiment_score}
-                    - Sentiment: {sentiment_analysis.sentiment_label}
-                    
-                    - Defects Detected: {image_analysis.detected_defects}
-                    - Defect Score: {image_analysis.defect_score}
-                    """
-                }
-            ]
+        with stage('refund_estimation'):
+            # Clear-cut claims are decided by the rules engine without an LLM call
+            if Config.REFUND_RULES_ENABLED:
+                decision = rules_engine.evaluate(sentiment_analysis, image_analysis, claim_info)
+                if decision is not None:
+                    increment('refund_rules_short_circuited')
+                    return decision
             
-            # TODO: Add Calculator Tool to precisely estimate the refund amount
-            response = client.chat.completions.create(
-                model=Config.REFUND_ESTIMATION_MODEL,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": REFUND_ESTIMATION_PROMPT
-                    },
-                    {
-                        "role": "user",
-                        "content": content
-                    }
-                ],
-                max_tokens=300,
-                temperature=0,
-                response_format=RefundEstimationResponse
-            )
-
-            # Extract analysis from response
-            final_analysis = response.choices[0].message.parsed
-            return {
-                'refund_amount': final_analysis.refund_amount,
-                'refund_status': final_analysis.refund_status,
-                'refund_reason': final_analysis.refund_reason,
-                'refund_notes': final_analysis.refund_notes,
-                'error': None}
+            return self._estimate_refund(sentiment_analysis, image_analysis, claim_info)
+
+    def build_messages(self, sentiment_analysis, image_analysis, claim_info) -> List[Dict[str, Any]]:
+        """
+        Build the chat messages for a refund estimation request
+        
+        :param sentiment_analysis: SentimentAnalysisResponse for the review
+        :param image_analysis: ImageAnalysisResponse for the product images
+        :param claim_info: RefundClaim being processed
+        :return: List of chat messages
+        """
+        builder = PromptBuilder('refund_estimation', Config.REFUND_ESTIMATION_MODEL, Config.REFUND_PROMPT_MAX_TOKENS)
+        builder.system(REFUND_ESTIMATION_PROMPT)
+        builder.static("""
+            Based on the sentiment analysis of the customer's review and the image analysis of the product images,
+            please provide an estimate of the refund amount for the claim using the following details:
+        """)
+        builder.field('Product ID', claim_info.product_id)
+        builder.field('Product Name', claim_info.product_name)
+        builder.field('Product Cost', f"${claim_info.product_cost}")
+        builder.blank_line()
+        # Over budget, the review and the defects are shortened, longest first; for long
+        # reviews the sentiment details still quote the passages that drove their sentiment
+        builder.field('Customer Review', claim_info.product_review, compressible=True)
+        builder.field('Sentiment Score', sentiment_analysis.sentiment_score)
+        builder.field('Sentiment', sentiment_analysis.sentiment_label)
+        builder.field('Sentiment Details', sentiment_analysis.sentiment_details)
+        builder.blank_line()
+        builder.field('Defects Detected', image_analysis.detected_defects, compressible=True)
+        builder.field('Defect Score', image_analysis.defect_score)
+        return builder.build()
+
+    @staticmethod
+    def parse_estimation(final_analysis: RefundEstimationResponse) -> Dict:
+        return {
+            'refund_amount': final_analysis.refund_amount,
+            'refund_status': final_analysis.refund_status,
+            'refund_reason': final_analysis.refund_reason,
+            'refund_notes': final_analysis.refund_notes,
+            'error': None}
+
+    @staticmethod
+    def error_response(error: Exception, stage_name: str = 'refund_estimation') -> Dict:
+        record_error(stage_name, str(error))
+        return {
+            'refund_amount': None,
+            'refund_status': None,
+            'refund_reason': None,
+            'refund_notes': None,
+            'error': str(error)
+        }
+
+    def _estimate_refund(self, sentiment_analysis, image_analysis, claim_info) -> Dict:
+        try:
+            with stage('refund.openai_request'):
+                final_analysis = parse_structured(
+                    'refund_estimation',
+                    Config.REFUND_ESTIMATION_MODEL,
+                    self.build_messages(sentiment_analysis, image_analysis, claim_info),
+                    RefundEstimationResponse,
+                    max_tokens=Config.REFUND_MAX_COMPLETION_TOKENS,
+                    temperature=0
+                )
+            return self.parse_estimation(final_analysis)
+        
+        except Exception as e:
+            return self.error_response(e)
+
+    async def estimate_refund_async(self, sentiment_analysis, image_analysis, claim_info,
+                                    stage_name: str = 'refund_estimation') -> Dict:
+        """
+        Ask the refund estimation model without consulting the rules engine, awaiting the response
+
+        Cancelling the call cancels the request.
+
+        :param stage_name: Stage the time, tokens and errors are recorded under
+        :return: Refund estimation in the generate_report format
+        """
+        try:
+            with stage(stage_name):
+                final_analysis = await parse_structured_async(
+                    stage_name,
+                    Config.REFUND_ESTIMATION_MODEL,
+                    self.build_messages(sentiment_analysis, image_analysis, claim_info),
+                    RefundEstimationResponse,
+                    max_tokens=Config.REFUND_MAX_COMPLETION_TOKENS,
+                    temperature=0
+                )
+            return self.parse_estimation(final_analysis)
         
         except Exception as e:
-            return {
-                'refund_amount': None,
-                'refund_status': None,
-                'refund_reason': None,
-                'refund_notes': None,
-                'error': str(e)
-            }
+            return self.error_response(e, stage_name)
 
 
 # Test
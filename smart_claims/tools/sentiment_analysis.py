@@ -1,58 +1,750 @@
-import torch
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
-from typing import Dict, Any
+import hashlib
+import json
+import logging
+import os
+import re
+import textwrap
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from types import SimpleNamespace
+from typing import Dict, Any, Iterator, List, NamedTuple, Optional, Tuple
+import numpy as np
 from smart_claims.utils.config import Config
+from smart_claims.utils.batching import MicroBatcher
+from smart_claims.utils.model_registry import registry
+from smart_claims.utils.cache import result_cache, make_cache_key
+from smart_claims.utils.instrumentation import stage, record_error, increment
 
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-tokenizer = AutoTokenizer.from_pretrained(Config.SENTIMENT_MODEL)
-model = AutoModelForSequenceClassification.from_pretrained(Config.SENTIMENT_MODEL)
-model.to(device)
+# Longest input the classifier accepts, including the special tokens
+MAX_INPUT_TOKENS = 512
+
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+|\n+')
+
+# Conservative characters per token, used to bound the text tokenized for very long reviews
+CHARS_PER_TOKEN = 6
+
+# Longest quote of a segment in sentiment_details
+DETAIL_QUOTE_CHARS = 200
+
+# Label set an ensemble of differently labelled models is averaged on
+ENSEMBLE_LABELS = ('positive', 'negative', 'neutral')
+
+STAR_RATING = re.compile(r'^([1-5])\s*stars?$')
+
+# Models exported without class names only have LABEL_0, LABEL_1, ...; sentiment models
+# of that kind follow the SST-2 and TweetEval class orders
+GENERIC_LABEL = re.compile(r'^label_(\d+)$')
+GENERIC_LABEL_NAMES = {
+    2: ('negative', 'positive'),
+    3: ('negative', 'neutral', 'positive'),
+}
+
+# Base model children trained together with the classification head, which each
+# classifier keeps when encoders are shared
+ENCODER_HEAD_MODULES = ('pooler',)
+
+
+class SentimentModel(NamedTuple):
+    tokenizer: Any
+    model: Any
+    device: Any
+
+
+SENTIMENT_BACKENDS = ('torch', 'int8', 'onnx', 'onnx-int8')
+
+
+def load_torch_sentiment_model(model_name: str = Config.SENTIMENT_MODEL) -> SentimentModel:
+    """
+    Load the full-precision PyTorch classifier, on the GPU when there is one
+    """
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name)
+    model.to(device)
+    model.eval()
+    return SentimentModel(tokenizer, model, device)
+
+
+def load_int8_sentiment_model(model_name: str = Config.SENTIMENT_MODEL) -> SentimentModel:
+    """
+    Load the classifier with its Linear layers dynamically quantized to int8
+
+    Weights are stored in int8 and activations are quantized on the fly, which cuts
+    memory and speeds up CPU inference without a calibration set.
+    """
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    if Config.SENTIMENT_NUM_THREADS:
+        torch.set_num_threads(Config.SENTIMENT_NUM_THREADS)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name)
+    model.eval()
+    # In place, so the fp32 copy of each Linear layer is freed as soon as it is quantized
+    torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return SentimentModel(tokenizer, model, torch.device('cpu'))
+
+
+class OnnxSequenceClassifier:
+    """
+    ONNX Runtime session that is called like a transformers sequence classifier
+    """
+
+    def __init__(self, session: Any, config: Any):
+        self.session = session
+        self.config = config
+        self.input_names = [model_input.name for model_input in session.get_inputs()]
+
+    def __call__(self, **inputs) -> SimpleNamespace:
+        import torch
+
+        feeds = {name: inputs[name].cpu().numpy() for name in self.input_names if name in inputs}
+        logits = self.session.run(['logits'], feeds)[0]
+        return SimpleNamespace(logits=torch.from_numpy(logits))
+
+
+def export_onnx_sentiment_model(path: str, quantize: bool = False, model_name: str = Config.SENTIMENT_MODEL) -> None:
+    """
+    Export the classifier to ONNX with dynamic batch and sequence axes
+
+    The file is written under a temporary name and moved into place, so worker
+    processes starting together never load a half-written model.
+
+    :param path: Destination of the ONNX model
+    :param quantize: Also quantize the exported weights to int8 with ONNX Runtime
+    :param model_name: Hugging Face model to export
+    """
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    # Eager attention traces to plain ops that every ONNX Runtime build supports
+    model = AutoModelForSequenceClassification.from_pretrained(model_name, attn_implementation='eager')
+    model.eval()
+    sample = dict(tokenizer(["Sample review", "Another sample review text"], return_tensors='pt', padding=True))
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in sample}
+    dynamic_axes['logits'] = {0: 'batch'}
+
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample,),
+            temporary_path,
+            input_names=list(sample),
+            output_names=['logits'],
+            dynamic_axes=dynamic_axes,
+            opset_version=17,
+            dynamo=False,
+        )
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized_path = f"{temporary_path}.int8"
+        quantize_dynamic(temporary_path, quantized_path, weight_type=QuantType.QInt8)
+        os.replace(quantized_path, temporary_path)
+    os.replace(temporary_path, path)
+
+
+def onnx_model_path(quantize: bool = False, model_name: str = Config.SENTIMENT_MODEL) -> str:
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name.strip('/'))
+    return os.path.join(Config.SENTIMENT_ONNX_DIR, f"{name}{'-int8' if quantize else ''}.onnx")
+
+
+def load_onnx_sentiment_model(quantize: bool = False, model_name: str = Config.SENTIMENT_MODEL) -> SentimentModel:
+    """
+    Load the classifier as an ONNX Runtime CPU session, exporting it on first use
+
+    :param quantize: Use int8 weights quantized by ONNX Runtime
+    :param model_name: Hugging Face model to load
+    """
+    import onnxruntime
+    import torch
+    from transformers import AutoConfig, AutoTokenizer
+
+    path = onnx_model_path(quantize, model_name)
+    if not os.path.exists(path):
+        logging.info(f"Exporting {model_name} to {path}")
+        export_onnx_sentiment_model(path, quantize, model_name)
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if Config.SENTIMENT_NUM_THREADS:
+        options.intra_op_num_threads = Config.SENTIMENT_NUM_THREADS
+    session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = OnnxSequenceClassifier(session, AutoConfig.from_pretrained(model_name))
+    return SentimentModel(tokenizer, model, torch.device('cpu'))
+
+
+def load_sentiment_model(backend: str = Config.SENTIMENT_BACKEND, model_name: str = Config.SENTIMENT_MODEL) -> SentimentModel:
+    """
+    Load the sentiment tokenizer and classifier with the configured inference backend
+
+    torch, transformers and onnxruntime are imported by the loaders so that importing
+    this module stays fast. Every backend returns the same interface, so the
+    `analyze_sentiment` output does not depend on the backend.
+
+    :param backend: One of 'torch', 'int8', 'onnx' or 'onnx-int8'
+    :param model_name: Hugging Face model to load
+    :return: SentimentModel with the tokenizer, classifier and device
+    """
+    if backend == 'torch':
+        return load_torch_sentiment_model(model_name)
+    if backend == 'int8':
+        return load_int8_sentiment_model(model_name)
+    if backend == 'onnx':
+        return load_onnx_sentiment_model(model_name=model_name)
+    if backend == 'onnx-int8':
+        return load_onnx_sentiment_model(quantize=True, model_name=model_name)
+    raise ValueError(f"Unknown sentiment backend '{backend}', expected one of {', '.join(SENTIMENT_BACKENDS)}")
+
+
+def parse_ensemble(spec: str) -> List[Tuple[str, float]]:
+    """
+    Parse SENTIMENT_ENSEMBLE, e.g. "ProsusAI/finbert=1,cardiffnlp/twitter-roberta-base-sentiment-latest=2"
+
+    :param spec: Comma-separated model=weight pairs, a missing weight counts as 1
+    :return: List of (model name, weight) tuples, SENTIMENT_MODEL alone when the spec is empty
+    """
+    members: Dict[str, float] = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, weight = entry.rpartition('=') if '=' in entry else (entry, '', '')
+        members[name.strip()] = members.get(name.strip(), 0.0) + float(weight or 1)
+    return list(members.items()) or [(Config.SENTIMENT_MODEL, 1.0)]
+
+
+def model_labels(config: Any) -> Tuple[str, ...]:
+    """
+    Class names of a model in class index order, with generic LABEL_n names resolved
+
+    :param config: Hugging Face model config
+    :return: Tuple of class names
+    """
+    id2label = {int(index): label for index, label in config.id2label.items()}
+    generic = GENERIC_LABEL_NAMES.get(len(id2label))
+    labels = []
+    for index in range(len(id2label)):
+        match = GENERIC_LABEL.match(id2label[index].strip().lower())
+        labels.append(generic[int(match.group(1))] if match and generic and int(match.group(1)) < len(generic) else id2label[index])
+    return tuple(labels)
+
+
+def canonical_label(label: str) -> Optional[str]:
+    """
+    Map a model's class name onto ENSEMBLE_LABELS, star ratings included
+
+    :param label: Class name, resolved with model_labels
+    :return: Canonical label, None when the name is not recognised
+    """
+    label = label.strip().lower()
+    for canonical in ENSEMBLE_LABELS:
+        if label.startswith(canonical[:3]):
+            return canonical
+    stars = STAR_RATING.match(label)
+    if stars is None:
+        return None
+    rating = int(stars.group(1))
+    return 'negative' if rating <= 2 else 'neutral' if rating == 3 else 'positive'
+
+
+def tokenizer_fingerprint(tokenizer: Any) -> str:
+    """
+    Identifies tokenizers that turn any text into the same input ids
+    """
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    state = backend.to_str() if backend is not None else json.dumps(sorted(tokenizer.get_vocab().items()))
+    return hashlib.sha1(f"{type(tokenizer).__name__}:{state}".encode()).hexdigest()
+
+
+def encoder_modules(model: Any) -> Dict[str, Any]:
+    """
+    Children of a classifier's base model that make up its encoder, i.e. all but the pooler
+    """
+    return {name: module for name, module in model.base_model.named_children() if name not in ENCODER_HEAD_MODULES}
+
+
+def same_encoder(first: SentimentModel, second: SentimentModel) -> bool:
+    """
+    Whether two PyTorch classifiers have identical encoder weights, e.g. heads fine-tuned on a frozen encoder
+
+    Only the encoder is compared: the pooler is fine-tuned with the head, so it differs
+    even between classifiers trained on the same frozen encoder.
+    """
+    import torch
+
+    models = (first.model, second.model)
+    if first.device != second.device or not all(isinstance(model, torch.nn.Module) for model in models):
+        return False
+    if type(first.model.base_model) is not type(second.model.base_model):
+        return False
+    first_modules, second_modules = (encoder_modules(model) for model in models)
+    if not first_modules or first_modules.keys() != second_modules.keys():
+        return False
+    for name, module in first_modules.items():
+        first_state, second_state = module.state_dict(), second_modules[name].state_dict()
+        if first_state.keys() != second_state.keys() or not all(
+            first_state[key].shape == second_state[key].shape and torch.equal(first_state[key], second_state[key])
+            for key in first_state
+        ):
+            return False
+    return True
+
+
+def share_encoder(models: List[Any]) -> Any:
+    """
+    Point every classifier at the first one's encoder modules, freeing the duplicate weights
+
+    Each classifier keeps its own pooler and head.
+
+    :param models: PyTorch sequence classifiers with identical encoders
+    :return: The shared encoder; inside its `reuse()` context each encoder module runs
+        once and every classifier gets the same output
+    """
+    import torch
+
+    class SharedEncoder:
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.reusing = False
+            self.outputs: Dict[str, Any] = {}
+
+        @contextmanager
+        def reuse(self) -> Iterator[None]:
+            with self.lock:
+                self.reusing, self.outputs = True, {}
+                try:
+                    yield
+                finally:
+                    self.reusing, self.outputs = False, {}
+
+    class SharedModule(torch.nn.Module):
+        def __init__(self, key: str, module: torch.nn.Module, shared: SharedEncoder):
+            super().__init__()
+            self.module = module
+            self.key = key
+            self.shared = shared
+
+        def forward(self, *args, **kwargs):
+            if not self.shared.reusing:
+                return self.module(*args, **kwargs)
+            if self.key not in self.shared.outputs:
+                self.shared.outputs[self.key] = self.module(*args, **kwargs)
+            return self.shared.outputs[self.key]
+
+        def __getattr__(self, name: str):
+            # Base models read attributes such as buffers off their children
+            try:
+                return super().__getattr__(name)
+            except AttributeError:
+                return getattr(super().__getattr__('module'), name)
+
+    shared = SharedEncoder()
+    wrapped = {name: SharedModule(name, module, shared) for name, module in encoder_modules(models[0]).items()}
+    for model in models:
+        for name, module in wrapped.items():
+            setattr(model.base_model, name, module)
+    return shared
+
+
+class EnsembleMember(NamedTuple):
+    name: str
+    weight: float
+    sentiment_model: SentimentModel
+    # Maps the model's class probabilities onto the ensemble labels, None when they already match
+    projection: Optional[np.ndarray]
+
+
+class SentimentEnsemble:
+    """
+    The configured sentiment models, scored together.
+
+    Models are grouped by tokenizer, and each group tokenizes and pads a batch once.
+    Within a group, PyTorch models with identical encoder weights (several heads on
+    one base model) share a single encoder that runs once per batch, and the
+    remaining models run concurrently. Class probabilities are mapped onto a common
+    label set and averaged by weight. A single model keeps its own labels.
+    """
+
+    def __init__(self, members: List[Tuple[str, float, SentimentModel]]):
+        """
+        :param members: List of (model name, weight, loaded model) tuples, the first one is
+            also used to split long reviews into segments
+        """
+        if len(members) == 1:
+            self.labels = model_labels(members[0][2].model.config)
+        else:
+            self.labels = ENSEMBLE_LABELS
+        self.members = [
+            EnsembleMember(name, weight, sentiment_model, self._projection(name, sentiment_model) if len(members) > 1 else None)
+            for name, weight, sentiment_model in members
+        ]
+        self.total_weight = sum(member.weight for member in self.members)
+
+        # Tokenizer fingerprint -> members that share an encoder, with the shared encoder
+        self.groups: Dict[str, List[Tuple[List[EnsembleMember], Any]]] = {}
+        by_tokenizer: Dict[str, List[EnsembleMember]] = {}
+        for member in self.members:
+            by_tokenizer.setdefault(tokenizer_fingerprint(member.sentiment_model.tokenizer), []).append(member)
+        for fingerprint, group in by_tokenizer.items():
+            self.groups[fingerprint] = self._share_encoders(group)
+        self._executor = self._create_executor()
+        # Threads started before fork() do not exist in the child
+        os.register_at_fork(after_in_child=lambda: setattr(self, '_executor', self._create_executor()))
+
+    def _create_executor(self) -> Optional[ThreadPoolExecutor]:
+        jobs = sum(len(subgroups) for subgroups in self.groups.values())
+        return ThreadPoolExecutor(jobs, thread_name_prefix='sentiment-ensemble') if jobs > 1 else None
+
+    def _projection(self, name: str, sentiment_model: SentimentModel) -> np.ndarray:
+        labels = model_labels(sentiment_model.model.config)
+        projection = np.zeros((len(labels), len(self.labels)), dtype=np.float32)
+        for index, label in enumerate(labels):
+            canonical = canonical_label(label)
+            if canonical is None:
+                raise ValueError(f"Sentiment model '{name}' has label '{label}' that cannot be mapped to {', '.join(self.labels)}")
+            projection[index, self.labels.index(canonical)] = 1.0
+        return projection
+
+    @staticmethod
+    def _share_encoders(group: List[EnsembleMember]) -> List[Tuple[List[EnsembleMember], Any]]:
+        subgroups: List[List[EnsembleMember]] = []
+        for member in group:
+            if Config.SENTIMENT_BACKEND == 'torch':
+                match = next((subgroup for subgroup in subgroups
+                              if same_encoder(subgroup[0].sentiment_model, member.sentiment_model)), None)
+                if match is not None:
+                    match.append(member)
+                    continue
+            subgroups.append([member])
+        shared = []
+        for subgroup in subgroups:
+            encoder = None
+            if len(subgroup) > 1:
+                logging.info(f"Sharing one encoder between sentiment models {', '.join(member.name for member in subgroup)}")
+                encoder = share_encoder([member.sentiment_model.model for member in subgroup])
+            shared.append((subgroup, encoder))
+        return shared
+
+    @property
+    def tokenizer(self) -> Any:
+        return self.members[0].sentiment_model.tokenizer
+
+    @property
+    def id2label(self) -> Dict[int, str]:
+        return dict(enumerate(self.labels))
+
+    @staticmethod
+    def _score(member: EnsembleMember, inputs: Dict[str, Any]) -> np.ndarray:
+        import torch
+        _, model, device = member.sentiment_model
+
+        with torch.no_grad():
+            outputs = model(**{name: tensor.to(device) for name, tensor in inputs.items()})
+            probabilities = torch.softmax(outputs.logits, dim=1).cpu().numpy()
+        return probabilities if member.projection is None else probabilities @ member.projection
+
+    def _score_subgroup(self, members: List[EnsembleMember], encoder: Any, inputs: Dict[str, Any]) -> List[np.ndarray]:
+        with encoder.reuse() if encoder is not None else nullcontext():
+            return [self._score(member, inputs) for member in members]
+
+    def predict(self, texts: List[str]) -> np.ndarray:
+        """
+        Weighted ensemble class probabilities for each text
+        """
+        jobs = []
+        for subgroups in self.groups.values():
+            tokenizer = subgroups[0][0][0].sentiment_model.tokenizer
+            with stage('sentiment.tokenize'):
+                inputs = dict(tokenizer(texts, return_tensors='pt', padding=True, truncation=True, max_length=MAX_INPUT_TOKENS))
+            jobs.extend((members, encoder, inputs) for members, encoder in subgroups)
+
+        with stage('sentiment.inference'):
+            if self._executor is None:
+                scored = [self._score_subgroup(*jobs[0])]
+            else:
+                # torch and ONNX Runtime release the GIL while computing, so the models overlap
+                scored = list(self._executor.map(lambda job: self._score_subgroup(*job), jobs))
+        if len(self.members) == 1:
+            return scored[0][0]
+        members = [member for job in jobs for member in job[0]]
+        probabilities = [member_probabilities for subgroup in scored for member_probabilities in subgroup]
+        return sum(member.weight * member_probabilities for member, member_probabilities in zip(members, probabilities)) / self.total_weight
+
+
+def member_registry_name(model_name: str) -> str:
+    return f"sentiment:{model_name}"
+
+
+def load_sentiment_ensemble() -> SentimentEnsemble:
+    """
+    Load every model of SENTIMENT_ENSEMBLE (or SENTIMENT_MODEL alone) with the configured backend
+
+    Each model is its own registry entry, so its weights are loaded once per process
+    however many ensembles or tools use it.
+    """
+    return SentimentEnsemble([
+        (model_name, weight, registry.get(member_registry_name(model_name)))
+        for model_name, weight in parse_ensemble(Config.SENTIMENT_ENSEMBLE)
+    ])
+
+
+for _model_name, _ in parse_ensemble(Config.SENTIMENT_ENSEMBLE):
+    registry.register(member_registry_name(_model_name), partial(load_sentiment_model, model_name=_model_name))
+registry.register('sentiment', load_sentiment_ensemble)
 
 class SentimentAnalysisTool:
     """
     Sentiment analysis tool using Hugging Face transformers
     """
-    
+
+    @staticmethod
+    def _cache_key(text: str) -> str:
+        return make_cache_key('sentiment_analysis', [
+            Config.SENTIMENT_MODEL,
+            Config.SENTIMENT_ENSEMBLE,
+            Config.SENTIMENT_BACKEND,
+            Config.SENTIMENT_CHUNK_LONG_REVIEWS,
+            Config.SENTIMENT_SEGMENT_TOKENS,
+            Config.SENTIMENT_MAX_SEGMENTS,
+            text,
+        ])
+
+    def analyze_batch(self, texts: List[str]) -> List[Dict[str, Any]]:
+        """
+        Analyze sentiment of several texts in a single forward pass
+
+        Cached results are reused and only the remaining texts are sent to the model.
+
+        :param texts: Input texts to analyze
+        :return: List of sentiment analysis results, one per text
+        """
+        keys = [self._cache_key(text) for text in texts]
+        results = [result_cache.get(key) for key in keys]
+        missing = [index for index, result in enumerate(results) if result is None]
+        if missing:
+            computed = self._run_batch([texts[index] for index in missing])
+            for index, result in zip(missing, computed):
+                results[index] = result
+                if result['error'] is None:
+                    result_cache.set(keys[index], result)
+        return results
+
+    def _predict(self, texts: List[str]) -> np.ndarray:
+        """
+        Class probabilities for each text, in forward passes of at most SENTIMENT_MAX_BATCH_SIZE texts
+        """
+        ensemble = registry.get('sentiment')
+        return np.concatenate([
+            ensemble.predict(texts[offset:offset + Config.SENTIMENT_MAX_BATCH_SIZE])
+            for offset in range(0, len(texts), Config.SENTIMENT_MAX_BATCH_SIZE)
+        ])
+
+    @staticmethod
+    def _segments(tokenizer, text: str) -> List[Tuple[str, int]]:
+        """
+        Split a long review into segments of whole sentences
+
+        Segments hold up to SENTIMENT_SEGMENT_TOKENS tokens. Reviews with more than
+        SENTIMENT_MAX_SEGMENTS segments are sampled at evenly spaced positions, so the
+        work per review is bounded whatever its length.
+
+        :return: List of (segment text, token count) tuples
+        """
+        segment_tokens = min(MAX_INPUT_TOKENS - 2, Config.SENTIMENT_SEGMENT_TOKENS)
+        sentences = [sentence for sentence in SENTENCE_BOUNDARY.split(text.strip()) if sentence.strip()]
+        budget_chars = Config.SENTIMENT_MAX_SEGMENTS * segment_tokens * CHARS_PER_TOKEN
+        if len(text) > budget_chars:
+            # Far more text than can be scored: sample before tokenizing so the cost stays bounded
+            sentences = SentimentAnalysisTool._sample_sentences(sentences, Config.SENTIMENT_MAX_SEGMENTS, budget_chars)
+        counts = [len(ids) for ids in tokenizer(sentences, add_special_tokens=False)['input_ids']]
+
+        pieces = []
+        for sentence, count in zip(sentences, counts):
+            if count <= segment_tokens:
+                pieces.append((sentence, count))
+                continue
+            # A run-on sentence longer than a segment is cut into word windows
+            words = sentence.split()
+            window = max(1, len(words) * segment_tokens // count)
+            for start in range(0, len(words), window):
+                piece = words[start:start + window]
+                pieces.append((' '.join(piece), min(segment_tokens, -(-count * len(piece) // len(words)))))
+
+        segments = SentimentAnalysisTool._pack(pieces, segment_tokens)
+        if len(segments) > Config.SENTIMENT_MAX_SEGMENTS:
+            step = (len(segments) - 1) / (Config.SENTIMENT_MAX_SEGMENTS - 1) if Config.SENTIMENT_MAX_SEGMENTS > 1 else 1
+            kept = sorted({round(index * step) for index in range(Config.SENTIMENT_MAX_SEGMENTS)})
+            segments = [segments[index] for index in kept]
+        return segments
+
+    @staticmethod
+    def _pack(pieces: List[Tuple[str, int]], segment_tokens: int) -> List[Tuple[str, int]]:
+        """
+        Greedily join consecutive sentences into segments of at most `segment_tokens` tokens
+        """
+        segments, current, current_tokens = [], [], 0
+        for piece, count in pieces:
+            if current and current_tokens + count > segment_tokens:
+                segments.append((' '.join(current), current_tokens))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += count
+        if current:
+            segments.append((' '.join(current), current_tokens))
+        return segments
+
+    @staticmethod
+    def _sample_sentences(sentences: List[str], windows: int, budget_chars: int) -> List[str]:
+        """
+        Evenly spaced runs of consecutive sentences, `budget_chars` characters in total
+        """
+        window_chars = max(1, budget_chars // windows)
+        step = len(sentences) / windows
+        sampled = []
+        for window in range(windows):
+            index, taken = int(window * step), 0
+            while index < len(sentences) and taken < window_chars:
+                sentence = sentences[index][:window_chars - taken]
+                sampled.append(sentence)
+                taken += len(sentence) + 1
+                index += 1
+        return sampled
+
+    @staticmethod
+    def _aggregate(segments: List[Tuple[str, int]], probabilities: np.ndarray, id2label: Dict[int, str]) -> Tuple[int, float, Optional[str]]:
+        """
+        Combine segment scores into a review-level label, score and the most negative passages
+
+        Segment probabilities are averaged weighted by segment length.
+
+        :return: Tuple of label index, score and sentiment details
+        """
+        weights = np.array([count for _, count in segments], dtype=np.float64)
+        combined = (probabilities * weights[:, None]).sum(axis=0) / weights.sum()
+        sentiment_class = int(combined.argmax())
+
+        negative = next((index for index, label in id2label.items() if label.lower().startswith('neg')), None)
+        details = None
+        if negative is not None and Config.SENTIMENT_DETAIL_SEGMENTS > 0:
+            ranked = np.argsort(-probabilities[:, negative])[:Config.SENTIMENT_DETAIL_SEGMENTS]
+            quoted = [
+                f'"{textwrap.shorten(segments[index][0], DETAIL_QUOTE_CHARS)}" ({probabilities[index, negative]:.2f})'
+                for index in ranked if probabilities[index].argmax() == negative
+            ]
+            if quoted:
+                details = "Most negative passages: " + "; ".join(quoted)
+        return sentiment_class, float(combined[sentiment_class]), details
+
+    def _run_batch(self, texts: List[str]) -> List[Dict[str, Any]]:
+        """
+        Run the model on a batch of texts without consulting the cache
+
+        Texts that fit the model input are scored whole. With SENTIMENT_CHUNK_LONG_REVIEWS,
+        longer texts are split into segments that are scored in the same forward passes
+        instead of being truncated, and their details name the most negative segments.
+        """
+        try:
+            ensemble = registry.get('sentiment')
+            # Segments are sized with the first model's tokenizer, well within every model's input
+            tokenizer = ensemble.tokenizer
+
+            # Each text becomes one or more segments; spans map texts to their segments
+            segments, spans = [], []
+            token_counts = [0] * len(texts)
+            if Config.SENTIMENT_CHUNK_LONG_REVIEWS:
+                # Every word is at least one token, so reviews with more words than the
+                # model input are long without tokenizing them
+                token_counts = [len(text.split()) for text in texts]
+                short = [index for index, count in enumerate(token_counts) if count <= MAX_INPUT_TOKENS - 2]
+                if short:
+                    with stage('sentiment.tokenize'):
+                        encoded = tokenizer([texts[index] for index in short], add_special_tokens=False)['input_ids']
+                    for index, ids in zip(short, encoded):
+                        token_counts[index] = len(ids)
+            for text, token_count in zip(texts, token_counts):
+                start = len(segments)
+                if token_count > MAX_INPUT_TOKENS - 2:
+                    segments.extend(self._segments(tokenizer, text))
+                else:
+                    segments.append((text, token_count))
+                spans.append((start, len(segments)))
+
+            probabilities = self._predict([segment for segment, _ in segments])
+
+            # Get results
+            results = []
+            for text, (start, end) in zip(texts, spans):
+                if end - start == 1:
+                    sentiment_class = int(probabilities[start].argmax())
+                    score, details = float(probabilities[start][sentiment_class]), None
+                else:
+                    increment('sentiment_segmented_reviews')
+                    sentiment_class, score, details = self._aggregate(
+                        segments[start:end], probabilities[start:end], ensemble.id2label
+                    )
+                results.append({
+                    'text': text,
+                    'sentiment_label': ensemble.labels[sentiment_class],
+                    'sentiment_score': score,
+                    'sentiment_details': details,
+                    'error': None
+                })
+            return results
+        except Exception as e:
+            record_error('sentiment_analysis', str(e))
+            return [
+                {
+                    'text': text,
+                    'sentiment_label': None,
+                    'sentiment_score': None,
+                    'sentiment_details': None,
+                    'error': str(e)
+                }
+                for text in texts
+            ]
+
     def analyze_sentiment(self, text: str) -> Dict[str, Any]:
         """
         Analyze sentiment of given text
-        
+
+        When micro-batching is enabled, concurrent calls are merged into one forward pass.
+
         :param text: Input text to analyze
         :return: Dictionary with sentiment analysis results
         """
-        try:
-            # Tokenize and prepare input
-            inputs = tokenizer(text, return_tensors='pt', 
-                                    truncation=True, 
-                                    max_length=512).to(self.device)
-            
-            # Perform inference
-            with torch.no_grad():
-                outputs = model(**inputs)
-                probabilities = torch.softmax(outputs.logits, dim=1)
-                
-            # Get results
-            sentiment_scores = probabilities.cpu().numpy()
-            sentiment_class = sentiment_scores.argmax()
-            label_mapping = model.config.id2label[sentiment_class]
-            
-            return {
-                'text': text,
-                'sentiment_label': label_mapping,
-                'sentiment_score': sentiment_scores[sentiment_class],
-                'error': None
-            }
-        except Exception as e:
-            return {
-                'text': text,
-                'sentiment_label': None,
-                'sentiment_score': None,
-                'error': str(e)
-            }
+        with stage('sentiment_analysis'):
+            key = self._cache_key(text)
+            cached = result_cache.get(key)
+            if cached is not None:
+                return cached
+
+            if Config.SENTIMENT_MICRO_BATCHING:
+                result = batcher(text)
+            else:
+                result = self._run_batch([text])[0]
+            if result['error'] is None:
+                result_cache.set(key, result)
+            return result
+
+
+batcher = MicroBatcher(
+    SentimentAnalysisTool()._run_batch,
+    max_batch_size=Config.SENTIMENT_MAX_BATCH_SIZE,
+    max_wait_ms=Config.SENTIMENT_MAX_WAIT_MS,
+    name="sentiment-batcher"
+)
+os.register_at_fork(after_in_child=batcher.after_fork)
 
 
 if __name__ == "__main__":
     # Example usage
     tool = SentimentAnalysisTool()
     result = tool.analyze_sentiment("I love the new design of your website!")
-    print(result)
\ No newline at end of file
+    print(result)
@@ -0,0 +1,93 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Tuple
+
+
+class MicroBatcher:
+    """
+    Groups concurrent single-item requests into dynamic batches.
+
+    Callers submit items from any thread and receive a Future. A background thread
+    waits for the first item, keeps collecting until either `max_batch_size` items
+    are queued or `max_wait_ms` has elapsed since that first item arrived, runs
+    `process_batch` once on the whole batch and scatters the results back.
+    """
+
+    def __init__(
+            self,
+            process_batch: Callable[[List[Any]], List[Any]],
+            max_batch_size: int = 32,
+            max_wait_ms: float = 5.0,
+            name: str = "micro-batcher"
+        ):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.name = name
+        self._queue: "queue.Queue[Tuple[Any, Future]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, item: Any) -> Future:
+        """
+        Queue an item for the next batch
+
+        :param item: Input item
+        :return: Future resolved with the result for this item
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item: Any) -> Any:
+        return self.submit(item).result()
+
+    def after_fork(self) -> None:
+        """
+        Forget the parent's batching thread, which does not exist in a forked child
+        """
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _collect(self) -> List[Tuple[Any, Future]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            try:
+                results = self.process_batch(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"{self.name} returned {len(results)} results for {len(items)} items")
+            except Exception as e:
+                logging.error(f"{self.name} batch of {len(items)} failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,184 @@
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+from smart_claims.utils.config import Config
+from smart_claims.utils.instrumentation import increment
+
+
+def make_cache_key(namespace: str, parts: Iterable[Any] = (), files: Iterable[str] = ()) -> str:
+    """
+    Build a content-addressed cache key
+
+    :param namespace: Kind of result being cached, e.g. 'image_analysis'
+    :param parts: JSON-serializable values that affect the result (model, prompt version, ...)
+    :param files: Paths whose bytes affect the result
+    :return: Hex digest identifying the result
+    """
+    digest = hashlib.sha256(namespace.encode('utf-8'))
+    digest.update(json.dumps(list(parts), sort_keys=True, default=str).encode('utf-8'))
+    for path in files:
+        file_digest = hashlib.sha256()
+        with open(path, 'rb') as data:
+            for chunk in iter(lambda: data.read(1 << 20), b''):
+                file_digest.update(chunk)
+        digest.update(file_digest.digest())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Base class for analysis result caches.
+
+    Values must be JSON-serializable dictionaries. Subclasses implement `_get` and
+    `_set`; hit and miss counters are kept here.
+    """
+
+    def __init__(self, ttl_seconds: Optional[float] = None):
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        increment('cache_misses' if value is None else 'cache_hits')
+        return value
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        self._set(key, value)
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def after_fork(self) -> None:
+        """
+        Drop state that must not be shared with a forked child, called in the child
+        """
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - stored_at > self.ttl_seconds
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+
+class NullCache(ResultCache):
+    """
+    Cache that never stores anything
+    """
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        return None
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        pass
+
+
+class LRUCache(ResultCache):
+    """
+    In-memory least-recently-used cache with an optional TTL
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: Optional[float] = None):
+        super().__init__(ttl_seconds)
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if self._expired(stored_at):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return copy.deepcopy(value)
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), copy.deepcopy(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteCache(ResultCache):
+    """
+    On-disk cache backed by SQLite, shared between processes using the same file
+    """
+
+    def __init__(self, path: str, ttl_seconds: Optional[float] = None):
+        super().__init__(ttl_seconds)
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)"
+            )
+
+    def after_fork(self) -> None:
+        # Connections opened before fork() belong to the parent process
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute(
+            "SELECT value, stored_at FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or self._expired(row[1]):
+            return None
+        return json.loads(row[0])
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO results (key, value, stored_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, default=str), time.time())
+            )
+
+
+def create_cache(backend: str = Config.CACHE_BACKEND) -> ResultCache:
+    """
+    Create a result cache from configuration
+
+    :param backend: One of 'memory', 'sqlite' or 'none'
+    :return: Result cache instance
+    """
+    ttl = Config.CACHE_TTL_SECONDS or None
+    if backend == 'memory':
+        return LRUCache(max_entries=Config.CACHE_MAX_ENTRIES, ttl_seconds=ttl)
+    if backend == 'sqlite':
+        return SQLiteCache(Config.CACHE_PATH, ttl_seconds=ttl)
+    if backend == 'none':
+        return NullCache()
+    raise ValueError(f"Unknown cache backend '{backend}'")
+
+
+result_cache = create_cache()
+os.register_at_fork(after_in_child=result_cache.after_fork)
@@ -0,0 +1,410 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from smart_claims.utils.config import Config
+from smart_claims.utils.cache import make_cache_key
+from smart_claims.utils.data_models import RefundClaim
+
+ClaimRecord = Tuple[Union[RefundClaim, Dict[str, Any]], Optional[Dict[str, Any]]]
+
+# Claims waiting for a worker, and claims a worker is running
+QUEUED_STATUSES = ("Pending", "Processing")
+
+# Decisions in these states are not final and are never reused
+UNDECIDED_STATUSES = QUEUED_STATUSES + ("Not Successfully Processed", "Invalid")
+
+# Columns that can be filtered on, all of them indexed
+FILTER_COLUMNS = ('customer_id', 'order_id', 'product_id', 'status')
+
+
+def claim_fingerprint(claim: Union[RefundClaim, Dict[str, Any]]) -> str:
+    """
+    Identify a claim by the inputs that determine its decision
+
+    Two submissions with the same fingerprint get the same decision, so a stored
+    decision can be reused instead of reprocessing the claim.
+
+    :param claim: RefundClaim or claim dictionary
+    :return: Hex digest of the claim inputs
+    """
+    data = claim.model_dump() if isinstance(claim, RefundClaim) else claim
+    return make_cache_key('claim', [
+        str(data.get('customer_id')),
+        str(data.get('order_id')),
+        str(data.get('product_id')),
+        data.get('claim_date'),
+        data.get('order_date'),
+        float(data.get('product_cost') or 0),
+        data.get('product_review'),
+        list(data.get('product_images') or []),
+    ])
+
+
+class ClaimStore:
+    """
+    Base class for claim storage.
+
+    Stores each claim with its final decision and the raw output of every stage
+    (sentiment, image analysis, refund estimation). Subclasses implement
+    `bulk_upsert` and the query methods.
+    """
+
+    def save(self, claim: Union[RefundClaim, Dict[str, Any]], stage_outputs: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Insert or update one claim
+
+        :param claim: RefundClaim or claim dictionary with a claim_id
+        :param stage_outputs: Mapping of stage name to its output, replacing every stored
+            stage output of the claim; None keeps the stored ones
+        """
+        self.bulk_upsert([(claim, stage_outputs)])
+
+    def after_fork(self) -> None:
+        """
+        Drop state that must not be shared with a forked child, called in the child
+        """
+
+    def bulk_upsert(self, records: Iterable[ClaimRecord]) -> int:
+        """
+        Insert or update many claims in one transaction
+
+        :param records: (claim, stage outputs) tuples; stage outputs replace the claim's
+            stored ones unless they are None
+        :return: Number of claims written
+        """
+        raise NotImplementedError
+
+    def get(self, claim_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def stage_outputs(self, claim_id: str) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def find(self, limit: Optional[int] = None, **filters) -> List[Dict[str, Any]]:
+        """
+        Look up claims by customer_id, order_id, product_id, status and claim date range
+
+        :param limit: Maximum number of claims to return
+        :param filters: Column filters plus optional claim_date_from / claim_date_to (YYYY-MM-DD)
+        :return: Matching claims, oldest claim date first
+        """
+        return list(self.iter_claims(limit=limit, **filters))
+
+    def iter_claims(self, batch_size: int = 1000, limit: Optional[int] = None, **filters) -> Iterator[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def find_duplicates(self, claim: Union[RefundClaim, Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Other claims filed by the same customer for the same order and product
+        """
+        data = claim.model_dump() if isinstance(claim, RefundClaim) else claim
+        return [
+            existing for existing in self.find(
+                customer_id=str(data['customer_id']),
+                order_id=str(data['order_id']),
+                product_id=str(data['product_id'])
+            )
+            if existing.get('claim_id') != data.get('claim_id')
+        ]
+
+    def find_decided(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """
+        Most recent final decision for a claim with the given fingerprint
+        """
+        raise NotImplementedError
+
+    def count(self, **filters) -> int:
+        raise NotImplementedError
+
+    def lease_pending(self, limit: int = 1, lease_seconds: float = Config.JOB_LEASE_SECONDS) -> List[Dict[str, Any]]:
+        """
+        Atomically move pending claims to 'Processing' so exactly one worker runs each
+
+        Claims left in 'Processing' for longer than `lease_seconds` (their worker died)
+        are leased again.
+
+        :param limit: Maximum number of claims to lease
+        :param lease_seconds: Time after which an unfinished claim is handed to another worker
+        :return: Leased claims, oldest first
+        """
+        raise NotImplementedError
+
+    def renew_lease(self, claim_id: str) -> bool:
+        """
+        Restart the lease of a claim that is still being processed
+
+        :param claim_id: Leased claim
+        :return: False when the claim is no longer 'Processing'
+        """
+        raise NotImplementedError
+
+
+class NullClaimStore(ClaimStore):
+    """
+    Store that keeps nothing
+    """
+
+    def bulk_upsert(self, records: Iterable[ClaimRecord]) -> int:
+        return 0
+
+    def get(self, claim_id: str) -> Optional[Dict[str, Any]]:
+        return None
+
+    def stage_outputs(self, claim_id: str) -> Dict[str, Any]:
+        return {}
+
+    def iter_claims(self, batch_size: int = 1000, limit: Optional[int] = None, **filters) -> Iterator[Dict[str, Any]]:
+        return iter(())
+
+    def find_decided(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        return None
+
+    def count(self, **filters) -> int:
+        return 0
+
+
+class SQLiteClaimStore(ClaimStore):
+    """
+    Claim store backed by SQLite, with indexes on every lookup column
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS claims (
+                    claim_id TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    customer_id TEXT NOT NULL,
+                    order_id TEXT NOT NULL,
+                    product_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    claim_date TEXT NOT NULL,
+                    refund_amount REAL,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_claims_customer_id ON claims (customer_id);
+                CREATE INDEX IF NOT EXISTS idx_claims_order_id ON claims (order_id);
+                CREATE INDEX IF NOT EXISTS idx_claims_product_id ON claims (product_id);
+                CREATE INDEX IF NOT EXISTS idx_claims_status ON claims (status);
+                CREATE INDEX IF NOT EXISTS idx_claims_claim_date ON claims (claim_date);
+                CREATE INDEX IF NOT EXISTS idx_claims_fingerprint ON claims (fingerprint);
+                CREATE TABLE IF NOT EXISTS stage_outputs (
+                    claim_id TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    output TEXT NOT NULL,
+                    recorded_at REAL NOT NULL,
+                    PRIMARY KEY (claim_id, stage)
+                );
+                """
+            )
+
+    def after_fork(self) -> None:
+        # Connections opened before fork() belong to the parent process
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def bulk_upsert(self, records: Iterable[ClaimRecord]) -> int:
+        now = time.time()
+        claim_rows = []
+        stage_rows = []
+        # Claims whose stage set is replaced, so stages that did not run this time
+        # (e.g. refund_estimation of an amended claim that is now rejected) are dropped
+        replaced = []
+        for claim, stage_outputs in records:
+            data = claim.model_dump() if isinstance(claim, RefundClaim) else dict(claim)
+            claim_rows.append((
+                data['claim_id'],
+                claim_fingerprint(data),
+                str(data['customer_id']),
+                str(data['order_id']),
+                str(data['product_id']),
+                data.get('refund_status') or "Pending",
+                data['claim_date'],
+                data.get('refund_amount'),
+                json.dumps(data, default=str),
+                now,
+            ))
+            if stage_outputs is not None:
+                replaced.append((data['claim_id'],))
+            for stage_name, output in (stage_outputs or {}).items():
+                if output is not None:
+                    stage_rows.append((data['claim_id'], stage_name, json.dumps(output, default=str), now))
+
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT INTO claims (claim_id, fingerprint, customer_id, order_id, product_id, status, "
+                "claim_date, refund_amount, data, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (claim_id) DO UPDATE SET fingerprint = excluded.fingerprint, "
+                "customer_id = excluded.customer_id, order_id = excluded.order_id, "
+                "product_id = excluded.product_id, status = excluded.status, "
+                "claim_date = excluded.claim_date, refund_amount = excluded.refund_amount, "
+                "data = excluded.data, updated_at = excluded.updated_at",
+                claim_rows
+            )
+            connection.executemany("DELETE FROM stage_outputs WHERE claim_id = ?", replaced)
+            connection.executemany(
+                "INSERT OR REPLACE INTO stage_outputs (claim_id, stage, output, recorded_at) VALUES (?, ?, ?, ?)",
+                stage_rows
+            )
+        return len(claim_rows)
+
+    def get(self, claim_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute("SELECT data FROM claims WHERE claim_id = ?", (claim_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def stage_outputs(self, claim_id: str) -> Dict[str, Any]:
+        rows = self._connection().execute(
+            "SELECT stage, output FROM stage_outputs WHERE claim_id = ?", (claim_id,)
+        ).fetchall()
+        return {stage_name: json.loads(output) for stage_name, output in rows}
+
+    @staticmethod
+    def _where(filters: Dict[str, Any]) -> Tuple[str, List[Any]]:
+        clauses, params = [], []
+        for column, value in filters.items():
+            if column in FILTER_COLUMNS:
+                clauses.append(f"{column} = ?")
+                params.append(str(value))
+            elif column == 'claim_date_from':
+                clauses.append("claim_date >= ?")
+                params.append(value)
+            elif column == 'claim_date_to':
+                clauses.append("claim_date <= ?")
+                params.append(value)
+            else:
+                raise ValueError(f"Unknown claim filter '{column}'")
+        return " AND ".join(clauses), params
+
+    def iter_claims(self, batch_size: int = 1000, limit: Optional[int] = None, **filters) -> Iterator[Dict[str, Any]]:
+        """
+        Stream claims page by page without holding a read transaction open between pages
+
+        :param batch_size: Claims fetched per query
+        :param limit: Maximum number of claims to return
+        :param filters: Same filters as `find`
+        :return: Iterator over claim dictionaries ordered by claim date
+        """
+        where, params = self._where(filters)
+        last = ('', -1)
+        returned = 0
+        while limit is None or returned < limit:
+            page_size = batch_size if limit is None else min(batch_size, limit - returned)
+            # Keyset pagination on (claim_date, rowid) so every page is an index range scan
+            conditions = [where] if where else []
+            conditions.append("(claim_date > ? OR (claim_date = ? AND rowid > ?))")
+            rows = self._connection().execute(
+                f"SELECT claim_date, rowid, data FROM claims WHERE {' AND '.join(conditions)} "
+                f"ORDER BY claim_date, rowid LIMIT ?",
+                params + [last[0], last[0], last[1], page_size]
+            ).fetchall()
+            if not rows:
+                return
+            for claim_date, rowid, data in rows:
+                yield json.loads(data)
+            returned += len(rows)
+            last = (rows[-1][0], rows[-1][1])
+
+    def find_decided(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        placeholders = ", ".join("?" for _ in UNDECIDED_STATUSES)
+        row = self._connection().execute(
+            f"SELECT data FROM claims WHERE fingerprint = ? AND status NOT IN ({placeholders}) "
+            f"ORDER BY updated_at DESC LIMIT 1",
+            (fingerprint, *UNDECIDED_STATUSES)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def count(self, **filters) -> int:
+        where, params = self._where(filters)
+        query = "SELECT COUNT(*) FROM claims" + (f" WHERE {where}" if where else "")
+        return self._connection().execute(query, params).fetchone()[0]
+
+    def lease_pending(self, limit: int = 1, lease_seconds: float = Config.JOB_LEASE_SECONDS) -> List[Dict[str, Any]]:
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            # Take the write lock before reading so two workers never lease the same claim
+            connection.execute("BEGIN IMMEDIATE")
+            rows = connection.execute(
+                "SELECT data FROM claims WHERE status = 'Pending' OR (status = 'Processing' AND updated_at < ?) "
+                "ORDER BY updated_at LIMIT ?",
+                (now - lease_seconds, limit)
+            ).fetchall()
+            leased = []
+            for (data,) in rows:
+                claim = json.loads(data)
+                claim['refund_status'] = "Processing"
+                leased.append(claim)
+            connection.executemany(
+                "UPDATE claims SET status = 'Processing', data = ?, updated_at = ? WHERE claim_id = ?",
+                [(json.dumps(claim, default=str), now, claim['claim_id']) for claim in leased]
+            )
+        return leased
+
+    def renew_lease(self, claim_id: str) -> bool:
+        connection = self._connection()
+        with connection:
+            cursor = connection.execute(
+                "UPDATE claims SET updated_at = ? WHERE claim_id = ? AND status = 'Processing'",
+                (time.time(), claim_id)
+            )
+        return cursor.rowcount > 0
+
+
+def create_claim_store(backend: str = Config.CLAIM_STORE_BACKEND) -> ClaimStore:
+    """
+    Create a claim store from configuration
+
+    :param backend: One of 'sqlite' or 'none'
+    :return: Claim store instance
+    """
+    if backend == 'sqlite':
+        return SQLiteClaimStore(Config.CLAIM_STORE_PATH)
+    if backend == 'none':
+        return NullClaimStore()
+    raise ValueError(f"Unknown claim store backend '{backend}'")
+
+
+_claim_store: Optional[ClaimStore] = None
+_claim_store_lock = threading.Lock()
+
+
+def get_claim_store() -> ClaimStore:
+    """
+    Process-wide claim store, opened on first use
+
+    Importing the flow, the tools or the offline runner therefore creates no database.
+
+    :return: Claim store instance
+    """
+    global _claim_store
+    if _claim_store is None:
+        with _claim_store_lock:
+            if _claim_store is None:
+                _claim_store = create_claim_store()
+    return _claim_store
+
+
+def _after_fork() -> None:
+    global _claim_store_lock
+    _claim_store_lock = threading.Lock()
+    if _claim_store is not None:
+        _claim_store.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
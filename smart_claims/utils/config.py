@@ -24,4 +24,171 @@ class Config:
     REFUND_ESTIMATION_MODEL = os.getenv(
         'REFUND_ESTIMATION_MODEL', 
         'gpt-4o'
-    )
\ No newline at end of file
+    )
+    
+    # Batch Processing Configuration
+    BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))
+    BATCH_PROGRESS_INTERVAL = int(os.getenv('BATCH_PROGRESS_INTERVAL', '100'))
+    
+    # Sentiment Inference Configuration
+    SENTIMENT_MICRO_BATCHING = os.getenv('SENTIMENT_MICRO_BATCHING', 'true').lower() == 'true'
+    SENTIMENT_MAX_BATCH_SIZE = int(os.getenv('SENTIMENT_MAX_BATCH_SIZE', '32'))
+    SENTIMENT_MAX_WAIT_MS = float(os.getenv('SENTIMENT_MAX_WAIT_MS', '5'))
+    # 'torch', 'int8' (PyTorch dynamic int8 quantization, CPU), 'onnx' or 'onnx-int8' (ONNX Runtime, CPU)
+    SENTIMENT_BACKEND = os.getenv('SENTIMENT_BACKEND', 'torch')
+    # Comma-separated model=weight pairs scored together and averaged, e.g.
+    # "ProsusAI/finbert=1,cardiffnlp/twitter-roberta-base-sentiment-latest=2"; empty uses SENTIMENT_MODEL alone
+    SENTIMENT_ENSEMBLE = os.getenv('SENTIMENT_ENSEMBLE', '')
+    # Exported ONNX models are written here on first load and reused afterwards
+    SENTIMENT_ONNX_DIR = os.getenv('SENTIMENT_ONNX_DIR', 'onnx_models')
+    # CPU threads used by the int8 and ONNX backends, 0 keeps the runtime default
+    SENTIMENT_NUM_THREADS = int(os.getenv('SENTIMENT_NUM_THREADS', '0'))
+    # Reviews longer than the model input are split into segments scored in one batch
+    SENTIMENT_CHUNK_LONG_REVIEWS = os.getenv('SENTIMENT_CHUNK_LONG_REVIEWS', 'true').lower() == 'true'
+    SENTIMENT_SEGMENT_TOKENS = int(os.getenv('SENTIMENT_SEGMENT_TOKENS', '96'))
+    # Bounds the work per review; longer reviews are sampled at evenly spaced segments
+    SENTIMENT_MAX_SEGMENTS = int(os.getenv('SENTIMENT_MAX_SEGMENTS', '32'))
+    # Most negative segments quoted in sentiment_details
+    SENTIMENT_DETAIL_SEGMENTS = int(os.getenv('SENTIMENT_DETAIL_SEGMENTS', '3'))
+    
+    # Result Cache Configuration
+    CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory')
+    CACHE_PATH = os.getenv('CACHE_PATH', 'smart_claims_cache.sqlite')
+    CACHE_TTL_SECONDS = float(os.getenv('CACHE_TTL_SECONDS', '86400'))
+    CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '10000'))
+    # Bump when prompts change so cached analyses from older prompts are not reused
+    PROMPT_VERSION = os.getenv('PROMPT_VERSION', '2')
+    
+    # Image Preprocessing Configuration
+    IMAGE_DETAIL = os.getenv('IMAGE_DETAIL', 'low')
+    # Overrides the per-model resolution limit when set
+    IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', '0'))
+    LOCAL_VLM_IMAGE_MAX_SIDE = int(os.getenv('LOCAL_VLM_IMAGE_MAX_SIDE', '1344'))
+    IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '85'))
+    IMAGE_DEDUPE_DISTANCE = int(os.getenv('IMAGE_DEDUPE_DISTANCE', '4'))
+    # Larger files are rejected before any model call
+    IMAGE_MAX_FILE_BYTES = int(os.getenv('IMAGE_MAX_FILE_BYTES', str(20 * 1024 * 1024)))
+    # Encoded image bytes all in-flight vision requests may hold; requests wait for room, 0 disables
+    IMAGE_INFLIGHT_BUDGET_BYTES = int(os.getenv('IMAGE_INFLIGHT_BUDGET_BYTES', str(256 * 1024 * 1024)))
+    # Bytes read and base64 encoded per step when building an upload
+    IMAGE_ENCODE_CHUNK_BYTES = int(os.getenv('IMAGE_ENCODE_CHUNK_BYTES', str(64 * 1024)))
+    
+    # Local Vision Model Configuration (used when IMAGE_ANALYSIS_MODEL is not an OpenAI model)
+    LOCAL_VLM_MODEL = os.getenv('LOCAL_VLM_MODEL', 'microsoft/Phi-3.5-vision-instruct')
+    LOCAL_VLM_DEVICE = os.getenv('LOCAL_VLM_DEVICE', 'auto')
+    LOCAL_VLM_QUANTIZATION = os.getenv('LOCAL_VLM_QUANTIZATION', '4bit')
+    LOCAL_VLM_NUM_CROPS = int(os.getenv('LOCAL_VLM_NUM_CROPS', '4'))
+    LOCAL_VLM_MAX_NEW_TOKENS = int(os.getenv('LOCAL_VLM_MAX_NEW_TOKENS', '256'))
+    LOCAL_VLM_BATCH_SIZE = int(os.getenv('LOCAL_VLM_BATCH_SIZE', '4'))
+    LOCAL_VLM_MAX_WAIT_MS = float(os.getenv('LOCAL_VLM_MAX_WAIT_MS', '50'))
+    
+    # Refund Rules Configuration (clear-cut claims are decided without the LLM)
+    REFUND_RULES_ENABLED = os.getenv('REFUND_RULES_ENABLED', 'true').lower() == 'true'
+    REFUND_RULES_NO_DEFECT_MAX_SCORE = float(os.getenv('REFUND_RULES_NO_DEFECT_MAX_SCORE', '0.05'))
+    REFUND_RULES_SEVERE_DEFECT_MIN_SCORE = float(os.getenv('REFUND_RULES_SEVERE_DEFECT_MIN_SCORE', '0.8'))
+    REFUND_RULES_LOW_COST_MAX = float(os.getenv('REFUND_RULES_LOW_COST_MAX', '50'))
+    REFUND_RULES_MIN_SENTIMENT_CONFIDENCE = float(os.getenv('REFUND_RULES_MIN_SENTIMENT_CONFIDENCE', '0.6'))
+    # Moderate defects on a low cost item with a confidently negative review get a partial
+    # refund, scaled linearly from the min to the max fraction of the product cost as the
+    # defect score rises from REFUND_RULES_PARTIAL_MIN_SCORE to the severe defect score
+    REFUND_RULES_PARTIAL_ENABLED = os.getenv('REFUND_RULES_PARTIAL_ENABLED', 'true').lower() == 'true'
+    REFUND_RULES_PARTIAL_MIN_SCORE = float(os.getenv('REFUND_RULES_PARTIAL_MIN_SCORE', '0.4'))
+    REFUND_RULES_PARTIAL_MIN_FRACTION = float(os.getenv('REFUND_RULES_PARTIAL_MIN_FRACTION', '0.25'))
+    REFUND_RULES_PARTIAL_MAX_FRACTION = float(os.getenv('REFUND_RULES_PARTIAL_MAX_FRACTION', '0.75'))
+    
+    # Speculative Refund Estimation Configuration
+    # Start the refund estimate as soon as the review is scored, assuming a defect score for
+    # its sentiment, and keep it if the image analysis lands close to that assumption
+    REFUND_SPECULATION_ENABLED = os.getenv('REFUND_SPECULATION_ENABLED', 'false').lower() == 'true'
+    # Defect score assumed for each sentiment label, e.g. "negative=0.7,neutral=0.4,positive=0.1"
+    REFUND_SPECULATION_DEFECT_PRIORS = os.getenv('REFUND_SPECULATION_DEFECT_PRIORS', 'negative=0.7,neutral=0.4,positive=0.1')
+    # Largest difference between assumed and actual defect score for which the speculative estimate is kept
+    REFUND_SPECULATION_MAX_DEFECT_DIFF = float(os.getenv('REFUND_SPECULATION_MAX_DEFECT_DIFF', '0.2'))
+    
+    # OpenAI Client Configuration
+    # Set to a local stub server (e.g. http://127.0.0.1:8100/v1) for offline testing
+    OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL')
+    OPENAI_TIMEOUT_SECONDS = float(os.getenv('OPENAI_TIMEOUT_SECONDS', '60'))
+    OPENAI_DEADLINE_SECONDS = float(os.getenv('OPENAI_DEADLINE_SECONDS', '180'))
+    OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '5'))
+    OPENAI_BACKOFF_BASE_SECONDS = float(os.getenv('OPENAI_BACKOFF_BASE_SECONDS', '0.5'))
+    OPENAI_BACKOFF_MAX_SECONDS = float(os.getenv('OPENAI_BACKOFF_MAX_SECONDS', '30'))
+    OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '100'))
+    # Per-model budgets as model=requests_per_minute:tokens_per_minute, comma separated
+    OPENAI_RATE_LIMITS = os.getenv('OPENAI_RATE_LIMITS', '')
+    
+    # Offline Batch Configuration (OpenAI Batch API for non-urgent backlogs)
+    OFFLINE_BATCH_DIR = os.getenv('OFFLINE_BATCH_DIR', 'offline_batches')
+    OFFLINE_BATCH_POLL_SECONDS = float(os.getenv('OFFLINE_BATCH_POLL_SECONDS', '60'))
+    OFFLINE_BATCH_COMPLETION_WINDOW = os.getenv('OFFLINE_BATCH_COMPLETION_WINDOW', '24h')
+    # Batch API limits per input file
+    OFFLINE_BATCH_MAX_REQUESTS = int(os.getenv('OFFLINE_BATCH_MAX_REQUESTS', '50000'))
+    OFFLINE_BATCH_MAX_FILE_BYTES = int(os.getenv('OFFLINE_BATCH_MAX_FILE_BYTES', str(190 * 1024 * 1024)))
+    
+    # Claim Store Configuration
+    # 'sqlite' persists claims, stage outputs and decisions, 'none' disables persistence
+    CLAIM_STORE_BACKEND = os.getenv('CLAIM_STORE_BACKEND', 'sqlite')
+    CLAIM_STORE_PATH = os.getenv('CLAIM_STORE_PATH', 'smart_claims_claims.sqlite')
+    # Reuse the stored decision when an identical claim is submitted again
+    CLAIM_STORE_REUSE_DECISIONS = os.getenv('CLAIM_STORE_REUSE_DECISIONS', 'true').lower() == 'true'
+    # A claim resubmitted under its id (an amended review, an added photo) reuses the
+    # stored output of every stage whose inputs did not change
+    CLAIM_INCREMENTAL_REEVALUATION = os.getenv('CLAIM_INCREMENTAL_REEVALUATION', 'true').lower() == 'true'
+    # Claims written per transaction by batch runs
+    CLAIM_STORE_BULK_SIZE = int(os.getenv('CLAIM_STORE_BULK_SIZE', '200'))
+    
+    # Fraud Screening Configuration (near-duplicate images and reviews across claims)
+    FRAUD_SCREENING_ENABLED = os.getenv('FRAUD_SCREENING_ENABLED', 'true').lower() == 'true'
+    # 'sqlite' keeps the index across runs, 'memory' keeps it for the life of the process
+    FRAUD_INDEX_BACKEND = os.getenv('FRAUD_INDEX_BACKEND', 'sqlite')
+    FRAUD_INDEX_PATH = os.getenv('FRAUD_INDEX_PATH', 'smart_claims_fraud.sqlite')
+    # Largest perceptual hash distance between images treated as the same photo
+    FRAUD_IMAGE_MAX_DISTANCE = int(os.getenv('FRAUD_IMAGE_MAX_DISTANCE', '3'))
+    # Reviews with Jaccard similarity s share a band with probability 1 - (1 - s^r)^b,
+    # for b bands of r = permutations / b rows. 16 bands of 4 rows find 0.9998 of the
+    # pairs at 0.8 (8 bands of 8 rows found 0.77) at the cost of more candidates, 0.64
+    # of the pairs at 0.5 and 0.89 at 0.6. Candidates are then checked against
+    # FRAUD_REVIEW_MIN_SIMILARITY, so extra candidates cost lookup time, not false flags
+    FRAUD_MINHASH_PERMUTATIONS = int(os.getenv('FRAUD_MINHASH_PERMUTATIONS', '64'))
+    FRAUD_MINHASH_BANDS = int(os.getenv('FRAUD_MINHASH_BANDS', '16'))
+    # Smallest estimated Jaccard similarity between reviews treated as copied text
+    FRAUD_REVIEW_MIN_SIMILARITY = float(os.getenv('FRAUD_REVIEW_MIN_SIMILARITY', '0.8'))
+    # Shorter reviews ("Broken on arrival") are too common to be evidence of copying
+    FRAUD_REVIEW_MIN_WORDS = int(os.getenv('FRAUD_REVIEW_MIN_WORDS', '8'))
+    
+    # Claim API and Job Queue Configuration
+    API_HOST = os.getenv('API_HOST', '127.0.0.1')
+    API_PORT = int(os.getenv('API_PORT', '8000'))
+    # Base URL the Gradio UI submits claims to
+    API_URL = os.getenv('API_URL', f"http://127.0.0.1:{API_PORT}")
+    # Worker threads started inside the API process; set to 0 and run
+    # `python -m smart_claims.job_queue` to scale workers separately
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+    JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', '0.5'))
+    # Workers renew the lease of the claim they run every third of this time; a claim
+    # whose lease was not renewed for this long (its worker died) goes to another worker
+    JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '600'))
+    # Worker processes forked by `python -m smart_claims.job_queue` after the models are
+    # loaded, so they share one copy of the weights; 0 runs the workers as threads only
+    JOB_PROCESSES = int(os.getenv('JOB_PROCESSES', '0'))
+    # torch intra-op threads per worker process, 0 divides the cores between the processes
+    JOB_TORCH_THREADS = int(os.getenv('JOB_TORCH_THREADS', '0'))
+    UI_POLL_SECONDS = float(os.getenv('UI_POLL_SECONDS', '1'))
+    UI_RESULT_TIMEOUT_SECONDS = float(os.getenv('UI_RESULT_TIMEOUT_SECONDS', '120'))
+    
+    # Prompt Budget Configuration
+    # Largest estimated prompt per request in tokens, images included; long reviews and
+    # descriptions are shortened to fit, 0 disables
+    IMAGE_PROMPT_MAX_TOKENS = int(os.getenv('IMAGE_PROMPT_MAX_TOKENS', '2000'))
+    REFUND_PROMPT_MAX_TOKENS = int(os.getenv('REFUND_PROMPT_MAX_TOKENS', '1200'))
+    # Shortened fields keep at least this many tokens
+    PROMPT_MIN_FIELD_TOKENS = int(os.getenv('PROMPT_MIN_FIELD_TOKENS', '64'))
+    # Completion token caps per request
+    IMAGE_ANALYSIS_MAX_COMPLETION_TOKENS = int(os.getenv('IMAGE_ANALYSIS_MAX_COMPLETION_TOKENS', '300'))
+    REFUND_MAX_COMPLETION_TOKENS = int(os.getenv('REFUND_MAX_COMPLETION_TOKENS', '300'))
+    
+    # Structured Output Configuration
+    # Model output that does not fit its schema is repaired locally (code fences, prose,
+    # truncated JSON, "$17.80" amounts); if that fails the request is sent once more with
+    # a constrained prompt
+    STRUCTURED_OUTPUT_RETRY = os.getenv('STRUCTURED_OUTPUT_RETRY', 'true').lower() == 'true'
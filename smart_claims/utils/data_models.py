@@ -1,14 +1,15 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, field_validator
+from typing import Any, Dict, List, Optional
+from smart_claims.utils.output_parsing import coerce_list, coerce_number
 
 class RefundClaim(BaseModel):
     """
     Represents a refund claim submitted by a customer
     """
-    claim_id: str
+    claim_id: Optional[str] = None
     claim_date: str
     customer_id: str
-    customer_name: str
+    customer_name: Optional[str] = None
     product_id: str
     product_name: str
     product_description: str
@@ -21,6 +22,10 @@ class RefundClaim(BaseModel):
     refund_status: str = "Pending"
     refund_reason: str = "Under review"
     refund_notes: Optional[str] = None
+    # Set when fraud screening finds near-duplicate images ('duplicate_image') or review text ('duplicate_review')
+    fraud_flags: Optional[List[str]] = None
+    # Per-stage latency, token usage, bytes uploaded, cache hits and errors of this claim
+    trace: Optional[Dict[str, Any]] = None
     
 
 class SentimentAnalysisResponse(BaseModel):
@@ -29,7 +34,7 @@ class SentimentAnalysisResponse(BaseModel):
     """
     sentiment_score: float
     sentiment_label: str
-    sentiment_details: str
+    sentiment_details: Optional[str] = None
 
 
 class ImageAnalysisResponse(BaseModel):
@@ -39,12 +44,30 @@ class ImageAnalysisResponse(BaseModel):
     detected_defects: List[str]
     defect_score: float
 
+    # Model output is not always well-formed: defects may come as one line of text and
+    # the score as "0.7/1", "70%" or "7" on a 0-10 scale; scores that stay outside 0-1
+    # are rejected so the response is repaired or retried
+    @field_validator('detected_defects', mode='before')
+    @classmethod
+    def _coerce_defects(cls, value: Any) -> List[str]:
+        return coerce_list(value)
+
+    @field_validator('defect_score', mode='before')
+    @classmethod
+    def _coerce_score(cls, value: Any) -> float:
+        return coerce_number(value, ratio=True)
+
 
 class RefundEstimationResponse(BaseModel):
     """
     Represents a response to a report creation task
     """
-    refund_amount: str
+    refund_amount: float
     refund_status: str
     refund_reason: str
-    refund_notes: Optional[str] = None
\ No newline at end of file
+    refund_notes: Optional[str] = None
+
+    @field_validator('refund_amount', mode='before')
+    @classmethod
+    def _coerce_amount(cls, value: Any) -> float:
+        return coerce_number(value)
@@ -0,0 +1,365 @@
+import asyncio
+import base64
+import io
+import logging
+import mmap
+import os
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+from PIL import Image, ImageOps
+from smart_claims.utils.config import Config
+from smart_claims.utils.instrumentation import stage
+
+# Largest (long side, short side) each model actually looks at. OpenAI resizes
+# 'low' detail images to 512x512 and 'high' detail images to fit 2048 then 768 on
+# the short side, so sending anything larger only costs upload time and memory.
+OPENAI_IMAGE_LIMITS = {
+    'low': (512, 512),
+    'high': (2048, 768),
+}
+
+
+def image_size_limits(model: str = Config.IMAGE_ANALYSIS_MODEL, detail: str = Config.IMAGE_DETAIL) -> Tuple[int, int]:
+    """
+    Resolution limits for the selected vision model
+
+    :param model: Image analysis model name
+    :param detail: OpenAI image detail level
+    :return: Tuple of (max long side, max short side) in pixels
+    """
+    if Config.IMAGE_MAX_SIDE:
+        return Config.IMAGE_MAX_SIDE, Config.IMAGE_MAX_SIDE
+    if model in ['gpt-4o-mini', 'gpt-4o']:
+        return OPENAI_IMAGE_LIMITS.get(detail, OPENAI_IMAGE_LIMITS['high'])
+    return Config.LOCAL_VLM_IMAGE_MAX_SIDE, Config.LOCAL_VLM_IMAGE_MAX_SIDE
+
+
+def perceptual_hash(image: Image.Image) -> int:
+    """
+    64-bit difference hash (dHash) of an image
+
+    Visually similar images (re-encoded, resized, slightly edited) have hashes
+    with a small Hamming distance.
+    """
+    pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return bin(first ^ second).count('1')
+
+
+def encoded_size(size: int) -> int:
+    """
+    Length of the base64 encoding of `size` bytes
+    """
+    return 4 * ((size + 2) // 3)
+
+
+def encode_base64(data, prefix: str = '', chunk_bytes: int = Config.IMAGE_ENCODE_CHUNK_BYTES) -> str:
+    """
+    Base64 encode a buffer chunk by chunk into a single string
+
+    Nothing is streamed: the whole encoding is built in one preallocated buffer and then
+    decoded to the returned string, so peak memory is about twice the encoded size.
+    What the chunking saves is a copy of the input: `data` is read in place, and a
+    memory map is paged in from the OS cache instead of being read onto the heap.
+
+    :param data: Bytes-like object to encode
+    :param prefix: ASCII text placed before the encoding, e.g. a data URL header
+    :param chunk_bytes: Bytes encoded per step, rounded down to a multiple of 3
+    :return: Prefix followed by the base64 text
+    """
+    chunk_bytes = max(3, chunk_bytes - chunk_bytes % 3)
+    header = prefix.encode('ascii')
+    with memoryview(data) as view:
+        output = bytearray(len(header) + encoded_size(view.nbytes))
+        output[:len(header)] = header
+        position = len(header)
+        for offset in range(0, view.nbytes, chunk_bytes):
+            with view[offset:offset + chunk_bytes] as chunk:
+                encoded = base64.b64encode(chunk)
+            output[position:position + len(encoded)] = encoded
+            position += len(encoded)
+    return output.decode('ascii')
+
+
+class PreparedImage:
+    """
+    A decoded, orientation-corrected and downsized image ready for a vision model
+    """
+
+    def __init__(self, path: str, image: Image.Image, phash: int, source_format: Optional[str] = None):
+        self.path = path
+        self.image = image
+        self.phash = phash
+        # Set when the file is already a JPEG/PNG that needed no rotation or resizing,
+        # in which case the original bytes are smaller than a re-encode
+        self.source_format = source_format
+
+    @property
+    def mime_type(self) -> str:
+        if self.source_format is not None:
+            return f"image/{self.source_format.lower()}"
+        return 'image/png' if self._has_alpha() else 'image/jpeg'
+
+    def _has_alpha(self) -> bool:
+        return self.image.mode in ('RGBA', 'LA') or (self.image.mode == 'P' and 'transparency' in self.image.info)
+
+    def _reencode(self) -> io.BytesIO:
+        """
+        Re-encode the image as PNG when it has transparency and JPEG otherwise
+        """
+        buffer = io.BytesIO()
+        if self._has_alpha():
+            self.image.save(buffer, format='PNG', optimize=True)
+        else:
+            self.image.convert('RGB').save(buffer, format='JPEG', quality=Config.IMAGE_JPEG_QUALITY, optimize=True)
+        return buffer
+
+    def encode(self) -> bytes:
+        """
+        Bytes of the image as uploaded
+        """
+        if self.source_format is not None:
+            with open(self.path, 'rb') as image_file:
+                return image_file.read()
+        return self._reencode().getvalue()
+
+    def _encode_base64(self, prefix: str) -> str:
+        # Original files are memory-mapped and re-encodes are read in place, so the
+        # image bytes are never copied before encoding
+        if self.source_format is not None:
+            with open(self.path, 'rb') as image_file:
+                with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return encode_base64(mapped, prefix)
+        buffer = self._reencode()
+        with buffer.getbuffer() as view:
+            return encode_base64(view, prefix)
+
+    def to_base64(self) -> str:
+        return self._encode_base64('')
+
+    def to_data_url(self) -> str:
+        return self._encode_base64(f"data:{self.mime_type};base64,")
+
+
+def estimate_upload_bytes(image_paths: List[str], limits: Optional[Tuple[int, int]] = None) -> int:
+    """
+    Upper estimate of the encoded upload size of a claim's images, from file sizes only
+
+    Images are downsized to the model resolution before upload, so a file never
+    contributes more than an uncompressed image at that resolution.
+
+    :param image_paths: Paths to the image files
+    :param limits: Tuple of (max long side, max short side), defaults to the configured model
+    :return: Estimated base64 bytes
+    """
+    max_long, max_short = limits or image_size_limits()
+    total = 0
+    for image_path in image_paths:
+        try:
+            size = os.path.getsize(image_path)
+        except OSError:
+            continue
+        total += encoded_size(min(size, max_long * max_short * 3))
+    return total
+
+
+class ByteReservation:
+    """
+    Bytes held in an ImageByteBudget by one request
+    """
+
+    def __init__(self, budget: "ImageByteBudget", amount: int):
+        self.budget = budget
+        self.amount = amount
+
+    def settle(self, actual: int) -> None:
+        """
+        Replace the estimate with the real size once the images are encoded
+        """
+        self.budget.adjust(actual - self.amount)
+        self.amount = actual
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class ImageByteBudget:
+    """
+    Bounds the encoded image bytes held by in-flight vision requests across all claims.
+
+    A request reserves an estimate before encoding its images and waits while the
+    budget is spent (backpressure), settles the reservation to the encoded size, and
+    gives it back when the response arrives. A reservation larger than the whole
+    budget goes through once nothing else is in flight, so it never waits forever.
+
+    Threads wait on a condition variable. Coroutines wait on a future of their own
+    event loop, woken when bytes are given back, so a waiting claim does not hold a
+    worker thread that a claim holding the budget needs to finish.
+    """
+
+    def __init__(self, max_bytes: int = Config.IMAGE_INFLIGHT_BUDGET_BYTES):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        # (event loop, future) of every coroutine waiting for room
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def _has_room(self, amount: int) -> bool:
+        return not self.max_bytes or self.in_flight == 0 or self.in_flight + amount <= self.max_bytes
+
+    def acquire(self, amount: int) -> ByteReservation:
+        with self._condition:
+            self._condition.wait_for(lambda: self._has_room(amount))
+            self.in_flight += amount
+        return ByteReservation(self, amount)
+
+    async def acquire_async(self, amount: int) -> ByteReservation:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._has_room(amount):
+                    self.in_flight += amount
+                    return ByteReservation(self, amount)
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._condition:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+                raise
+
+    def adjust(self, amount: int) -> None:
+        """
+        Take (positive) or give back (negative) bytes without waiting
+        """
+        with self._condition:
+            self.in_flight += amount
+            self._condition.notify_all()
+            for loop, waiter in self._async_waiters:
+                try:
+                    loop.call_soon_threadsafe(_wake, waiter)
+                except RuntimeError:
+                    # The waiter's event loop is closed
+                    pass
+            self._async_waiters.clear()
+
+    @contextmanager
+    def reserve(self, amount: int) -> Iterator[ByteReservation]:
+        with stage('image.budget_wait'):
+            reservation = self.acquire(amount)
+        try:
+            yield reservation
+        finally:
+            self.adjust(-reservation.amount)
+
+    @asynccontextmanager
+    async def reserve_async(self, amount: int) -> AsyncIterator[ByteReservation]:
+        with stage('image.budget_wait'):
+            reservation = await self.acquire_async(amount)
+        try:
+            yield reservation
+        finally:
+            self.adjust(-reservation.amount)
+
+
+image_byte_budget = ImageByteBudget()
+
+
+def load_image(image_path: str, limits: Optional[Tuple[int, int]] = None) -> Tuple[Image.Image, Optional[str]]:
+    """
+    Decode an image once, apply its EXIF orientation and shrink it to the model resolution
+
+    :param image_path: Path to the image file
+    :param limits: Tuple of (max long side, max short side), defaults to the configured model
+    :return: Tuple of the decoded PIL image and the source format if the pixels were left untouched
+    """
+    max_long, max_short = limits or image_size_limits()
+    with Image.open(image_path) as source:
+        source_format = source.format
+        original_size = source.size
+        # draft() lets the JPEG decoder skip most of the work for large downscales
+        source.draft('RGB', (max_long, max_long))
+        image = ImageOps.exif_transpose(source)
+        long_side, short_side = max(image.size), min(image.size)
+        scale = min(1.0, max_long / long_side, max_short / short_side)
+        if scale < 1.0:
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image = image.resize(size, Image.LANCZOS)
+        image.load()
+        orientation = source.getexif().get(0x0112, 1)
+
+    untouched = image.size == original_size and orientation == 1 and source_format in ('JPEG', 'PNG')
+    return image, source_format if untouched else None
+
+
+def preprocess_images(
+        image_paths: List[str],
+        limits: Optional[Tuple[int, int]] = None,
+        dedupe_distance: int = Config.IMAGE_DEDUPE_DISTANCE
+    ) -> List[PreparedImage]:
+    """
+    Prepare a claim's images for a vision model, dropping near-duplicates
+
+    :param image_paths: Paths to the image files
+    :param limits: Tuple of (max long side, max short side), defaults to the configured model
+    :param dedupe_distance: Maximum perceptual hash distance treated as a duplicate, negative disables
+    :return: List of prepared images in upload order
+    """
+    prepared: List[PreparedImage] = []
+    for image_path in image_paths:
+        image, source_format = load_image(image_path, limits)
+        phash = perceptual_hash(image)
+        duplicate = next(
+            (kept for kept in prepared if dedupe_distance >= 0 and hamming_distance(kept.phash, phash) <= dedupe_distance),
+            None
+        )
+        if duplicate is not None:
+            logging.info(f"Skipping {image_path}: near-duplicate of {duplicate.path}")
+            continue
+        prepared.append(PreparedImage(image_path, image, phash, source_format))
+    return prepared
+
+
+def validate_image_files(image_paths: List[str], max_bytes: int = Config.IMAGE_MAX_FILE_BYTES) -> List[str]:
+    """
+    Cheap pre-flight check of image files before any model sees them
+
+    Only the file size and the image header are inspected; pixels are not decoded.
+
+    :param image_paths: Paths to the image files
+    :param max_bytes: Largest accepted file size
+    :return: List of problems found, empty if every image is usable
+    """
+    problems = []
+    for image_path in image_paths:
+        try:
+            size = os.path.getsize(image_path)
+        except OSError:
+            problems.append(f"{os.path.basename(image_path)} could not be read")
+            continue
+        if size == 0:
+            problems.append(f"{os.path.basename(image_path)} is empty")
+            continue
+        if size > max_bytes:
+            problems.append(f"{os.path.basename(image_path)} is larger than {max_bytes // (1024 * 1024)} MB")
+            continue
+        try:
+            with Image.open(image_path) as image:
+                image.verify()
+        except Exception:
+            problems.append(f"{os.path.basename(image_path)} is not a valid image")
+    return problems
@@ -0,0 +1,229 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+
+class MetricsRegistry:
+    """
+    Process-wide aggregate of every claim trace, exportable as JSON or Prometheus text
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stage_seconds: Dict[str, float] = defaultdict(float)
+            self.stage_count: Dict[str, int] = defaultdict(int)
+            self.stage_max_seconds: Dict[str, float] = defaultdict(float)
+            self.tokens: Dict[tuple, int] = defaultdict(int)
+            self.counters: Dict[str, int] = defaultdict(int)
+            self.errors: Dict[str, int] = defaultdict(int)
+            # Stages running right now, so samplers (e.g. of memory) can attribute what they see
+            self.active: Dict[str, int] = defaultdict(int)
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stage_seconds[stage] += seconds
+            self.stage_count[stage] += 1
+            self.stage_max_seconds[stage] = max(self.stage_max_seconds[stage], seconds)
+
+    def enter_stage(self, stage: str) -> None:
+        with self._lock:
+            self.active[stage] += 1
+
+    def exit_stage(self, stage: str) -> None:
+        with self._lock:
+            self.active[stage] -= 1
+            if self.active[stage] <= 0:
+                del self.active[stage]
+
+    def active_stages(self) -> List[str]:
+        with self._lock:
+            return list(self.active)
+
+    def add_tokens(self, model: str, kind: str, count: int) -> None:
+        with self._lock:
+            self.tokens[(model, kind)] += count
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += amount
+
+    def add_error(self, stage: str) -> None:
+        with self._lock:
+            self.errors[stage] += 1
+
+    def to_json(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'stages': {
+                    stage: {
+                        'count': self.stage_count[stage],
+                        'total_seconds': self.stage_seconds[stage],
+                        'avg_seconds': self.stage_seconds[stage] / self.stage_count[stage],
+                        'max_seconds': self.stage_max_seconds[stage],
+                    }
+                    for stage in self.stage_count
+                },
+                'tokens': {f"{model}:{kind}": count for (model, kind), count in self.tokens.items()},
+                'counters': dict(self.counters),
+                'errors': dict(self.errors),
+            }
+
+    def to_prometheus(self) -> str:
+        lines = [
+            "# TYPE smart_claims_stage_seconds summary",
+        ]
+        with self._lock:
+            for stage in sorted(self.stage_count):
+                lines.append(f'smart_claims_stage_seconds_sum{{stage="{stage}"}} {self.stage_seconds[stage]:.6f}')
+                lines.append(f'smart_claims_stage_seconds_count{{stage="{stage}"}} {self.stage_count[stage]}')
+            lines.append("# TYPE smart_claims_tokens_total counter")
+            for (model, kind), count in sorted(self.tokens.items()):
+                lines.append(f'smart_claims_tokens_total{{model="{model}",kind="{kind}"}} {count}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE smart_claims_{name}_total counter")
+                lines.append(f"smart_claims_{name}_total {value}")
+            lines.append("# TYPE smart_claims_errors_total counter")
+            for stage, count in sorted(self.errors.items()):
+                lines.append(f'smart_claims_errors_total{{stage="{stage}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str) -> None:
+        """
+        Write the metrics to a file, in Prometheus text format for .prom files and JSON otherwise
+        """
+        with open(path, 'w') as metrics_file:
+            if path.endswith('.prom'):
+                metrics_file.write(self.to_prometheus())
+            else:
+                json.dump(self.to_json(), metrics_file, indent=2)
+
+
+metrics = MetricsRegistry()
+
+
+class ClaimTrace:
+    """
+    Structured record of where time, tokens and bytes went while processing one claim
+    """
+
+    def __init__(self, claim_id: Optional[str] = None):
+        self.claim_id = claim_id
+        self.stages: Dict[str, float] = defaultdict(float)
+        self.token_usage: Dict[str, Dict[str, int]] = {}
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.errors: List[Dict[str, str]] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self) -> Iterator["ClaimTrace"]:
+        """
+        Make this the trace that tools record into for the current context
+        """
+        token = _current_trace.set(self)
+        try:
+            yield self
+        finally:
+            _current_trace.reset(token)
+
+    def add_stage_time(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[stage] += seconds
+
+    def add_usage(self, stage: str, model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> None:
+        with self._lock:
+            usage = self.token_usage.setdefault(
+                stage, {'model': model, 'prompt_tokens': 0, 'completion_tokens': 0, 'cached_prompt_tokens': 0}
+            )
+            usage['prompt_tokens'] += prompt_tokens
+            usage['completion_tokens'] += completion_tokens
+            usage['cached_prompt_tokens'] += cached_tokens
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += amount
+
+    def add_error(self, stage: str, error: str) -> None:
+        with self._lock:
+            self.errors.append({'stage': stage, 'error': error})
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'claim_id': self.claim_id,
+                'stages': dict(self.stages),
+                'token_usage': {stage: dict(usage) for stage, usage in self.token_usage.items()},
+                'counters': dict(self.counters),
+                'errors': list(self.errors),
+            }
+
+
+_current_trace: ContextVar[Optional[ClaimTrace]] = ContextVar('smart_claims_trace', default=None)
+
+
+def current_trace() -> Optional[ClaimTrace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Time a block of work and record it on the active trace and the process metrics
+    """
+    started = time.perf_counter()
+    metrics.enter_stage(name)
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        metrics.exit_stage(name)
+        metrics.observe_stage(name, seconds)
+        trace = current_trace()
+        if trace is not None:
+            trace.add_stage_time(name, seconds)
+
+
+def record_usage(stage_name: str, model: str, usage: Any) -> None:
+    """
+    Record the token usage returned by an OpenAI response
+
+    :param stage_name: Stage the request belongs to
+    :param model: Model name
+    :param usage: `response.usage` object, may be None
+    """
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+    # Prompt tokens served from the provider's prompt cache, a subset of prompt_tokens
+    cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', 0) or 0
+    metrics.add_tokens(model, 'prompt', prompt_tokens)
+    metrics.add_tokens(model, 'completion', completion_tokens)
+    metrics.add_tokens(model, 'cached_prompt', cached_tokens)
+    trace = current_trace()
+    if trace is not None:
+        trace.add_usage(stage_name, model, prompt_tokens, completion_tokens, cached_tokens)
+
+
+def increment(name: str, amount: int = 1) -> None:
+    """
+    Increment a named counter (bytes uploaded, cache hits, ...) on the trace and the process metrics
+    """
+    metrics.increment(name, amount)
+    trace = current_trace()
+    if trace is not None:
+        trace.increment(name, amount)
+
+
+def record_error(stage_name: str, error: str) -> None:
+    metrics.add_error(stage_name)
+    trace = current_trace()
+    if trace is not None:
+        trace.add_error(stage_name, error)
@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+from smart_claims.utils.instrumentation import metrics
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of lazily loaded models.
+
+    Tools register a loader under a name at import time, which is cheap. The loader
+    runs on the first `get()` call and its result is shared by every tool object in
+    the process. Servers can call `warmup()` to pay the loading cost up front.
+    """
+
+    def __init__(self):
+        self._loaders: Dict[str, Callable[[], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._load_times: Dict[str, float] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._registry_lock = threading.Lock()
+
+    def register(self, name: str, loader: Callable[[], Any]) -> None:
+        """
+        Register a model loader
+
+        :param name: Name of the model
+        :param loader: Zero-argument callable returning the loaded model
+        """
+        with self._registry_lock:
+            self._loaders[name] = loader
+            self._locks.setdefault(name, threading.Lock())
+
+    def get(self, name: str) -> Any:
+        """
+        Return the shared instance of a model, loading it on first use
+
+        :param name: Name of the model
+        :return: Loaded model
+        """
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+
+        if name not in self._loaders:
+            raise KeyError(f"No model registered under '{name}'")
+
+        with self._locks[name]:
+            if name not in self._instances:
+                started = time.perf_counter()
+                self._instances[name] = self._loaders[name]()
+                self._load_times[name] = time.perf_counter() - started
+                metrics.observe_stage(f"model_load.{name}", self._load_times[name])
+                logging.info(f"Loaded model '{name}' in {self._load_times[name]:.2f}s")
+        return self._instances[name]
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._instances
+
+    def registered(self) -> Iterable[str]:
+        return list(self._loaders)
+
+    def warmup(self, names: Optional[Iterable[str]] = None) -> Dict[str, float]:
+        """
+        Load models ahead of the first request
+
+        :param names: Models to load, defaults to every registered model
+        :return: Mapping of model name to load time in seconds
+        """
+        for name in names if names is not None else self.registered():
+            self.get(name)
+        return self.load_times
+
+    @property
+    def load_times(self) -> Dict[str, float]:
+        return dict(self._load_times)
+
+
+registry = ModelRegistry()
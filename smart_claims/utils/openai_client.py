@@ -0,0 +1,336 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Awaitable, Dict, Optional, Tuple
+import httpx
+import openai
+from openai import OpenAI, AsyncOpenAI
+from smart_claims.utils.config import Config
+from smart_claims.utils.instrumentation import increment
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+# Rough prompt token cost of an image part for each detail level
+IMAGE_TOKEN_ESTIMATES = {'low': 85, 'high': 765, 'auto': 765}
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a request cannot complete before its deadline
+    """
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `rate_per_minute`
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Take `amount` tokens, going into debt if needed
+
+        :return: Seconds the caller must wait before using the reservation
+        """
+        with self._lock:
+            self._refill()
+            # A single request larger than the bucket can never fit; let it through once full
+            amount = min(amount, self.capacity)
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate) if self._tokens < 0 else 0.0
+
+    def adjust(self, amount: float) -> None:
+        """
+        Give back (positive) or take (negative) tokens once the real cost is known
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+
+class ModelLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budget for one model
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def reserve(self, estimated_tokens: int) -> float:
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(estimated_tokens))
+        return wait
+
+    def settle(self, estimated_tokens: int, actual_tokens: int) -> None:
+        if self.tokens is not None:
+            self.tokens.adjust(estimated_tokens - actual_tokens)
+
+
+def parse_rate_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    """
+    Parse a rate limit specification such as "gpt-4o=500:30000,gpt-4o-mini=500:200000"
+
+    :param spec: Comma separated model=requests_per_minute:tokens_per_minute entries
+    :return: Mapping of model name to (requests per minute, tokens per minute)
+    """
+    limits = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        model, _, budget = entry.partition('=')
+        requests, _, tokens = budget.partition(':')
+        limits[model.strip()] = (float(requests or 0), float(tokens or 0))
+    return limits
+
+
+def estimate_tokens(messages: Any, max_tokens: int = 0) -> int:
+    """
+    Cheap upper-bound estimate of the tokens a chat request will consume
+    """
+    total = max_tokens
+    for message in messages or []:
+        content = message.get('content') if isinstance(message, dict) else None
+        if isinstance(content, str):
+            total += len(content) // 4 + 4
+        elif isinstance(content, list):
+            for part in content:
+                if part.get('type') == 'image_url':
+                    total += IMAGE_TOKEN_ESTIMATES.get(part['image_url'].get('detail', 'auto'), 765)
+                else:
+                    total += len(part.get('text', '')) // 4
+    return total
+
+
+class PooledOpenAIClient:
+    """
+    Shared OpenAI access for every tool in the process.
+
+    Sync and async clients share one HTTP connection pool each, requests are admitted
+    through per-model request and token budgets, retryable failures (429, timeouts,
+    connection errors, 5xx) are retried with jittered exponential backoff, and every
+    call is bounded by an overall deadline. Point OPENAI_BASE_URL at a local stub
+    server to exercise all of this offline.
+
+    httpx async pools are bound to the event loop that created them, while claims run
+    on short-lived loops (one asyncio.run per flow kickoff). The async client therefore
+    lives on one long-lived loop in a background thread, and async requests from any
+    loop are sent through it, so connections are reused across claims.
+    """
+
+    def __init__(self):
+        self._client: Optional[OpenAI] = None
+        self._async_client: Optional[AsyncOpenAI] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self.share_rate_limits(1.0)
+
+    def share_rate_limits(self, share: float) -> None:
+        """
+        Hold this process to a share of the OPENAI_RATE_LIMITS budgets
+
+        :param share: Fraction of each budget, e.g. 1/8 in each of 8 worker processes
+        """
+        self.limiters: Dict[str, ModelLimiter] = {
+            model: ModelLimiter(requests * share, tokens * share)
+            for model, (requests, tokens) in parse_rate_limits(Config.OPENAI_RATE_LIMITS).items()
+        }
+
+    def after_fork(self) -> None:
+        """
+        Drop the parent's connection pools, whose sockets must not be shared with a forked child
+        """
+        self._client = None
+        # The parent's client loop thread does not exist in the child
+        self._async_client = None
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _client_options(self) -> Dict[str, Any]:
+        options = {
+            'api_key': Config.OPENAI_API_KEY,
+            'timeout': Config.OPENAI_TIMEOUT_SECONDS,
+            # Retries are handled here so they respect the rate limiter and the deadline
+            'max_retries': 0,
+        }
+        if Config.OPENAI_BASE_URL:
+            options['base_url'] = Config.OPENAI_BASE_URL
+        return options
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=Config.OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=Config.OPENAI_MAX_CONNECTIONS
+        )
+
+    @property
+    def client(self) -> OpenAI:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = OpenAI(
+                        http_client=openai.DefaultHttpxClient(limits=self._limits()),
+                        **self._client_options()
+                    )
+        return self._client
+
+    def _client_loop(self) -> asyncio.AbstractEventLoop:
+        """
+        Event loop of the async client, started on first use
+        """
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name='openai-client-loop', daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        """
+        Pooled async client; only use it from the client loop
+        """
+        if self._async_client is None:
+            with self._lock:
+                if self._async_client is None:
+                    self._async_client = AsyncOpenAI(
+                        http_client=openai.DefaultAsyncHttpxClient(limits=self._limits()),
+                        **self._client_options()
+                    )
+        return self._async_client
+
+    async def _on_client_loop(self, awaitable: Awaitable) -> Any:
+        """
+        Await a request on the client loop from the caller's loop; cancelling the caller cancels the request
+        """
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(awaitable, self._client_loop()))
+
+    def _limiter(self, model: str) -> Optional[ModelLimiter]:
+        return self.limiters.get(model)
+
+    @staticmethod
+    def _backoff(attempt: int, error: Exception) -> float:
+        retry_after = None
+        response = getattr(error, 'response', None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get('retry-after'))
+            except (TypeError, ValueError):
+                retry_after = None
+        delay = random.uniform(0, min(Config.OPENAI_BACKOFF_MAX_SECONDS, Config.OPENAI_BACKOFF_BASE_SECONDS * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+    @staticmethod
+    def _actual_tokens(response: Any, estimated: int) -> int:
+        usage = getattr(response, 'usage', None)
+        return getattr(usage, 'total_tokens', None) or estimated
+
+    def parse(self, **kwargs) -> Any:
+        """
+        `client.beta.chat.completions.parse` with rate limiting, retries and a deadline
+        """
+        model = kwargs['model']
+        estimated = estimate_tokens(kwargs.get('messages'), kwargs.get('max_tokens') or 0)
+        limiter = self._limiter(model)
+        deadline = time.monotonic() + Config.OPENAI_DEADLINE_SECONDS
+
+        for attempt in range(Config.OPENAI_MAX_RETRIES + 1):
+            if limiter is not None:
+                self._sleep_until(limiter.reserve(estimated), deadline)
+            remaining = self._remaining(deadline)
+            try:
+                response = self.client.beta.chat.completions.parse(
+                    timeout=min(Config.OPENAI_TIMEOUT_SECONDS, remaining), **kwargs
+                )
+            except RETRYABLE_ERRORS as e:
+                if limiter is not None:
+                    limiter.settle(estimated, 0)
+                self._before_retry(model, attempt, e)
+                self._sleep_until(self._backoff(attempt, e), deadline)
+                continue
+            if limiter is not None:
+                limiter.settle(estimated, self._actual_tokens(response, estimated))
+            return response
+        raise DeadlineExceeded(f"{model} request failed after {Config.OPENAI_MAX_RETRIES + 1} attempts")
+
+    async def parse_async(self, **kwargs) -> Any:
+        """
+        Async `client.beta.chat.completions.parse` with rate limiting, retries and a deadline
+        """
+        model = kwargs['model']
+        estimated = estimate_tokens(kwargs.get('messages'), kwargs.get('max_tokens') or 0)
+        limiter = self._limiter(model)
+        deadline = time.monotonic() + Config.OPENAI_DEADLINE_SECONDS
+
+        for attempt in range(Config.OPENAI_MAX_RETRIES + 1):
+            if limiter is not None:
+                await self._sleep_until_async(limiter.reserve(estimated), deadline)
+            remaining = self._remaining(deadline)
+            try:
+                response = await self._on_client_loop(self._parse_on_client_loop(
+                    timeout=min(Config.OPENAI_TIMEOUT_SECONDS, remaining), **kwargs
+                ))
+            except RETRYABLE_ERRORS as e:
+                if limiter is not None:
+                    limiter.settle(estimated, 0)
+                self._before_retry(model, attempt, e)
+                await self._sleep_until_async(self._backoff(attempt, e), deadline)
+                continue
+            if limiter is not None:
+                limiter.settle(estimated, self._actual_tokens(response, estimated))
+            return response
+        raise DeadlineExceeded(f"{model} request failed after {Config.OPENAI_MAX_RETRIES + 1} attempts")
+
+    async def _parse_on_client_loop(self, **kwargs) -> Any:
+        return await self.async_client.beta.chat.completions.parse(**kwargs)
+
+    @staticmethod
+    def _before_retry(model: str, attempt: int, error: Exception) -> None:
+        if attempt >= Config.OPENAI_MAX_RETRIES:
+            raise error
+        increment('openai_retries')
+        logging.warning(f"Retrying {model} request after {type(error).__name__} (attempt {attempt + 1})")
+
+    @staticmethod
+    def _remaining(deadline: float) -> float:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded("OpenAI request deadline exceeded")
+        return remaining
+
+    def _sleep_until(self, delay: float, deadline: float) -> None:
+        if delay > 0:
+            if time.monotonic() + delay >= deadline:
+                raise DeadlineExceeded("OpenAI request deadline exceeded while waiting for capacity")
+            time.sleep(delay)
+
+    async def _sleep_until_async(self, delay: float, deadline: float) -> None:
+        if delay > 0:
+            if time.monotonic() + delay >= deadline:
+                raise DeadlineExceeded("OpenAI request deadline exceeded while waiting for capacity")
+            await asyncio.sleep(delay)
+
+
+openai_client = PooledOpenAIClient()
+os.register_at_fork(after_in_child=openai_client.after_fork)
@@ -0,0 +1,384 @@
+import ast
+import json
+import re
+import types
+from typing import Any, Dict, List, Optional, Type, Union, get_args, get_origin
+import openai
+from pydantic import BaseModel, ValidationError
+from smart_claims.utils.config import Config
+from smart_claims.utils.openai_client import openai_client
+from smart_claims.utils.instrumentation import increment, record_usage
+
+_CODE_FENCE = re.compile(r'```[a-zA-Z]*\s*(.*?)(?:```|$)', re.S)
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+_DANGLING_KEY = re.compile(r'([{,])\s*"[^"]*"$')
+_KEY_VALUE = re.compile(r'^\s*[-*]?\s*\**([A-Za-z][\w ()/-]{0,40}?)\**\s*[:=]\s*(.*)$')
+_BULLET = re.compile(r'^\s*(?:[-*•]|\d+[.)])\s*')
+_PARENTHESES = re.compile(r'\([^)]*\)')
+_THOUSANDS = re.compile(r'(?<=\d),(?=\d{3}\b)')
+_NUMBER = r'-?\d+(?:\.\d+)?'
+
+# Errors raised when a response does not fit its schema, as opposed to failed requests
+PARSE_ERRORS = (ValidationError, json.JSONDecodeError, openai.LengthFinishReasonError)
+
+
+class OutputParseError(ValueError):
+    """
+    Model output that could not be repaired into the expected schema
+    """
+
+
+def coerce_number(value: Any, ratio: bool = False) -> float:
+    """
+    Read a number from model output such as 17.8, "$17.80" or "0.7 (moderate)"
+
+    :param value: Value to convert
+    :param ratio: Read a score between 0 and 1: fractions and percentages are divided
+        out ("7/10" and "70%" both give 0.7), bare numbers above 1 are taken to be on a
+        0-10 or 0-100 scale ("8" gives 0.8, "80" gives 0.8), and anything else outside
+        the range is rejected
+    :return: The number
+    """
+    if isinstance(value, bool):
+        raise ValueError(f"Expected a number, got {value!r}")
+    if isinstance(value, (int, float)):
+        return _unit_interval(_rescale(float(value)), value) if ratio else float(value)
+    if isinstance(value, (list, tuple)) and len(value) == 1:
+        return coerce_number(value[0], ratio)
+
+    # Parenthesized asides such as "(0-1)" hold numbers that are not the value
+    text = _THOUSANDS.sub('', _PARENTHESES.sub(' ', str(value)))
+    if ratio:
+        fraction = re.search(rf'({_NUMBER})\s*(?:/|out of)\s*({_NUMBER})', text)
+        if fraction and float(fraction.group(2)):
+            return _unit_interval(float(fraction.group(1)) / float(fraction.group(2)), value)
+        percentage = re.search(rf'({_NUMBER})\s*%', text)
+        if percentage:
+            return _unit_interval(float(percentage.group(1)) / 100, value)
+    number = re.search(_NUMBER, text)
+    if number is None:
+        raise ValueError(f"No number in {value!r}")
+    if ratio:
+        return _unit_interval(_rescale(float(number.group(0))), value)
+    return float(number.group(0))
+
+
+def _rescale(number: float) -> float:
+    # A score above 1 with no scale given is out of 10 or out of 100
+    if 1 < number <= 10:
+        return number / 10
+    if 10 < number <= 100:
+        return number / 100
+    return number
+
+
+def _unit_interval(number: float, value: Any) -> float:
+    if not 0 <= number <= 1:
+        raise ValueError(f"Expected a score between 0 and 1, got {value!r}")
+    return number
+
+
+def coerce_list(value: Any) -> List[str]:
+    """
+    Read a list of strings from model output given as a list, a bulleted or numbered
+    block of lines, or a comma or semicolon separated line
+    """
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(item).strip() for item in value if str(item).strip()]
+    lines = [_BULLET.sub('', line).strip() for line in str(value).splitlines()]
+    lines = [line for line in lines if line]
+    if len(lines) == 1:
+        lines = [item.strip() for item in re.split(r'[;,]', lines[0]) if item.strip()]
+    return lines
+
+
+def coerce_text(value: Any) -> Optional[str]:
+    """
+    Read a string from model output, joining lists
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (list, tuple)):
+        return '; '.join(str(item) for item in value)
+    return str(value)
+
+
+def _close_json(text: str) -> str:
+    """
+    Close the strings, arrays and objects left open by a truncated JSON document and
+    drop anything after the first complete one
+    """
+    closers, in_string, escaped = [], False, False
+    for position, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            closers.append('}' if char == '{' else ']')
+        elif char in '}]' and closers:
+            closers.pop()
+            if not closers:
+                return text[:position + 1]
+    if in_string:
+        # Drop a cut-off escape sequence before closing the string
+        text = (text[:-1] if escaped else text) + '"'
+    text = text.rstrip().rstrip(',')
+    if closers and closers[-1] == '}':
+        if text.endswith(':'):
+            text += ' null'
+        else:
+            # A key cut off before its value cannot be completed
+            text = _DANGLING_KEY.sub(r'\1', text).rstrip().rstrip(',')
+    return text + ''.join(reversed(closers))
+
+
+def extract_json(text: str) -> Any:
+    """
+    Find the JSON value in model output, tolerating code fences, surrounding prose,
+    trailing commas, Python literals and truncation
+
+    :param text: Model output
+    :return: Decoded JSON value
+    """
+    fenced = _CODE_FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    starts = [index for index in (text.find('{'), text.find('[')) if index >= 0]
+    if not starts:
+        raise OutputParseError("No JSON object in the output")
+    candidate = text[min(starts):]
+
+    try:
+        return json.JSONDecoder().raw_decode(candidate)[0]
+    except json.JSONDecodeError:
+        pass
+    repaired = _TRAILING_COMMA.sub(r'\1', _close_json(candidate))
+    try:
+        return json.loads(repaired)
+    except json.JSONDecodeError:
+        pass
+    try:
+        return ast.literal_eval(re.sub(r'\btrue\b', 'True', re.sub(r'\bfalse\b', 'False', re.sub(r'\bnull\b', 'None', repaired))))
+    except (ValueError, SyntaxError):
+        raise OutputParseError("Output is not valid JSON") from None
+
+
+def parse_key_values(text: str) -> Dict[str, str]:
+    """
+    Read "Label: value" lines, with lines that follow a label without a value (such as a
+    bulleted list) collected as its value
+    """
+    values: Dict[str, str] = {}
+    key = None
+    for line in text.splitlines():
+        match = _KEY_VALUE.match(line)
+        if match:
+            key = match.group(1).strip()
+            values[key] = match.group(2).strip()
+        elif key is not None and line.strip():
+            values[key] = (values[key] + '\n' + line.strip()).strip()
+    return values
+
+
+def _normalize_key(key: Any) -> str:
+    return re.sub(r'[^a-z0-9]+', '_', str(key).lower()).strip('_')
+
+
+def _is_str_field(annotation: Any) -> bool:
+    if get_origin(annotation) in (Union, types.UnionType):
+        return str in get_args(annotation)
+    return annotation is str
+
+
+def _match_fields(data: Dict[str, Any], response_format: Type[BaseModel]) -> Dict[str, Any]:
+    """
+    Map the keys of model output onto the schema's fields, e.g. "Defects" onto
+    "detected_defects" and "Refund Amount" onto "refund_amount"
+    """
+    fields = response_format.model_fields
+    matched = {}
+    for key, value in data.items():
+        normalized = _normalize_key(key)
+        name = normalized if normalized in fields else next(
+            (field for field in fields if normalized and (normalized in field or field in normalized)), None
+        )
+        if name is not None and name not in matched:
+            matched[name] = coerce_text(value) if _is_str_field(fields[name].annotation) else value
+    return matched
+
+
+def repair_output(response_format: Type[BaseModel], raw: Union[str, Dict[str, Any]]) -> BaseModel:
+    """
+    Repair model output into a response model
+
+    Text is read as JSON (see `extract_json`) or as "Label: value" lines, keys are
+    matched to fields by name and the model's validators coerce the values.
+
+    :param response_format: Pydantic model of the expected output
+    :param raw: Model output, as text or as a dictionary of raw field values
+    :return: Validated response model
+    """
+    data: Any = raw
+    if isinstance(raw, str):
+        try:
+            data = extract_json(raw)
+        except OutputParseError:
+            data = parse_key_values(raw)
+    if isinstance(data, list) and len(data) == 1:
+        data = data[0]
+    if isinstance(data, dict) and len(data) == 1:
+        # Output wrapped in an envelope such as {"result": {...}}
+        inner = next(iter(data.values()))
+        if isinstance(inner, dict) and not _match_fields(data, response_format):
+            data = inner
+    if not isinstance(data, dict):
+        raise OutputParseError("Output is not an object")
+
+    try:
+        return response_format.model_validate(_match_fields(data, response_format))
+    except ValidationError as e:
+        raise OutputParseError(f"Output does not match {response_format.__name__}: {e.error_count()} invalid fields") from e
+
+
+def parse_output(response_format: Type[BaseModel], content: str, stage_name: str) -> BaseModel:
+    """
+    Validate model output against its schema, repairing it when it does not fit
+
+    :param response_format: Pydantic model of the expected output
+    :param content: Model output
+    :param stage_name: Stage the output belongs to, used in the `{stage}_output_repaired` counter
+    :return: Validated response model
+    """
+    try:
+        return response_format.model_validate_json(content)
+    except ValidationError:
+        pass
+    result = repair_output(response_format, content)
+    increment(f"{stage_name}_output_repaired")
+    return result
+
+
+def _parsed_message(response: Any, response_format: Type[BaseModel], stage_name: str) -> BaseModel:
+    message = response.choices[0].message
+    if message.parsed is not None:
+        return message.parsed
+    if message.refusal:
+        raise OutputParseError(f"Model refused: {message.refusal}")
+    return parse_output(response_format, message.content or '', stage_name)
+
+
+def _failed_content(error: Exception) -> Optional[str]:
+    """
+    Model output carried by a failed parse, if any
+    """
+    # A truncated response comes back with its completion
+    completion = getattr(error, 'completion', None)
+    if completion is not None:
+        return completion.choices[0].message.content
+    # Output that is not JSON at all (prose, code fences) is kept as the error's input
+    if isinstance(error, ValidationError):
+        for detail in error.errors():
+            if detail['type'] == 'json_invalid' and isinstance(detail.get('input'), str):
+                return detail['input']
+    return None
+
+
+def _recover(error: Exception, response_format: Type[BaseModel], stage_name: str, model: str) -> Optional[BaseModel]:
+    """
+    Repair the output carried by a failed parse
+    """
+    completion = getattr(error, 'completion', None)
+    if completion is not None:
+        record_usage(stage_name, model, completion.usage)
+    content = _failed_content(error)
+    if not content:
+        return None
+    try:
+        return parse_output(response_format, content, stage_name)
+    except OutputParseError:
+        return None
+
+
+def constrained_retry(messages: List[Dict[str, Any]], response_format: Type[BaseModel], error: Exception,
+                      request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Request for the single retry of an output that could not be repaired
+
+    The conversation is repeated with the failure and the exact fields expected, and a
+    truncated response gets twice the completion tokens.
+
+    :param messages: Messages of the failed request
+    :param response_format: Pydantic model of the expected output
+    :param error: Why the output could not be used
+    :param request: Other arguments of the failed request
+    :return: Arguments for the retried request
+    """
+    fields = ', '.join(response_format.model_fields)
+    reminder = (f"Your previous reply could not be used ({type(error).__name__}). Reply with only a JSON "
+                f"object with exactly these fields: {fields}. Keep every value brief.")
+    retry = dict(request, messages=list(messages) + [{"role": "user", "content": reminder}])
+    if isinstance(error, openai.LengthFinishReasonError) and request.get('max_tokens'):
+        retry['max_tokens'] = request['max_tokens'] * 2
+    return retry
+
+
+def parse_structured(stage_name: str, model: str, messages: List[Dict[str, Any]],
+                     response_format: Type[BaseModel], **kwargs) -> BaseModel:
+    """
+    Structured output request through the pooled client, with repair and one retry
+
+    Outputs that do not fit the schema are repaired locally (`{stage}_output_repaired`);
+    only when that fails is the request sent once more with a constrained prompt
+    (`{stage}_output_retried`, when STRUCTURED_OUTPUT_RETRY is set).
+
+    :param stage_name: Stage the tokens, counters and errors are recorded under
+    :param model: OpenAI model name
+    :param messages: Chat messages
+    :param response_format: Pydantic model of the expected output
+    :return: Validated response model
+    """
+    request = dict(model=model, messages=messages, response_format=response_format, **kwargs)
+    for attempt in range(2 if Config.STRUCTURED_OUTPUT_RETRY else 1):
+        if attempt:
+            increment(f"{stage_name}_output_retried")
+            request = constrained_retry(messages, response_format, error, request)
+        try:
+            response = openai_client.parse(**request)
+            record_usage(stage_name, model, response.usage)
+            return _parsed_message(response, response_format, stage_name)
+        except PARSE_ERRORS + (OutputParseError,) as e:
+            error = e
+        recovered = _recover(error, response_format, stage_name, model)
+        if recovered is not None:
+            return recovered
+    raise error
+
+
+async def parse_structured_async(stage_name: str, model: str, messages: List[Dict[str, Any]],
+                                 response_format: Type[BaseModel], **kwargs) -> BaseModel:
+    """
+    Async `parse_structured`
+    """
+    request = dict(model=model, messages=messages, response_format=response_format, **kwargs)
+    for attempt in range(2 if Config.STRUCTURED_OUTPUT_RETRY else 1):
+        if attempt:
+            increment(f"{stage_name}_output_retried")
+            request = constrained_retry(messages, response_format, error, request)
+        try:
+            response = await openai_client.parse_async(**request)
+            record_usage(stage_name, model, response.usage)
+            return _parsed_message(response, response_format, stage_name)
+        except PARSE_ERRORS + (OutputParseError,) as e:
+            error = e
+        recovered = _recover(error, response_format, stage_name, model)
+        if recovered is not None:
+            return recovered
+    raise error
@@ -0,0 +1,205 @@
+import re
+import textwrap
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+from smart_claims.utils.config import Config
+from smart_claims.utils.instrumentation import increment
+from smart_claims.utils.openai_client import IMAGE_TOKEN_ESTIMATES
+
+# Marks the text cut out of the middle of a truncated field
+TRUNCATION_MARKER = " [...] "
+
+_SPACES = re.compile(r'[ \t]+')
+_BLANK_LINES = re.compile(r'\n{3,}')
+
+
+@lru_cache(maxsize=256)
+def normalize_whitespace(text: str) -> str:
+    """
+    Remove common indentation, trailing and repeated spaces and runs of blank lines
+
+    Prompts written as indented triple-quoted strings otherwise send every indent as
+    tokens. Line breaks, single blank lines and the relative indentation of nested
+    lists, which carry structure, are kept.
+
+    :param text: Prompt text
+    :return: Compacted text
+    """
+    lines = []
+    for line in textwrap.dedent(text).splitlines():
+        stripped = line.lstrip()
+        lines.append(line[:len(line) - len(stripped)] + _SPACES.sub(' ', stripped).rstrip())
+    return _BLANK_LINES.sub('\n\n', '\n'.join(lines)).strip()
+
+
+@lru_cache(maxsize=8)
+def _encoding(model: str) -> Any:
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('o200k_base')
+
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Tokens of `text` for `model`, exact with tiktoken installed and estimated otherwise
+
+    :param text: Text to count
+    :param model: OpenAI model name
+    :return: Token count
+    """
+    encoding = _encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str) -> Tuple[str, bool]:
+    """
+    Shorten text to a token budget, keeping its beginning and its end
+
+    Complaints tend to state the problem up front and the damage details last, so the
+    middle is cut.
+
+    :param text: Text to shorten
+    :param max_tokens: Token budget
+    :param model: OpenAI model name
+    :return: Tuple of the text within budget and whether it was shortened
+    """
+    if count_tokens(text, model) <= max_tokens:
+        return text, False
+    keep = max(0, max_tokens - count_tokens(TRUNCATION_MARKER, model))
+    head, tail = (keep + 1) // 2, keep // 2
+    encoding = _encoding(model)
+    if encoding is None:
+        # Four characters per token, matching count_tokens
+        head_text, tail_text = text[:head * 4], text[len(text) - tail * 4:] if tail else ''
+    else:
+        tokens = encoding.encode(text, disallowed_special=())
+        head_text = encoding.decode(tokens[:head])
+        tail_text = encoding.decode(tokens[len(tokens) - tail:]) if tail else ''
+    return head_text.rstrip() + TRUNCATION_MARKER + tail_text.lstrip(), True
+
+
+class PromptBuilder:
+    """
+    Builds chat messages for one stage within a prompt token budget.
+
+    Static text (system prompt, instructions) is added before per-claim fields and
+    images, so requests share the longest possible prefix for provider-side prompt
+    caching. All text is whitespace-normalized. Fields marked `compressible` are cut
+    down, largest first, until the text fits `budget_tokens`; image tokens are counted
+    towards the estimate but never dropped.
+    """
+
+    def __init__(self, stage_name: str, model: str, budget_tokens: int = 0,
+                 min_field_tokens: int = Config.PROMPT_MIN_FIELD_TOKENS):
+        """
+        :param stage_name: Stage the prompt is for, used in the recorded counters
+        :param model: Model the prompt is sent to, used for token counting
+        :param budget_tokens: Largest prompt size in tokens, 0 disables the budget
+        :param min_field_tokens: Compressible fields are never cut below this size
+        """
+        self.stage_name = stage_name
+        self.model = model
+        self.budget_tokens = budget_tokens
+        self.min_field_tokens = min_field_tokens
+        self.system_text: Optional[str] = None
+        self.static_parts: List[str] = []
+        self.fields: List[Dict[str, Any]] = []
+        self.images: List[Dict[str, Any]] = []
+        self.closing_text: Optional[str] = None
+
+    def system(self, text: str) -> "PromptBuilder":
+        self.system_text = normalize_whitespace(text)
+        return self
+
+    def static(self, text: str) -> "PromptBuilder":
+        """
+        Instructions that are the same for every claim
+        """
+        self.static_parts.append(normalize_whitespace(text))
+        return self
+
+    def field(self, label: str, value: Any, compressible: bool = False) -> "PromptBuilder":
+        """
+        A per-claim value, rendered as "- label: value"; empty values are skipped
+        """
+        if value is None or value == '':
+            return self
+        self.fields.append({'label': label, 'value': normalize_whitespace(str(value)), 'compressible': compressible})
+        return self
+
+    def blank_line(self) -> "PromptBuilder":
+        self.fields.append({'label': None, 'value': '', 'compressible': False})
+        return self
+
+    def image(self, url: str, detail: str) -> "PromptBuilder":
+        self.images.append({"type": "image_url", "image_url": {"url": url, "detail": detail}})
+        return self
+
+    def closing(self, text: str) -> "PromptBuilder":
+        """
+        Text after the per-claim fields, e.g. output format reminders
+        """
+        self.closing_text = normalize_whitespace(text)
+        return self
+
+    def _render_fields(self) -> str:
+        lines = [f"- {field['label']}: {field['value']}" if field['label'] else '' for field in self.fields]
+        return _BLANK_LINES.sub('\n\n', '\n'.join(lines)).strip()
+
+    def _user_text(self) -> str:
+        parts = self.static_parts + [self._render_fields()]
+        if self.closing_text:
+            parts.append(self.closing_text)
+        return '\n\n'.join(part for part in parts if part)
+
+    def _image_tokens(self) -> int:
+        return sum(IMAGE_TOKEN_ESTIMATES.get(image['image_url']['detail'], 765) for image in self.images)
+
+    def prompt_tokens(self) -> int:
+        """
+        Estimated prompt tokens of the messages as currently built
+        """
+        # Every message costs a few tokens of framing
+        return count_tokens(self.system_text or '', self.model) + count_tokens(self._user_text(), self.model) \
+            + self._image_tokens() + 8
+
+    def _fit_budget(self) -> bool:
+        truncated = False
+        compressible = sorted(
+            (field for field in self.fields if field['compressible']),
+            key=lambda field: count_tokens(field['value'], self.model),
+            reverse=True
+        )
+        for field in compressible:
+            excess = self.prompt_tokens() - self.budget_tokens
+            if excess <= 0:
+                break
+            field_tokens = count_tokens(field['value'], self.model)
+            target = max(self.min_field_tokens, field_tokens - excess)
+            field['value'], shortened = truncate_to_tokens(field['value'], target, self.model)
+            truncated = truncated or shortened
+        return truncated
+
+    def build(self) -> List[Dict[str, Any]]:
+        """
+        Build the chat messages and record their estimated size on the claim trace
+
+        :return: List of chat messages
+        """
+        if self.budget_tokens and self.prompt_tokens() > self.budget_tokens and self._fit_budget():
+            increment(f"{self.stage_name}_prompt_truncated")
+        increment(f"{self.stage_name}_prompt_tokens_estimated", self.prompt_tokens())
+
+        messages = []
+        if self.system_text:
+            messages.append({"role": "system", "content": self.system_text})
+        content = [{"type": "text", "text": self._user_text()}] + self.images
+        messages.append({"role": "user", "content": content})
+        return messages
@@ -0,0 +1,377 @@
+import hashlib
+import re
+import sqlite3
+import threading
+from array import array
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+import numpy as np
+from smart_claims.utils.config import Config
+from smart_claims.utils.image_processing import hamming_distance
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_KEY_MASK = (1 << 63) - 1
+_WORD_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+def review_words(text: str) -> List[str]:
+    return _WORD_PATTERN.findall((text or '').lower())
+
+
+def review_shingles(text: str, size: int = 3) -> Set[str]:
+    """
+    Overlapping word n-grams of a review, after lower-casing and dropping punctuation
+    """
+    words = review_words(text)
+    if len(words) <= size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[index:index + size]) for index in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    """
+    MinHash signatures of review shingles; the share of equal signature values estimates Jaccard similarity
+    """
+
+    def __init__(self, num_perm: int = Config.FRAUD_MINHASH_PERMUTATIONS, seed: int = 1):
+        generator = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self._a = generator.integers(1, int(_MERSENNE_PRIME), num_perm, dtype=np.uint64)
+        self._b = generator.integers(0, int(_MERSENNE_PRIME), num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """
+        :param text: Review text
+        :return: uint32 signature, or None for an empty review
+        """
+        shingles = review_shingles(text)
+        if not shingles:
+            return None
+        hashes = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=4).digest(), 'little') for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles)
+        )
+        # Universal hashing (a * x + b) mod p; the uint64 product wraps like other MinHash implementations
+        permuted = ((np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME) & _MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+
+def signature_similarity(first: np.ndarray, second: np.ndarray) -> float:
+    return float(np.count_nonzero(first == second)) / len(first)
+
+
+def signature_bands(signature: np.ndarray, bands: int) -> List[int]:
+    """
+    LSH band keys of a MinHash signature; similar reviews agree on at least one band with high probability
+    """
+    rows = len(signature) // bands
+    return [
+        int.from_bytes(hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8).digest(), 'little') & _KEY_MASK
+        for band in range(bands)
+    ]
+
+
+def image_hash_bands(image_hash: int, bands: int) -> List[int]:
+    """
+    Split a 64-bit perceptual hash into `bands` bit ranges
+
+    Two hashes within Hamming distance bands - 1 agree exactly on at least one range
+    (pigeonhole principle), so exact band lookups find every near-duplicate.
+    """
+    bounds = [round(band * 64 / bands) for band in range(bands + 1)]
+    return [(image_hash >> start) & ((1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+
+
+class IndexEntry(NamedTuple):
+    claim_id: str
+    # Claims sharing a group (same customer, order and product) are resubmissions, not duplicates
+    group_id: str
+    image_hashes: Sequence[int]
+    review_signature: Optional[np.ndarray]
+
+
+class SimilarityIndex:
+    """
+    Base class for the near-duplicate index of claim images and reviews.
+
+    Images are indexed by the bit bands of their perceptual hash and reviews by the
+    LSH bands of their MinHash signature, so a lookup only compares against the few
+    entries that share a band instead of every past claim.
+    """
+
+    def __init__(
+            self,
+            image_max_distance: int = Config.FRAUD_IMAGE_MAX_DISTANCE,
+            review_bands: int = Config.FRAUD_MINHASH_BANDS
+        ):
+        self.image_max_distance = image_max_distance
+        self.image_bands = image_max_distance + 1
+        self.review_bands = review_bands
+
+    def after_fork(self) -> None:
+        """
+        Drop state that must not be shared with a forked child, called in the child
+        """
+
+    def add(self, entry: IndexEntry) -> None:
+        self.add_many([entry])
+
+    def add_many(self, entries: Iterable[IndexEntry]) -> int:
+        """
+        Index the images and review of many claims
+
+        :return: Number of claims indexed
+        """
+        raise NotImplementedError
+
+    def similar_images(self, image_hash: int, max_distance: Optional[int] = None) -> List[Tuple[str, str, int]]:
+        """
+        :return: (claim_id, group_id, distance) of indexed images within `max_distance`
+        """
+        max_distance = self.image_max_distance if max_distance is None else min(max_distance, self.image_max_distance)
+        return [
+            (claim_id, group_id, distance)
+            for claim_id, group_id, candidate in self._image_candidates(image_hash_bands(image_hash, self.image_bands))
+            for distance in [hamming_distance(image_hash, candidate)]
+            if distance <= max_distance
+        ]
+
+    def similar_reviews(self, signature: np.ndarray, min_similarity: float) -> List[Tuple[str, str, float]]:
+        """
+        :return: (claim_id, group_id, estimated Jaccard similarity) of indexed reviews above `min_similarity`
+        """
+        return [
+            (claim_id, group_id, similarity)
+            for claim_id, group_id, candidate in self._review_candidates(signature_bands(signature, self.review_bands))
+            for similarity in [signature_similarity(signature, candidate)]
+            if similarity >= min_similarity
+        ]
+
+    def _image_candidates(self, band_keys: List[int]) -> Iterable[Tuple[str, str, int]]:
+        raise NotImplementedError
+
+    def _review_candidates(self, band_keys: List[int]) -> Iterable[Tuple[str, str, np.ndarray]]:
+        raise NotImplementedError
+
+
+class BandTable:
+    """
+    Multimap from (band, key) to entry ids.
+
+    Each band keeps its keys in a sorted numpy array searched with binary search, plus
+    a dict of recent inserts that is merged into the arrays once it grows, so both
+    inserts and lookups stay cheap at millions of entries.
+    """
+
+    def __init__(self, bands: int, min_compact: int = 65536):
+        self.bands = bands
+        self.min_compact = min_compact
+        self._keys = [np.empty(0, dtype=np.uint64) for _ in range(bands)]
+        self._ids = [np.empty(0, dtype=np.int64) for _ in range(bands)]
+        self._pending: List[Dict[int, List[int]]] = [defaultdict(list) for _ in range(bands)]
+        self._pending_count = 0
+        self._size = 0
+
+    def add(self, entry_id: int, band_keys: List[int]) -> None:
+        for band, key in enumerate(band_keys):
+            self._pending[band][key].append(entry_id)
+        self._pending_count += 1
+        # Merge cost grows with the table, so merge less often as it grows
+        if self._pending_count >= max(self.min_compact, self._size // 4):
+            self.compact()
+
+    def compact(self) -> None:
+        for band, pending in enumerate(self._pending):
+            if not pending:
+                continue
+            count = sum(len(ids) for ids in pending.values())
+            new_keys = np.fromiter((key for key, ids in pending.items() for _ in ids), dtype=np.uint64, count=count)
+            new_ids = np.fromiter((entry_id for ids in pending.values() for entry_id in ids), dtype=np.int64, count=count)
+            keys = np.concatenate([self._keys[band], new_keys])
+            ids = np.concatenate([self._ids[band], new_ids])
+            order = np.argsort(keys, kind='stable')
+            self._keys[band], self._ids[band] = keys[order], ids[order]
+            pending.clear()
+        self._size += self._pending_count
+        self._pending_count = 0
+
+    def lookup(self, band_keys: List[int]) -> Set[int]:
+        found = set()
+        for band, key in enumerate(band_keys):
+            keys = self._keys[band]
+            needle = np.uint64(key)
+            start, end = np.searchsorted(keys, needle, 'left'), np.searchsorted(keys, needle, 'right')
+            if end > start:
+                found.update(self._ids[band][start:end].tolist())
+            found.update(self._pending[band].get(key, ()))
+        return found
+
+
+class MemorySimilarityIndex(SimilarityIndex):
+    """
+    In-process index, rebuilt from scratch every run
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._image_table = BandTable(self.image_bands)
+        self._image_hashes = array('Q')
+        self._image_owners: List[Tuple[str, str]] = []
+        self._review_table = BandTable(self.review_bands)
+        self._signatures: Optional[np.ndarray] = None
+        self._review_owners: List[Tuple[str, str]] = []
+
+    def _append_signature(self, signature: np.ndarray) -> int:
+        count = len(self._review_owners)
+        if self._signatures is None:
+            self._signatures = np.empty((1024, len(signature)), dtype=np.uint32)
+        elif count == len(self._signatures):
+            self._signatures = np.concatenate([self._signatures, np.empty_like(self._signatures)])
+        self._signatures[count] = signature
+        return count
+
+    def add_many(self, entries: Iterable[IndexEntry]) -> int:
+        added = 0
+        with self._lock:
+            for entry in entries:
+                owner = (entry.claim_id, entry.group_id)
+                for image_hash in entry.image_hashes:
+                    self._image_table.add(len(self._image_hashes), image_hash_bands(image_hash, self.image_bands))
+                    self._image_hashes.append(image_hash)
+                    self._image_owners.append(owner)
+                if entry.review_signature is not None:
+                    entry_id = self._append_signature(entry.review_signature)
+                    self._review_table.add(entry_id, signature_bands(entry.review_signature, self.review_bands))
+                    self._review_owners.append(owner)
+                added += 1
+        return added
+
+    def _image_candidates(self, band_keys: List[int]) -> Iterable[Tuple[str, str, int]]:
+        with self._lock:
+            return [(*self._image_owners[entry_id], self._image_hashes[entry_id]) for entry_id in self._image_table.lookup(band_keys)]
+
+    def _review_candidates(self, band_keys: List[int]) -> Iterable[Tuple[str, str, np.ndarray]]:
+        with self._lock:
+            return [(*self._review_owners[entry_id], self._signatures[entry_id].copy()) for entry_id in self._review_table.lookup(band_keys)]
+
+
+def _to_signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class SQLiteSimilarityIndex(SimilarityIndex):
+    """
+    Persistent index backed by SQLite, with the band tables clustered on (band, key)
+    """
+
+    def __init__(self, path: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS images (
+                    entry_id INTEGER PRIMARY KEY, claim_id TEXT NOT NULL, group_id TEXT NOT NULL, image_hash INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS image_bands (
+                    band INTEGER NOT NULL, key INTEGER NOT NULL, entry_id INTEGER NOT NULL,
+                    PRIMARY KEY (band, key, entry_id)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS reviews (
+                    entry_id INTEGER PRIMARY KEY, claim_id TEXT NOT NULL, group_id TEXT NOT NULL, signature BLOB NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS review_bands (
+                    band INTEGER NOT NULL, key INTEGER NOT NULL, entry_id INTEGER NOT NULL,
+                    PRIMARY KEY (band, key, entry_id)
+                ) WITHOUT ROWID;
+                """
+            )
+            # Band layouts must match the ones the index was built with
+            for name, value in (('image_bands', self.image_bands), ('review_bands', self.review_bands)):
+                connection.execute("INSERT OR IGNORE INTO settings (name, value) VALUES (?, ?)", (name, str(value)))
+                stored = connection.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()[0]
+                if int(stored) != value:
+                    raise ValueError(f"{path} was built with {name}={stored}, not {value}; use a new FRAUD_INDEX_PATH")
+
+    def after_fork(self) -> None:
+        # Connections opened before fork() belong to the parent process
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def add_many(self, entries: Iterable[IndexEntry]) -> int:
+        connection = self._connection()
+        added = 0
+        with connection:
+            # Reserve entry ids under the write lock so concurrent writers never collide
+            connection.execute("BEGIN IMMEDIATE")
+            next_image = connection.execute("SELECT COALESCE(MAX(entry_id), 0) + 1 FROM images").fetchone()[0]
+            next_review = connection.execute("SELECT COALESCE(MAX(entry_id), 0) + 1 FROM reviews").fetchone()[0]
+            images, image_bands, reviews, review_bands = [], [], [], []
+            for entry in entries:
+                for image_hash in entry.image_hashes:
+                    images.append((next_image, entry.claim_id, entry.group_id, _to_signed(image_hash)))
+                    image_bands.extend((band, key, next_image) for band, key in enumerate(image_hash_bands(image_hash, self.image_bands)))
+                    next_image += 1
+                if entry.review_signature is not None:
+                    reviews.append((next_review, entry.claim_id, entry.group_id, entry.review_signature.astype(np.uint32).tobytes()))
+                    review_bands.extend((band, key, next_review) for band, key in enumerate(signature_bands(entry.review_signature, self.review_bands)))
+                    next_review += 1
+                added += 1
+            connection.executemany("INSERT INTO images VALUES (?, ?, ?, ?)", images)
+            connection.executemany("INSERT INTO image_bands VALUES (?, ?, ?)", image_bands)
+            connection.executemany("INSERT INTO reviews VALUES (?, ?, ?, ?)", reviews)
+            connection.executemany("INSERT INTO review_bands VALUES (?, ?, ?)", review_bands)
+        return added
+
+    @staticmethod
+    def _band_query(table: str, columns: str, band_keys: List[int]) -> Tuple[str, List[int]]:
+        clauses = " OR ".join("(b.band = ? AND b.key = ?)" for _ in band_keys)
+        params = [value for band, key in enumerate(band_keys) for value in (band, key)]
+        return (
+            f"SELECT DISTINCT {columns} FROM {table}_bands b JOIN {table}s t ON t.entry_id = b.entry_id WHERE {clauses}",
+            params
+        )
+
+    def _image_candidates(self, band_keys: List[int]) -> Iterable[Tuple[str, str, int]]:
+        query, params = self._band_query('image', 't.entry_id, t.claim_id, t.group_id, t.image_hash', band_keys)
+        return [
+            (claim_id, group_id, image_hash & ((1 << 64) - 1))
+            for _, claim_id, group_id, image_hash in self._connection().execute(query, params)
+        ]
+
+    def _review_candidates(self, band_keys: List[int]) -> Iterable[Tuple[str, str, np.ndarray]]:
+        query, params = self._band_query('review', 't.entry_id, t.claim_id, t.group_id, t.signature', band_keys)
+        return [
+            (claim_id, group_id, np.frombuffer(signature, dtype=np.uint32))
+            for _, claim_id, group_id, signature in self._connection().execute(query, params)
+        ]
+
+
+def create_similarity_index(backend: str = Config.FRAUD_INDEX_BACKEND) -> SimilarityIndex:
+    """
+    Create the fraud screening index from configuration
+
+    :param backend: One of 'sqlite' or 'memory'
+    :return: Similarity index instance
+    """
+    if backend == 'sqlite':
+        return SQLiteSimilarityIndex(Config.FRAUD_INDEX_PATH)
+    if backend == 'memory':
+        return MemorySimilarityIndex()
+    raise ValueError(f"Unknown fraud index backend '{backend}'")
+